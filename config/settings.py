@@ -12,6 +12,9 @@ POP_SERVER = os.getenv('POP_SERVER', 'mail.webpossa.com')
 POP_PORT = int(os.getenv('POP_PORT', '110'))
 POP_USER = os.getenv('POP_USER', 'webpos_inbox@webpossa.com')
 POP_PASSWORD = os.getenv('POP_PASSWORD', 'password')
+# Estado de UIDL ya procesados y borrado opcional (DELE) tras una entrega exitosa
+POP_UIDL_STATE_FILE = os.getenv('POP_UIDL_STATE_FILE', 'pop_uidl_state.txt')
+POP_DELETE_AFTER_DELIVERY = os.getenv('POP_DELETE_AFTER_DELIVERY', 'false').lower() == 'true'
 
 SMTP_SERVER = os.getenv('SMTP_SERVER', 'mail.webpossa.com')
 SMTP_PORT = int(os.getenv('SMTP_PORT', '587'))
@@ -19,14 +22,118 @@ SMTP_USER = os.getenv('SMTP_USER', 'edelivery@webpossa.com')
 SMTP_PASSWORD = os.getenv('SMTP_PASSWORD', 'password')
 SMTP_USE_SSL = os.getenv('SMTP_USE_SSL', 'true').lower() == 'true'
 
+# Límites de envío SMTP (0 = sin límite): tasa por cuenta, por dominio de destino y envíos simultáneos
+SMTP_RATE_PER_SECOND = float(os.getenv('SMTP_RATE_PER_SECOND', '5'))
+SMTP_BURST = int(os.getenv('SMTP_BURST', '10'))
+SMTP_DOMAIN_RATE_PER_SECOND = float(os.getenv('SMTP_DOMAIN_RATE_PER_SECOND', '2'))
+SMTP_DOMAIN_BURST = int(os.getenv('SMTP_DOMAIN_BURST', '5'))
+SMTP_MAX_IN_FLIGHT = int(os.getenv('SMTP_MAX_IN_FLIGHT', '4'))
+SMTP_TRANSIENT_RETRIES = int(os.getenv('SMTP_TRANSIENT_RETRIES', '2'))
+
 IMAP_SERVER = os.getenv('IMAP_SERVER', 'mail.webpossa.com')
 IMAP_PORT = int(os.getenv('IMAP_PORT', '993'))
 IMAP_USER = os.getenv('IMAP_USER', 'webpos_inbox@webpossa.com')
 IMAP_PASSWORD = os.getenv('IMAP_PASSWORD', 'QD4$xG')
 IMAP_USE_SSL = os.getenv('IMAP_USE_SSL', 'true').lower() == 'true'
+# Carpetas a las que se mueven los emails procesados (formato strftime) y los fallidos; vacío = quedan en INBOX
+IMAP_PROCESSED_FOLDER = os.getenv('IMAP_PROCESSED_FOLDER', 'Procesados/%Y-%m')
+IMAP_ERROR_FOLDER = os.getenv('IMAP_ERROR_FOLDER', 'Errores')
+
+# Plazos (segundos) de las conexiones IMAP, POP3 y SMTP: conexión, cada lectura y total por operación
+# (conexión, búsqueda, descarga, envío...); al vencer el total el watchdog corta la conexión. 0 = sin plazo
+MAIL_CONNECT_TIMEOUT = float(os.getenv('MAIL_CONNECT_TIMEOUT', '15'))
+MAIL_READ_TIMEOUT = float(os.getenv('MAIL_READ_TIMEOUT', '60'))
+MAIL_OPERATION_TIMEOUT = float(os.getenv('MAIL_OPERATION_TIMEOUT', '300'))
+WATCHDOG_INTERVAL = float(os.getenv('WATCHDOG_INTERVAL', '5'))
+# Circuit breaker por servidor (IMAP, POP3, SMTP): fallos de conexión seguidos para abrirlo y
+# enfriamiento (segundos) antes de probar de nuevo, que se duplica con cada prueba fallida hasta el máximo
+CIRCUIT_FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '3'))
+CIRCUIT_COOLDOWN_SECONDS = float(os.getenv('CIRCUIT_COOLDOWN_SECONDS', '30'))
+CIRCUIT_MAX_COOLDOWN_SECONDS = float(os.getenv('CIRCUIT_MAX_COOLDOWN_SECONDS', '600'))
 
+# Protocolo de lectura del buzón en modo servicio: imap o pop3
+MAIL_PROTOCOL = os.getenv('MAIL_PROTOCOL', 'imap').lower()
 CHECK_INTERVAL = int(os.getenv('CHECK_INTERVAL', '30'))
+# Intervalo adaptativo del modo servicio: baja a POLL_MIN_INTERVAL mientras llegan correos y, con el
+# buzón vacío, se multiplica por POLL_BACKOFF_FACTOR hasta POLL_MAX_INTERVAL (segundos). false = CHECK_INTERVAL fijo
+POLL_ADAPTIVE = os.getenv('POLL_ADAPTIVE', 'true').lower() == 'true'
+POLL_MIN_INTERVAL = float(os.getenv('POLL_MIN_INTERVAL', '5'))
+POLL_MAX_INTERVAL = float(os.getenv('POLL_MAX_INTERVAL', '300'))
+POLL_BACKOFF_FACTOR = float(os.getenv('POLL_BACKOFF_FACTOR', '2'))
+# IMAP: antes de la búsqueda completa se consulta STATUS INBOX (UNSEEN UIDNEXT) en una sesión que queda
+# abierta; si no cambió se omite la revisión. Igual se hace una completa cada POLL_FULL_CHECK_SECONDS
+POLL_STATUS_CHECK = os.getenv('POLL_STATUS_CHECK', 'true').lower() == 'true'
+POLL_FULL_CHECK_SECONDS = float(os.getenv('POLL_FULL_CHECK_SECONDS', '900'))
+
+# Varias cuentas por proceso: archivo JSON con la lista de perfiles (ver ReadmeENV.md)
+ACCOUNTS_FILE = os.getenv('ACCOUNTS_FILE') or None
+
+# Reparto de un mismo buzón entre réplicas: cada una procesa los UID con UID % SHARD_COUNT == SHARD_INDEX
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
 
 TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'templates')
+# Aplicar el CSS en línea y minificar las plantillas HTML al cargarlas
+TEMPLATES_COMPACT = os.getenv('TEMPLATES_COMPACT', 'true').lower() == 'true'
 RETENTION_LOG = int(os.getenv('RETENTION_LOG', '7'))
-LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
\ No newline at end of file
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+
+# Modo resumen (digest) para las notificaciones internas de procesamiento
+DIGEST_ENABLED = os.getenv('DIGEST_ENABLED', 'false').lower() == 'true'
+DIGEST_MAX_ITEMS = int(os.getenv('DIGEST_MAX_ITEMS', '50'))
+DIGEST_WINDOW_SECONDS = int(os.getenv('DIGEST_WINDOW_SECONDS', '900'))
+
+# Agrupación de los emails de cliente por destinatario: ventana en minutos (0 = un email por documento),
+# máximo de documentos y tamaño máximo (MB) de los adjuntos por email
+BUNDLE_WINDOW_MINUTES = float(os.getenv('BUNDLE_WINDOW_MINUTES', '0'))
+BUNDLE_MAX_DOCUMENTS = int(os.getenv('BUNDLE_MAX_DOCUMENTS', '25'))
+BUNDLE_MAX_MB = int(os.getenv('BUNDLE_MAX_MB', '15'))
+# Carpeta donde esperan en disco los documentos agrupados aún no enviados (se reenvían al reiniciar)
+BUNDLE_SPOOL_DIR = os.getenv('BUNDLE_SPOOL_DIR', 'bundle_spool')
+
+# Adjuntos: tamaño (bytes) a partir del cual se vuelcan a un archivo temporal
+ATTACHMENT_SPOOL_THRESHOLD = int(os.getenv('ATTACHMENT_SPOOL_THRESHOLD', str(1024 * 1024)))
+TEMP_DIR = os.getenv('TEMP_DIR') or None
+
+# Límites de descompresión de adjuntos ZIP (protección contra ZIP bombs)
+ZIP_MAX_ENTRIES = int(os.getenv('ZIP_MAX_ENTRIES', '500'))
+ZIP_MAX_ENTRY_BYTES = int(os.getenv('ZIP_MAX_ENTRY_BYTES', str(20 * 1024 * 1024)))
+ZIP_MAX_TOTAL_BYTES = int(os.getenv('ZIP_MAX_TOTAL_BYTES', str(100 * 1024 * 1024)))
+ZIP_MAX_RATIO = int(os.getenv('ZIP_MAX_RATIO', '100'))
+
+# Control de admisión: memoria máxima (MB) en vuelo entre descarga, limpieza de PDFs y armado MIME.
+# Cada mensaje reserva su tamaño RFC822 por MEMORY_ESTIMATE_FACTOR (0 = sin límite)
+MEMORY_BUDGET_MB = int(os.getenv('MEMORY_BUDGET_MB', '256'))
+MEMORY_ESTIMATE_FACTOR = float(os.getenv('MEMORY_ESTIMATE_FACTOR', '4'))
+# Emails IMAP procesados en paralelo dentro del presupuesto de memoria
+MESSAGE_WORKERS = int(os.getenv('MESSAGE_WORKERS', '2'))
+
+# Orden de proceso de los correos pendientes: plazo virtual = llegada + nivel de prioridad x paso
+# + tiempo estimado según tamaño (los chicos primero). Prioridades "clave:nivel", nivel menor = antes:
+# por tipo de documento ("01:0,07:2") y por remitente o dominio ("urgente@x.com:-1,@masivo.com:2")
+SCHEDULER_ENABLED = os.getenv('SCHEDULER_ENABLED', 'true').lower() == 'true'
+SCHEDULER_DOCUMENT_PRIORITY = os.getenv('SCHEDULER_DOCUMENT_PRIORITY', '')
+SCHEDULER_SENDER_PRIORITY = os.getenv('SCHEDULER_SENDER_PRIORITY', '')
+SCHEDULER_PRIORITY_STEP_SECONDS = int(os.getenv('SCHEDULER_PRIORITY_STEP_SECONDS', '300'))
+SCHEDULER_SJF_KB_PER_SECOND = int(os.getenv('SCHEDULER_SJF_KB_PER_SECOND', '100'))
+# Cada cuántos segundos se buscan correos nuevos mientras se procesa una cola larga (0 = solo al inicio)
+SCHEDULER_RESCAN_SECONDS = int(os.getenv('SCHEDULER_RESCAN_SECONDS', '30'))
+
+# Envíos en paralelo cuando un email trae varios documentos
+DELIVERY_WORKERS = int(os.getenv('DELIVERY_WORKERS', '4'))
+
+# Índice local (SQLite) de los mensajes vistos para los modos monitor y audit (vacío = desactivado)
+MESSAGE_INDEX_FILE = os.getenv('MESSAGE_INDEX_FILE', 'message_index.db')
+
+# Archivo legal de los XML y PDF entregados (vacío = desactivado) y tamaño máximo de cada segmento
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_SEGMENT_MB = int(os.getenv('ARCHIVE_SEGMENT_MB', '256'))
+# MB máximos de documentos esperando en memoria a que el hilo del archivo los escriba
+ARCHIVE_QUEUE_MB = int(os.getenv('ARCHIVE_QUEUE_MB', '32'))
+
+# Generar el RIDE (PDF) cuando un XML llega sin PDF
+RIDE_ENABLED = os.getenv('RIDE_ENABLED', 'true').lower() == 'true'
+
+# Ingreso por lotes desde carpeta (--mode batch)
+BATCH_CHECKPOINT_FILE = os.getenv('BATCH_CHECKPOINT_FILE') or None
+BATCH_SETTLE_SECONDS = int(os.getenv('BATCH_SETTLE_SECONDS', '5'))
@@ -0,0 +1,86 @@
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from config import settings
+from core.logger import logger
+
+_MB = 1024 * 1024
+
+
+class MemoryBudget:
+    """
+    Presupuesto de bytes en vuelo (mensajes descargados, adjuntos decodificados, PDFs
+    limpios y MIME de salida). acquire() bloquea la descarga de nuevos mensajes hasta
+    que las entregas en curso liberen memoria. Un mensaje mayor que el presupuesto
+    completo se admite solo cuando no hay nada más en vuelo.
+    """
+
+    def __init__(self, limit_bytes: int, estimate_factor: float = 1.0):
+        self.limit = max(0, int(limit_bytes))
+        self.estimate_factor = max(1.0, float(estimate_factor))
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+    @property
+    def in_use(self) -> int:
+        with self._cond:
+            return self._in_use
+
+    def estimate(self, message_size: int) -> int:
+        """
+        Memoria estimada para procesar un mensaje de `message_size` bytes de principio a fin.
+        """
+        return int(message_size * self.estimate_factor)
+
+    def is_oversized(self, cost: int) -> bool:
+        return bool(self.limit) and cost > self.limit
+
+    def acquire(self, cost: int) -> int:
+        """
+        Reserva `cost` bytes, esperando a que haya espacio. Retorna lo reservado.
+        """
+        if not self.limit:
+            return 0
+        with self._cond:
+            if not self._fits(cost):
+                logger.info(f"⏸️  Presupuesto de memoria completo ({self._in_use / _MB:.1f} de {self.limit / _MB:.0f} MB "
+                            f"en vuelo), esperando entregas para admitir {cost / _MB:.1f} MB")
+                self._cond.wait_for(lambda: self._fits(cost))
+            self._in_use += cost
+            return cost
+
+    def _fits(self, cost: int) -> bool:
+        if self.is_oversized(cost):
+            return self._in_use == 0
+        return self._in_use + cost <= self.limit
+
+    def release(self, cost: int) -> None:
+        if not cost:
+            return
+        with self._cond:
+            self._in_use = max(0, self._in_use - cost)
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, cost: int) -> Iterator[int]:
+        reserved = self.acquire(cost)
+        try:
+            yield reserved
+        finally:
+            self.release(reserved)
+
+
+_budget: Optional[MemoryBudget] = None
+_budget_lock = threading.Lock()
+
+
+def get_memory_budget() -> MemoryBudget:
+    """
+    Presupuesto compartido por todas las cuentas y hilos del proceso.
+    """
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = MemoryBudget(settings.MEMORY_BUDGET_MB * _MB, settings.MEMORY_ESTIMATE_FACTOR)
+        return _budget
@@ -0,0 +1,282 @@
+import atexit
+import gzip
+import hashlib
+import os
+import queue
+import sqlite3
+import struct
+import threading
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import settings
+from core.logger import logger
+
+try:
+    import zstandard
+except ImportError:  # zstd es opcional; sin él se comprime con gzip
+    zstandard = None
+
+# Encabezado de cada registro del segmento: marca, sha256 del contenido, códec y largo comprimido
+_RECORD = struct.Struct(">4s32sBQ")
+_MAGIC = b"ARC1"
+_CODEC_GZIP = 1
+_CODEC_ZSTD = 2
+
+# Reintentos de una tanda que no se pudo archivar (p. ej. "database is locked" con otra réplica):
+# espera creciente hasta _RETRY_MAX_DELAY segundos, sin límite de intentos mientras el proceso
+# sigue; al salir se intenta _EXIT_ATTEMPTS veces para no bloquear el cierre
+_RETRY_MAX_DELAY = 60.0
+_EXIT_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    digest BLOB PRIMARY KEY,
+    segment TEXT NOT NULL,
+    offset INTEGER NOT NULL,
+    length INTEGER NOT NULL,
+    codec INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS documents (
+    clave_acceso TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    digest BLOB NOT NULL,
+    archived_at TEXT NOT NULL,
+    PRIMARY KEY (clave_acceso, filename, digest)
+);
+"""
+
+
+class ArchiveStore:
+    """
+    Archivo legal de los documentos entregados (XML y PDF limpio). Cada contenido se guarda
+    una sola vez (direccionado por su sha256), comprimido con zstd o gzip, en segmentos
+    append-only de hasta ARCHIVE_SEGMENT_MB; un índice SQLite lleva de la clave de acceso
+    al segmento y offset de cada archivo. La escritura la hace un hilo propio, fuera del envío;
+    los documentos en cola ocupan como máximo `queue_bytes`.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int, queue_bytes: int = 32 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(os.path.join(directory, "index.db"), timeout=10,
+                                   check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._db_lock = threading.Lock()
+        self._queue: "queue.Queue[Optional[Tuple[str, List[Tuple[str, bytes]]]]]" = queue.Queue()
+        self.queue_bytes = max(0, int(queue_bytes))
+        self._queued = 0
+        self._queued_cond = threading.Condition()
+        self._compressor = zstandard.ZstdCompressor(level=10) if zstandard else None
+        self._exiting = threading.Event()
+        self._thread = threading.Thread(target=self._writer, name="archivo", daemon=True)
+        self._thread.start()
+
+    def submit(self, clave_acceso: str, files: Iterable[Tuple[str, bytes]]) -> None:
+        """
+        Encola los archivos de un documento para archivarlos. Si la cola ya ocupa `queue_bytes`
+        espera a que el hilo escriba, para no acumular sin límite copias en memoria (fuera del
+        presupuesto de MEMORY_BUDGET_MB). Un documento mayor que el límite se admite con la cola vacía.
+        """
+        files = [(filename, bytes(content)) for filename, content in files]
+        size = sum(len(content) for _, content in files)
+        with self._queued_cond:
+            self._queued_cond.wait_for(lambda: not self._queued or self._queued + size <= self.queue_bytes)
+            self._queued += size
+        self._queue.put((clave_acceso, files))
+
+    def get(self, clave_acceso: str) -> List[Tuple[str, bytes]]:
+        """
+        (nombre, contenido) de los archivos archivados de una clave de acceso.
+        """
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT d.filename, b.segment, b.offset, b.length, b.codec FROM documents d "
+                "JOIN blobs b ON b.digest = d.digest WHERE d.clave_acceso = ? ORDER BY d.archived_at",
+                (clave_acceso,)
+            ).fetchall()
+        return [(filename, self._read(segment, offset, length, codec))
+                for filename, segment, offset, length, codec in rows]
+
+    def flush(self, final: bool = False) -> None:
+        """
+        Espera a que se escriban los documentos encolados. Con `final` (al salir del proceso)
+        las tandas que fallan dejan de reintentarse tras _EXIT_ATTEMPTS intentos.
+        """
+        if final:
+            self._exiting.set()
+        self._queue.join()
+
+    def close(self) -> None:
+        self._exiting.set()
+        self._queue.put(None)
+        self._thread.join()
+        with self._db_lock:
+            self._db.close()
+
+    def _read(self, segment: str, offset: int, length: int, codec: int) -> bytes:
+        with open(os.path.join(self.directory, segment), "rb") as f:
+            data = os.pread(f.fileno(), length, offset + _RECORD.size)
+        if codec == _CODEC_ZSTD:
+            if zstandard is None:
+                raise RuntimeError("El documento está comprimido con zstd y el paquete zstandard no está instalado")
+            return zstandard.ZstdDecompressor().decompress(data)
+        return gzip.decompress(data)
+
+    def _writer(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            # Se agrupa lo que haya en cola: un fsync y una transacción por tanda
+            batch = [item]
+            while True:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+            try:
+                self._write_with_retry(batch)
+            finally:
+                with self._queued_cond:
+                    self._queued -= sum(len(content) for _, files in batch for _, content in files)
+                    self._queued_cond.notify_all()
+                for _ in batch:
+                    self._queue.task_done()
+
+    def _write_with_retry(self, batch: List[Tuple[str, List[Tuple[str, bytes]]]]) -> None:
+        """
+        Archiva una tanda reintentando hasta lograrlo. Los archivos ya escritos en un segmento
+        se recuerdan entre intentos: solo se repite lo que falta, sin duplicar bytes en disco.
+        """
+        written: Dict[bytes, Tuple] = {}
+        attempt = 0
+        while True:
+            try:
+                self._write_batch(batch, written)
+                return
+            except Exception as e:
+                attempt += 1
+                claves = [clave_acceso for clave_acceso, _ in batch]
+                if self._exiting.is_set() and attempt >= _EXIT_ATTEMPTS:
+                    logger.critical(f"No se pudieron archivar {len(batch)} documentos tras {attempt} intentos: "
+                                    f"{e}. Claves sin archivar: {claves}")
+                    return
+                delay = min(_RETRY_MAX_DELAY, 2.0 ** (attempt - 1))
+                logger.error(f"Error archivando {len(batch)} documentos (intento {attempt}): {e}. "
+                             f"Se reintenta en {delay:g}s")
+                # Al salir se despierta antes para no demorar el cierre
+                self._exiting.wait(delay)
+
+    def _write_batch(self, batch: List[Tuple[str, List[Tuple[str, bytes]]]], written: Dict[bytes, Tuple]) -> None:
+        """
+        Escribe los archivos nuevos de la tanda en un segmento y los registra en el índice en una
+        sola transacción. `written` lleva las filas ya escritas en un intento anterior.
+        """
+        now = datetime.now().isoformat(timespec="seconds")
+        blobs, documents, stored = [], [], 0
+        with self._db_lock:
+            known = set(written)
+            for clave_acceso, files in batch:
+                for filename, content in files:
+                    digest = hashlib.sha256(content).digest()
+                    documents.append((clave_acceso, filename, digest, now))
+                    if digest in known or self._db.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest,)).fetchone():
+                        continue  # reenvío: el contenido ya está archivado
+                    known.add(digest)
+                    blobs.append((digest, content))
+
+        if blobs:
+            rows = []
+            segment, f = self._open_segment()
+            try:
+                _lock_file(f)
+                offset = f.seek(0, os.SEEK_END)
+                for digest, content in blobs:
+                    codec, data = self._compress(content)
+                    f.write(_RECORD.pack(_MAGIC, digest, codec, len(data)))
+                    f.write(data)
+                    rows.append((digest, segment, offset, len(data), codec, len(content)))
+                    offset += _RECORD.size + len(data)
+                    stored += len(data)
+                f.flush()
+                # Los datos quedan en disco antes de que el índice apunte a ellos
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+            written.update((row[0], row) for row in rows)
+
+        # Con la conexión como contexto, un error hace ROLLBACK y la conexión no queda dentro de la transacción
+        with self._db_lock, self._db:
+            self._db.execute("BEGIN")
+            self._db.executemany("INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?, ?, ?)", written.values())
+            self._db.executemany("INSERT OR IGNORE INTO documents VALUES (?, ?, ?, ?)", documents)
+        logger.info(f"🗄️ Archivados {len(batch)} documentos: {len(written)} archivos nuevos, "
+                    f"{len(documents) - len(written)} ya existentes ({stored} bytes comprimidos)")
+
+    def _compress(self, content: bytes) -> Tuple[int, bytes]:
+        if self._compressor is not None:
+            return _CODEC_ZSTD, self._compressor.compress(content)
+        return _CODEC_GZIP, gzip.compress(content, compresslevel=6, mtime=0)
+
+    def _open_segment(self):
+        """
+        Abre para agregar el último segmento, o uno nuevo si ya alcanzó el tamaño máximo.
+        """
+        segments = sorted(name for name in os.listdir(self.directory) if name.startswith("segment_"))
+        if segments and os.path.getsize(os.path.join(self.directory, segments[-1])) < self.segment_bytes:
+            name = segments[-1]
+        else:
+            name = f"segment_{len(segments) + 1:06d}.dat"
+        return name, open(os.path.join(self.directory, name), "ab")
+
+
+def _lock_file(f) -> None:
+    """
+    Bloqueo exclusivo del segmento (se libera al cerrarlo), para réplicas que comparten ARCHIVE_DIR.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+_store: Optional[ArchiveStore] = None
+_store_lock = threading.Lock()
+
+
+def get_archive_store() -> Optional[ArchiveStore]:
+    """
+    Archivo compartido por todas las cuentas y hilos del proceso (None si ARCHIVE_DIR está vacío).
+    """
+    global _store
+    if not settings.ARCHIVE_DIR:
+        return None
+    with _store_lock:
+        if _store is None:
+            _store = ArchiveStore(settings.ARCHIVE_DIR, settings.ARCHIVE_SEGMENT_MB * 1024 * 1024,
+                                  settings.ARCHIVE_QUEUE_MB * 1024 * 1024)
+            # Al salir se terminan de escribir los documentos encolados
+            atexit.register(_store.flush, True)
+        return _store
+
+
+def flush_archive_store() -> None:
+    """
+    Termina de escribir los documentos encolados, si el archivo del proceso llegó a crearse.
+    Los workers de ProcessPoolExecutor terminan sin ejecutar atexit: lo registran con Finalize.
+    """
+    with _store_lock:
+        store = _store
+    if store is not None:
+        store.flush(final=True)
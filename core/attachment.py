@@ -0,0 +1,230 @@
+import binascii
+import email.message
+import io
+import mmap
+import os
+import tempfile
+from typing import BinaryIO, Optional, Union
+
+from config import settings
+
+# Tamaño de los bloques de base64 decodificados por iteración (múltiplo de 4)
+_DECODE_CHUNK = 64 * 1024
+
+
+class _MappedFile(io.RawIOBase):
+    """
+    Archivo de solo lectura sobre un mmap propio, que se libera al cerrarlo. mmap no tiene
+    seekable() antes de Python 3.13 y ZipFile lo necesita para leer las entradas.
+    """
+
+    def __init__(self, mapped: mmap.mmap):
+        super().__init__()
+        self._mmap = mapped
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._mmap.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        self._mmap.seek(offset, whence)
+        return self._mmap.tell()
+
+    def tell(self) -> int:
+        return self._mmap.tell()
+
+    def close(self) -> None:
+        if not self.closed:
+            self._mmap.close()
+        super().close()
+
+
+class Attachment:
+    """
+    Adjunto decodificado una sola vez.
+
+    Los contenidos por debajo de ATTACHMENT_SPOOL_THRESHOLD se mantienen en memoria;
+    los mayores se vuelcan a un archivo temporal que se mapea en memoria (mmap).
+    Los consumidores acceden al contenido con view() (memoryview) u open()
+    (objeto tipo archivo) sin generar copias adicionales.
+    """
+
+    def __init__(self, filename: str, content_type: str = "application/octet-stream",
+                 spool_threshold: Optional[int] = None):
+        self.filename = filename
+        self.content_type = content_type
+        self.detected_type = ""
+        self.size = 0
+        self._threshold = settings.ATTACHMENT_SPOOL_THRESHOLD if spool_threshold is None else spool_threshold
+        self._buffer: Optional[io.BytesIO] = io.BytesIO()
+        self._data: Optional[bytes] = None
+        self._file: Optional[BinaryIO] = None
+        self._mmap: Optional[mmap.mmap] = None
+
+    @classmethod
+    def from_bytes(cls, filename: str, data: bytes, content_type: str = "application/octet-stream",
+                   spool_threshold: Optional[int] = None) -> "Attachment":
+        """
+        Crea un adjunto a partir de bytes ya decodificados (sin copiarlos si caben en memoria).
+        """
+        attachment = cls(filename, content_type, spool_threshold)
+        if len(data) > attachment._threshold:
+            attachment.write(data)
+        else:
+            attachment._buffer = None
+            attachment._data = bytes(data)
+            attachment.size = len(data)
+        return attachment
+
+    @classmethod
+    def from_part(cls, part: email.message.Message, filename: str,
+                  spool_threshold: Optional[int] = None) -> Optional["Attachment"]:
+        """
+        Decodifica el payload de una parte MIME directamente al almacenamiento del adjunto.
+        Los payloads base64 se decodifican por bloques, sin materializar el contenido completo.
+        """
+        content_type = part.get_content_type()
+        payload = part.get_payload()
+        encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+
+        if encoding == 'base64' and isinstance(payload, str):
+            attachment = cls(filename, content_type, spool_threshold)
+            try:
+                pending = ""
+                for start in range(0, len(payload), _DECODE_CHUNK):
+                    chunk = pending + "".join(payload[start:start + _DECODE_CHUNK].split())
+                    usable = len(chunk) - len(chunk) % 4
+                    if usable:
+                        attachment.write(binascii.a2b_base64(chunk[:usable]))
+                    pending = chunk[usable:]
+                if pending.rstrip("="):
+                    attachment.write(binascii.a2b_base64(pending + "=" * (-len(pending) % 4)))
+                return attachment.finish() if attachment.size else None
+            except binascii.Error:
+                # Base64 mal formado: delegar en el decodificador tolerante de la librería email
+                attachment.close()
+
+        data = part.get_payload(decode=True)
+        if not data:
+            return None
+        return cls.from_bytes(filename, data, content_type, spool_threshold)
+
+    def write(self, chunk: bytes) -> None:
+        """
+        Agrega contenido al adjunto, volcando a disco al superar el umbral.
+        """
+        if self._file is None and self.size + len(chunk) > self._threshold:
+            temp_dir = settings.TEMP_DIR
+            if temp_dir:
+                os.makedirs(temp_dir, exist_ok=True)
+            self._file = tempfile.TemporaryFile(dir=temp_dir)
+            if self._buffer is not None:
+                self._file.write(self._buffer.getbuffer())
+                self._buffer = None
+            elif self._data is not None:
+                self._file.write(self._data)
+                self._data = None
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            if self._buffer is None:
+                self._buffer = io.BytesIO(self._data or b"")
+                self._buffer.seek(0, io.SEEK_END)
+                self._data = None
+            self._buffer.write(chunk)
+        self.size += len(chunk)
+
+    def finish(self) -> "Attachment":
+        """
+        Cierra la etapa de escritura y deja el contenido listo para lectura.
+        """
+        if self._file is not None:
+            self._file.flush()
+            if self._mmap is None and self.size:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        elif self._buffer is not None:
+            self._data = self._buffer.getvalue()
+            self._buffer = None
+        return self
+
+    @property
+    def spooled(self) -> bool:
+        """
+        Indica si el contenido está almacenado en un archivo temporal.
+        """
+        return self._file is not None
+
+    def view(self) -> memoryview:
+        """
+        Vista de solo lectura del contenido, sin copiarlo.
+        """
+        self.finish()
+        if self._mmap is not None:
+            return memoryview(self._mmap)
+        return memoryview(self._data or b"")
+
+    def open(self) -> BinaryIO:
+        """
+        Objeto tipo archivo (read/seek/tell) sobre el contenido, independiente por llamada.
+        """
+        self.finish()
+        if self._file is not None:
+            if not self.size:
+                return io.BytesIO(b"")
+            return _MappedFile(mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ))
+        return io.BytesIO(self._data or b"")
+
+    def head(self, size: int) -> bytes:
+        """
+        Primeros `size` bytes del contenido (copia pequeña para inspección).
+        """
+        return bytes(self.view()[:size])
+
+    def getvalue(self) -> bytes:
+        """
+        Copia completa del contenido en bytes, solo para consumidores que lo requieran.
+        """
+        self.finish()
+        if self._data is not None:
+            return self._data
+        return bytes(self.view())
+
+    def close(self) -> None:
+        """
+        Libera el almacenamiento del adjunto.
+        """
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # Aún hay vistas activas; el recolector liberará el mapeo
+                pass
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._buffer = None
+        self._data = None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __repr__(self) -> str:
+        storage = "disco" if self.spooled else "memoria"
+        return f"Attachment({self.filename!r}, {self.size} bytes, {storage})"
+
+
+def as_buffer(content: Union[bytes, bytearray, memoryview, Attachment]) -> Union[bytes, memoryview]:
+    """
+    Normaliza un contenido (bytes o Attachment) a un objeto bytes-like sin copiarlo.
+    """
+    if isinstance(content, Attachment):
+        return content.view()
+    return content
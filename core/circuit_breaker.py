@@ -0,0 +1,155 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Tuple
+
+from config import settings
+from core.logger import logger
+
+CLOSED = "cerrado"
+OPEN = "abierto"
+HALF_OPEN = "semiabierto"
+
+
+class CircuitOpen(ConnectionError):
+    """
+    El circuito del servidor está abierto: no se intenta conectar hasta que venza el enfriamiento.
+    """
+
+    def __init__(self, name: str, retry_in: float):
+        super().__init__(f"Servidor {name} no disponible (circuito abierto), próximo intento en {retry_in:.0f}s")
+        self.name = name
+        self.retry_in = retry_in
+
+
+def _is_connection_failure(error: BaseException) -> bool:
+    return isinstance(error, (OSError, EOFError))
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker de un servidor de correo (IMAP, POP3 o SMTP). Tras `failure_threshold`
+    fallos de conexión seguidos se abre: las conexiones fallan de inmediato con CircuitOpen
+    durante el enfriamiento. Al vencer, un único intento de prueba (semiabierto) decide: si
+    conecta se cierra, si falla se vuelve a abrir con el doble de enfriamiento, hasta
+    `max_cooldown` segundos. Los hilos que llegan durante la prueba esperan su resultado
+    en lugar de conectarse también.
+    """
+
+    def __init__(self, name: str, failure_threshold: int, cooldown: float, max_cooldown: float):
+        self.name = name
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.base_cooldown = max(0.0, float(cooldown))
+        self.max_cooldown = max(self.base_cooldown, float(max_cooldown))
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._cooldown = self.base_cooldown
+        self._retry_at = 0.0
+        self._probing = False
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def guard(self, is_failure: Callable[[BaseException], bool] = _is_connection_failure) -> Iterator[None]:
+        """
+        Ejecuta una conexión a través del circuito. Las excepciones para las que `is_failure`
+        es falso (el servidor respondió, por ejemplo con un error de autenticación) cuentan como éxito.
+        """
+        self._before_call()
+        try:
+            yield
+        except BaseException as e:
+            if is_failure(e):
+                self._record_failure(e)
+            else:
+                self._record_success()
+            raise
+        self._record_success()
+
+    def snapshot(self) -> Dict[str, object]:
+        with self._cond:
+            return {"estado": self.state, "fallos": self.failures, "aperturas": self.opened,
+                    "rechazados": self.rejected,
+                    "reintento_en": round(max(0.0, self._retry_at - time.monotonic()), 1) if self.state != CLOSED else 0}
+
+    def _before_call(self) -> None:
+        with self._cond:
+            if self.state == CLOSED:
+                return
+            now = time.monotonic()
+            if self.state == OPEN and now >= self._retry_at:
+                self.state = HALF_OPEN
+                self._probing = False
+            if self.state == HALF_OPEN and not self._probing:
+                # Solo un hilo prueba el servidor; los demás esperan el resultado
+                self._probing = True
+                logger.info(f"🔌 Circuito {self.name} semiabierto: probando la conexión")
+                return
+            if self.state == HALF_OPEN:
+                self._cond.wait_for(lambda: self.state != HALF_OPEN)
+                if self.state == CLOSED:
+                    return
+                now = time.monotonic()
+            self.rejected += 1
+            raise CircuitOpen(self.name, max(0.0, self._retry_at - now))
+
+    def _record_success(self) -> None:
+        with self._cond:
+            if self.state != CLOSED:
+                logger.info(f"✅ Circuito {self.name} cerrado: el servidor volvió a responder")
+            self.state = CLOSED
+            self.failures = 0
+            self._cooldown = self.base_cooldown
+            self._probing = False
+            self._cond.notify_all()
+
+    def _record_failure(self, error: BaseException) -> None:
+        with self._cond:
+            self.failures += 1
+            if self.state == HALF_OPEN:
+                # La prueba falló: enfriamiento exponencial
+                self._cooldown = min(self.max_cooldown, self._cooldown * 2)
+            elif self.state == OPEN or self.failures < self.failure_threshold:
+                return
+            self.state = OPEN
+            self.opened += 1
+            self._probing = False
+            self._cond.notify_all()
+            # Variación de ±10% para que las réplicas no prueben todas a la vez
+            cooldown = self._cooldown * random.uniform(0.9, 1.1)
+            self._retry_at = time.monotonic() + cooldown
+            logger.error(f"🚫 Circuito {self.name} abierto tras {self.failures} fallos ({error}), "
+                         f"próximo intento en {cooldown:.0f}s")
+
+
+_breakers: Dict[Tuple[str, str, int], CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(protocol: str, host: str, port: int) -> CircuitBreaker:
+    """
+    Circuito del servidor (protocolo, host, puerto), compartido por todas las cuentas y
+    hilos del proceso que se conectan a él.
+    """
+    key = (protocol, host, int(port))
+    with _breakers_lock:
+        breaker = _breakers.get(key)
+        if breaker is None:
+            breaker = _breakers[key] = CircuitBreaker(
+                f"{protocol} {host}:{port}",
+                settings.CIRCUIT_FAILURE_THRESHOLD,
+                settings.CIRCUIT_COOLDOWN_SECONDS,
+                settings.CIRCUIT_MAX_COOLDOWN_SECONDS,
+            )
+        return breaker
+
+
+def circuit_snapshot() -> Dict[str, Dict[str, object]]:
+    """
+    Estado de todos los circuitos del proceso.
+    """
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
@@ -0,0 +1,153 @@
+import os
+import xml.etree.ElementTree as ET
+from collections.abc import Mapping
+from dataclasses import dataclass, field
+from typing import Any, Iterator, List, Optional
+
+from core.attachment import Attachment
+from core.logger import logger
+from core.xml_data import XMLData
+
+
+@dataclass
+class ElectronicDocument:
+    """
+    Documento electrónico listo para entregar: el XML, sus datos extraídos y los PDFs asociados.
+    xml_root es el árbol ya parseado del comprobante, para generar el RIDE si llegó sin PDF.
+    """
+    xml_filename: str
+    xml_attachment: Attachment
+    xml_data: XMLData
+    pdfs: List[Attachment] = field(default_factory=list)
+    xml_root: Optional[ET.Element] = None
+
+    @property
+    def basename(self) -> str:
+        """
+        Nombre del XML sin ruta ni extensión, usado para emparejar PDFs.
+        """
+        return os.path.splitext(os.path.basename(self.xml_filename))[0].lower()
+
+    def matches_pdf(self, pdf_filename: str) -> bool:
+        """
+        Indica si el nombre de un PDF corresponde a este documento, por clave de acceso,
+        nombre base del XML o número de comprobante.
+        """
+        name = os.path.basename(pdf_filename).lower()
+        if self.xml_data.clave_acceso and self.xml_data.clave_acceso in name:
+            return True
+        if self.basename and os.path.splitext(name)[0] == self.basename:
+            return True
+        xml_data = self.xml_data
+        if xml_data.estab and xml_data.pto_emi and xml_data.secuencial:
+            for numero in (f"{xml_data.estab}-{xml_data.pto_emi}-{xml_data.secuencial}",
+                           f"{xml_data.estab}{xml_data.pto_emi}{xml_data.secuencial}"):
+                if numero in name:
+                    return True
+        return False
+
+
+def pair_pdfs(documents: List[ElectronicDocument], pdfs: List[Attachment]) -> None:
+    """
+    Asigna cada PDF a su documento por clave de acceso o nombre de archivo.
+    Si hay un solo documento recibe todos los PDFs sin emparejar; si quedan tantos PDFs
+    como documentos sin PDF, se emparejan en el orden en que llegaron.
+    """
+    if not documents:
+        return
+
+    unmatched = []
+    for pdf in pdfs:
+        match = next((doc for doc in documents if doc.matches_pdf(pdf.filename)), None)
+        if match:
+            match.pdfs.append(pdf)
+        else:
+            unmatched.append(pdf)
+
+    if not unmatched:
+        return
+    if len(documents) == 1:
+        documents[0].pdfs.extend(unmatched)
+        return
+
+    without_pdf = [doc for doc in documents if not doc.pdfs]
+    if len(without_pdf) == len(unmatched):
+        logger.warning(f"PDFs emparejados por orden de llegada: {[pdf.filename for pdf in unmatched]}")
+        for doc, pdf in zip(without_pdf, unmatched):
+            doc.pdfs.append(pdf)
+    else:
+        logger.warning(f"PDFs sin documento asociado (no se enviarán): {[pdf.filename for pdf in unmatched]}")
+
+
+# Claves del contexto de plantillas que se leen directamente de XMLData
+_XML_CONTEXT_KEYS = {
+    "email_extraido": lambda d: d.email_destinatario,
+    "clave_acceso": lambda d: d.clave_acceso,
+    "total_con_impuestos": lambda d: d.total_con_impuestos,
+    "razon_social": lambda d: d.razon_social_comprador or d.razon_social,
+    "fecha_emision": lambda d: d.fecha_emision,
+    "numero_factura": lambda d: d.numero_factura,
+    "xml_data": lambda d: d,
+    "numero_comprobante": XMLData.get_numero_comprobante,
+    "numero_autorizacion": lambda d: d.numero_autorizacion,
+    "estab": lambda d: d.estab,
+    "pto_emi": lambda d: d.pto_emi,
+    "secuencial": lambda d: d.secuencial,
+    "codigo_documento": lambda d: d.codigo_documento,
+    "tipo_documento_texto": XMLData.get_tipo_documento_texto,
+    "tipo_emision": lambda d: d.tipo_emision,
+    "tipo_emision_texto": XMLData.get_tipo_emision_texto,
+}
+
+
+class DocumentContext(Mapping):
+    """
+    Contexto de solo lectura para las plantillas de un documento. Los datos del XML se
+    leen de XMLData al acceder a cada clave, sin copiarlos a un diccionario; solo se
+    guardan los valores propios del envío (fecha, entorno, remitente, adjuntos...).
+    """
+    __slots__ = ("xml_data", "_values")
+
+    def __init__(self, xml_data: XMLData, **values: Any):
+        self.xml_data = xml_data
+        self._values = values
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._values:
+            return self._values[key]
+        getter = _XML_CONTEXT_KEYS.get(key)
+        if getter is None:
+            raise KeyError(key)
+        return getter(self.xml_data)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._values or key in _XML_CONTEXT_KEYS
+
+    def __iter__(self) -> Iterator[str]:
+        yield from self._values
+        yield from (key for key in _XML_CONTEXT_KEYS if key not in self._values)
+
+    def __len__(self) -> int:
+        return len(self._values) + sum(1 for key in _XML_CONTEXT_KEYS if key not in self._values)
+
+    def with_values(self, **values: Any) -> "DocumentContext":
+        """
+        Nuevo contexto con valores adicionales o reemplazados (el original no cambia).
+        """
+        return DocumentContext(self.xml_data, **{**self._values, **values})
+
+    def dump(self) -> dict:
+        """
+        Datos del XML y valores propios del envío, serializables a JSON.
+        """
+        return {"xml_data": dict(self.xml_data.items()), "values": dict(self._values)}
+
+    @classmethod
+    def load(cls, data: Mapping) -> "DocumentContext":
+        """
+        Reconstruye un contexto guardado con dump().
+        """
+        return cls(XMLData(**data["xml_data"]), **data["values"])
+
+    def __repr__(self) -> str:
+        return f"DocumentContext({self.xml_data.clave_acceso!r}, {self._values!r})"
@@ -1,4 +1,8 @@
-from dataclasses import dataclass
+import json
+from dataclasses import dataclass, fields
+from typing import List
+
+from config import settings
 
 @dataclass
 class EmailConfig:
@@ -10,4 +14,69 @@ class EmailConfig:
     smtp_port: int
     smtp_user: str
     smtp_password: str
-    smtp_use_ssl: bool
\ No newline at end of file
+    smtp_use_ssl: bool
+    imap_server: str = ""
+    imap_port: int = 993
+    imap_user: str = ""
+    imap_password: str = ""
+    imap_use_ssl: bool = True
+    mail_protocol: str = "imap"
+    pop_uidl_state_file: str = "pop_uidl_state.txt"
+    name: str = "default"
+
+    @classmethod
+    def from_settings(cls, **overrides) -> "EmailConfig":
+        """
+        Cuenta construida con las variables de entorno de config/settings.py;
+        los valores de `overrides` reemplazan a los de settings.
+        """
+        values = {
+            "pop_server": settings.POP_SERVER,
+            "pop_port": settings.POP_PORT,
+            "pop_user": settings.POP_USER,
+            "pop_password": settings.POP_PASSWORD,
+            "smtp_server": settings.SMTP_SERVER,
+            "smtp_port": settings.SMTP_PORT,
+            "smtp_user": settings.SMTP_USER,
+            "smtp_password": settings.SMTP_PASSWORD,
+            "smtp_use_ssl": settings.SMTP_USE_SSL,
+            "imap_server": settings.IMAP_SERVER,
+            "imap_port": settings.IMAP_PORT,
+            "imap_user": settings.IMAP_USER,
+            "imap_password": settings.IMAP_PASSWORD,
+            "imap_use_ssl": settings.IMAP_USE_SSL,
+            "mail_protocol": settings.MAIL_PROTOCOL,
+            "pop_uidl_state_file": settings.POP_UIDL_STATE_FILE,
+        }
+        values.update(overrides)
+        return cls(**values)
+
+
+def load_accounts(path: str) -> List[EmailConfig]:
+    """
+    Carga los perfiles de cuenta (buzón de entrada y salida) desde un archivo JSON con
+    una lista de objetos. Cada perfil usa los nombres de campo de EmailConfig y hereda
+    de settings los que no defina, por ejemplo para compartir la cuenta SMTP.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        profiles = json.load(f)
+    if not isinstance(profiles, list) or not profiles:
+        raise ValueError(f"{path} debe contener una lista de cuentas")
+
+    valid_fields = {f.name for f in fields(EmailConfig)}
+    accounts = []
+    for idx, profile in enumerate(profiles, 1):
+        unknown = set(profile) - valid_fields
+        if unknown:
+            raise ValueError(f"Cuenta #{idx} en {path} tiene campos desconocidos: {sorted(unknown)}")
+        profile = dict(profile)
+        name = profile.setdefault("name", profile.get("imap_user") or profile.get("pop_user") or f"cuenta{idx}")
+        # Cada cuenta POP3 necesita su propio estado de UIDL
+        profile.setdefault("pop_uidl_state_file", f"pop_uidl_state_{name}.txt")
+        profile["mail_protocol"] = str(profile.get("mail_protocol", settings.MAIL_PROTOCOL)).lower()
+        accounts.append(EmailConfig.from_settings(**profile))
+
+    names = [account.name for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Nombres de cuenta repetidos en {path}: {names}")
+    return accounts
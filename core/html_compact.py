@@ -0,0 +1,284 @@
+import re
+from html.parser import HTMLParser
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+# Sintaxis Jinja: se reemplaza por marcadores antes de analizar el HTML y se restaura al final
+_JINJA_RE = re.compile(r"\{\{.*?\}\}|\{%.*?%\}|\{#.*?#\}", re.S)
+_PLACEHOLDER_RE = re.compile(r"__J\d+__")
+_CSS_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+_WHITESPACE_RE = re.compile(r"\s+")
+_STYLE_ATTR_RE = re.compile(r"""\sstyle\s*=\s*("[^"]*"|'[^']*')""", re.I)
+_COMPOUND_RE = re.compile(r"^(\*|[a-zA-Z][\w-]*)?((?:[.#][\w-]+)*)$")
+
+_VOID_TAGS = frozenset({"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "wbr"})
+_INLINE_TAGS = frozenset({"a", "abbr", "b", "br", "code", "em", "font", "i", "img", "label", "small", "span",
+                          "strong", "sub", "sup", "u"})
+_RAW_TAGS = frozenset({"pre", "textarea", "script"})
+
+# (etiqueta o None, id o None, clases)
+Compound = Tuple[Optional[str], Optional[str], FrozenSet[str]]
+
+
+def _parse_compound(text: str) -> Optional[Compound]:
+    match = _COMPOUND_RE.match(text)
+    if not match or not text:
+        return None
+    tag = match.group(1)
+    parts = re.findall(r"[.#][\w-]+", match.group(2))
+    ids = [part[1:] for part in parts if part[0] == "#"]
+    if len(ids) > 1:
+        return None
+    return (None if tag in (None, "*") else tag.lower(), ids[0] if ids else None,
+            frozenset(part[1:] for part in parts if part[0] == "."))
+
+
+def _parse_selector(selector: str) -> Optional[List[Tuple[str, Compound]]]:
+    """
+    Selector de descendientes/hijos con selectores compuestos simples; None si usa
+    pseudo-clases, atributos u otros combinadores (esas reglas se dejan en <style>).
+    """
+    tokens = selector.replace(">", " > ").split()
+    parts, combinator = [], " "
+    for token in tokens:
+        if token == ">":
+            combinator = ">"
+            continue
+        compound = _parse_compound(token)
+        if compound is None:
+            return None
+        parts.append((combinator, compound))
+        combinator = " "
+    return parts or None
+
+
+def _specificity(parts: List[Tuple[str, Compound]]) -> Tuple[int, int, int]:
+    return (sum(1 for _, (_, id_, _) in parts if id_),
+            sum(len(classes) for _, (_, _, classes) in parts),
+            sum(1 for _, (tag, _, _) in parts if tag))
+
+
+def _compound_matches(compound: Compound, element: Compound) -> bool:
+    tag, id_, classes = compound
+    return ((tag is None or tag == element[0]) and (id_ is None or id_ == element[1])
+            and classes <= element[2])
+
+
+def _selector_matches(parts: List[Tuple[str, Compound]], stack: List[Compound]) -> bool:
+    if not stack or not _compound_matches(parts[-1][1], stack[-1]):
+        return False
+    position = len(stack) - 1
+    for index in range(len(parts) - 1, 0, -1):
+        combinator, compound = parts[index][0], parts[index - 1][1]
+        if combinator == ">":
+            position -= 1
+            if position < 0 or not _compound_matches(compound, stack[position]):
+                return False
+        else:
+            position -= 1
+            while position >= 0 and not _compound_matches(compound, stack[position]):
+                position -= 1
+            if position < 0:
+                return False
+    return True
+
+
+def _split_declarations(declarations: str) -> List[Tuple[str, str]]:
+    result = []
+    for declaration in declarations.split(";"):
+        name, _, value = declaration.partition(":")
+        if name.strip() and value.strip():
+            result.append((name.strip().lower(), _WHITESPACE_RE.sub(" ", value.strip())))
+    return result
+
+
+def _important(declarations: str) -> str:
+    """
+    Las reglas que quedan en <style> se marcan !important para no perder contra los estilos en línea.
+    """
+    return ";".join(f"{name}:{value}" if value.endswith("!important") else f"{name}:{value} !important"
+                    for name, value in _split_declarations(declarations))
+
+
+def _iter_css_blocks(css: str):
+    """
+    (prelude, cuerpo) de cada bloque de primer nivel de la hoja de estilos.
+    """
+    depth, start, prelude_start = 0, 0, 0
+    for position, char in enumerate(css):
+        if char == "{":
+            if depth == 0:
+                start = position
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                yield css[prelude_start:start].strip(), css[start + 1:position]
+                prelude_start = position + 1
+
+
+class _Compactor(HTMLParser):
+    def __init__(self, dynamic_classes: FrozenSet[str]):
+        super().__init__(convert_charrefs=False)
+        self.dynamic_classes = dynamic_classes
+        self.out: List[str] = []
+        self.stack: List[Compound] = []
+        self.open_tags: List[str] = []
+        # (especificidad, orden, selector, declaraciones) de las reglas que se aplican en línea
+        self.rules: List[Tuple[Tuple[int, int, int], int, List[Tuple[str, Compound]], List[Tuple[str, str]]]] = []
+        self.kept_css: List[str] = []
+        self.style_index: Optional[int] = None
+        self.last_inline = False
+
+    # --- hoja de estilos ---
+
+    def _add_stylesheet(self, css: str) -> None:
+        css = _CSS_COMMENT_RE.sub("", css)
+        for prelude, body in _iter_css_blocks(css):
+            prelude = _WHITESPACE_RE.sub(" ", prelude)
+            if prelude.startswith("@"):
+                inner = "".join(f"{_WHITESPACE_RE.sub(' ', sel).replace(', ', ',')}{{{_important(decls)}}}"
+                                for sel, decls in _iter_css_blocks(body))
+                self.kept_css.append(f"{prelude}{{{inner}}}")
+                continue
+            kept = []
+            for selector in (sel.strip() for sel in prelude.split(",")):
+                parts = _parse_selector(selector)
+                if parts is None or any(classes & self.dynamic_classes for _, (_, _, classes) in parts):
+                    kept.append(selector)
+                else:
+                    self.rules.append((_specificity(parts), len(self.rules), parts, _split_declarations(body)))
+            if kept:
+                self.kept_css.append(f"{','.join(kept)}{{{_important(body)}}}")
+
+    def _inline_style(self, original: Optional[str]) -> Optional[str]:
+        declarations: Dict[str, str] = {}
+        for _, _, parts, rule_declarations in sorted(self.rules, key=lambda rule: (rule[0], rule[1])):
+            if _selector_matches(parts, self.stack):
+                for name, value in rule_declarations:
+                    declarations.pop(name, None)
+                    declarations[name] = value
+        if not declarations:
+            return original
+        inlined = ";".join(f"{name}:{value}" for name, value in declarations.items())
+        if original and _PLACEHOLDER_RE.search(original):
+            # Estilo generado por Jinja: se agrega después para que siga teniendo prioridad
+            return f"{inlined};{original}"
+        for name, value in _split_declarations(original or ""):
+            declarations.pop(name, None)
+            declarations[name] = value
+        return ";".join(f"{name}:{value}" for name, value in declarations.items())
+
+    # --- HTMLParser ---
+
+    def handle_starttag(self, tag, attrs):
+        self._start(tag, attrs, self.get_starttag_text(), void=tag in _VOID_TAGS)
+
+    def handle_startendtag(self, tag, attrs):
+        self._start(tag, attrs, self.get_starttag_text(), void=True)
+
+    def _start(self, tag, attrs, text, void):
+        values = dict(attrs)
+        classes = frozenset((values.get("class") or "").split())
+        self.stack.append((tag, values.get("id"), classes))
+        if tag == "style":
+            self.style_index = len(self.out)
+        elif self.rules:
+            style = self._inline_style(values.get("style"))
+            if style != values.get("style"):
+                quoted = f'"{style}"' if '"' not in style else f"'{style}'"
+                if _STYLE_ATTR_RE.search(text):
+                    text = _STYLE_ATTR_RE.sub(lambda _: f" style={quoted}", text, count=1)
+                else:
+                    end = -2 if text.endswith("/>") else -1
+                    text = f"{text[:end].rstrip()} style={quoted}{text[end:]}"
+        self.out.append(text)
+        self.last_inline = tag in _INLINE_TAGS
+        if void:
+            self.stack.pop()
+        else:
+            self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in self.open_tags:
+            while self.open_tags:
+                self.stack.pop()
+                if self.open_tags.pop() == tag:
+                    break
+        if tag == "style":
+            self.out.append("</style>")
+            self.last_inline = False
+            return
+        self.out.append(f"</{tag}>")
+        self.last_inline = tag in _INLINE_TAGS
+
+    def handle_data(self, data):
+        if self.open_tags and self.open_tags[-1] == "style":
+            self._add_stylesheet(data)
+            return
+        if any(tag in _RAW_TAGS for tag in self.open_tags):
+            self.out.append(data)
+            return
+        collapsed = _WHITESPACE_RE.sub(" ", data)
+        if not collapsed.strip() and not self.last_inline:
+            return
+        self.out.append(collapsed)
+        self.last_inline = True
+
+    def handle_entityref(self, name):
+        self.out.append(f"&{name};")
+        self.last_inline = True
+
+    def handle_charref(self, name):
+        self.out.append(f"&#{name};")
+        self.last_inline = True
+
+    def handle_comment(self, data):
+        # Se conservan solo los comentarios condicionales de Outlook
+        if data.startswith("[if"):
+            self.out.append(f"<!--{data}-->")
+
+    def handle_decl(self, decl):
+        self.out.append(f"<!{decl}>")
+
+    def unknown_decl(self, data):
+        self.out.append(f"<![{data}]>")
+
+    def handle_pi(self, data):
+        self.out.append(f"<?{data}>")
+
+    def result(self) -> str:
+        out = self.out
+        if self.style_index is not None:
+            # <style> con solo las reglas que no se pudieron aplicar en línea (o nada si no queda ninguna)
+            closing = out.index("</style>", self.style_index)
+            out = out[:self.style_index] + ([f"<style>{''.join(self.kept_css)}</style>"] if self.kept_css else []) \
+                + out[closing + 1:]
+        return "".join(out)
+
+
+def compact_html(source: str) -> str:
+    """
+    Aplica en línea (atributo style) las reglas CSS de los bloques <style> y minifica el HTML:
+    quita comentarios y espacios redundantes. La sintaxis Jinja se conserva intacta; las reglas
+    que no se pueden resolver antes de renderizar (pseudo-clases, @media, clases generadas por
+    Jinja) quedan en <style> marcadas !important.
+    """
+    blocks: List[str] = []
+
+    def protect(match):
+        if match.group(0).startswith("{#"):
+            return ""
+        blocks.append(match.group(0))
+        return f"__J{len(blocks) - 1}__"
+
+    protected = _JINJA_RE.sub(protect, source)
+    dynamic_classes = set()
+    for value in re.findall(r"""class\s*=\s*(?:"([^"]*)"|'([^']*)')""", protected, re.I):
+        for token in "".join(value).split():
+            if _PLACEHOLDER_RE.search(token):
+                dynamic_classes.update(part for part in _PLACEHOLDER_RE.split(token) if part)
+
+    compactor = _Compactor(frozenset(dynamic_classes))
+    compactor.feed(protected)
+    compactor.close()
+    return _PLACEHOLDER_RE.sub(lambda match: blocks[int(match.group(0)[3:-2])], compactor.result())
@@ -5,10 +5,19 @@ from config import settings
 from datetime import datetime, timedelta
 
 LOG_DIR = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'log')
-os.makedirs(LOG_DIR, exist_ok=True)
 LOG_FILE = os.path.join(LOG_DIR, f"email_service.log")
 
-handler = TimedRotatingFileHandler(LOG_FILE, when="midnight", interval=1, backupCount=0, encoding="utf-8")
+
+class _LazyTimedRotatingFileHandler(TimedRotatingFileHandler):
+    """
+    Crea la carpeta de logs y abre el archivo recién con el primer registro escrito.
+    """
+    def _open(self):
+        os.makedirs(os.path.dirname(self.baseFilename), exist_ok=True)
+        return super()._open()
+
+
+handler = _LazyTimedRotatingFileHandler(LOG_FILE, when="midnight", interval=1, backupCount=0, encoding="utf-8", delay=True)
 handler.suffix = "%Y-%m-%d"
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
@@ -18,10 +27,12 @@ logger.setLevel(getattr(logging, settings.LOG_LEVEL.upper(), logging.INFO))
 logger.addHandler(handler)
 logger.addHandler(logging.StreamHandler())
 
-# Eliminar logs antiguos según RETENTION_LOG
+# Eliminar logs antiguos según RETENTION_LOG (se invoca al iniciar el servicio, no al importar)
 def cleanup_old_logs():
     retention_days = int(getattr(settings, 'RETENTION_LOG', 7))
     now = datetime.now()
+    if not os.path.isdir(LOG_DIR):
+        return
     for fname in os.listdir(LOG_DIR):
         if fname.startswith("email_service.log."):
             try:
@@ -32,5 +43,3 @@ def cleanup_old_logs():
                     logger.info(f"Log antiguo eliminado: {fname}")
             except Exception:
                 pass
-
-cleanup_old_logs()
\ No newline at end of file
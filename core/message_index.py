@@ -0,0 +1,245 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from email.header import decode_header, make_header
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from config import settings
+from core.logger import logger
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    account TEXT NOT NULL,
+    mailbox TEXT,
+    uid TEXT,
+    message_id TEXT,
+    sender TEXT NOT NULL DEFAULT '',
+    subject TEXT NOT NULL DEFAULT '',
+    date TEXT NOT NULL DEFAULT '',
+    flags TEXT NOT NULL DEFAULT '',
+    attachments TEXT NOT NULL DEFAULT '',
+    claves TEXT NOT NULL DEFAULT '',
+    status TEXT NOT NULL DEFAULT 'pendiente',
+    error TEXT,
+    first_seen TEXT NOT NULL,
+    processed_at TEXT,
+    UNIQUE (account, mailbox, uid)
+);
+CREATE INDEX IF NOT EXISTS messages_message_id ON messages (account, message_id);
+CREATE TABLE IF NOT EXISTS sync_state (
+    account TEXT NOT NULL,
+    mailbox TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    highestmodseq INTEGER NOT NULL DEFAULT 0,
+    last_uid INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (account, mailbox)
+);
+"""
+
+# Índice de texto (trigramas): acelera los LIKE '%texto%' sobre remitente, asunto, adjuntos y claves
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    sender, subject, attachments, claves, content='messages', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, sender, subject, attachments, claves)
+    VALUES (new.id, new.sender, new.subject, new.attachments, new.claves);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, sender, subject, attachments, claves)
+    VALUES ('delete', old.id, old.sender, old.subject, old.attachments, old.claves);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF sender, subject, attachments, claves ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, sender, subject, attachments, claves)
+    VALUES ('delete', old.id, old.sender, old.subject, old.attachments, old.claves);
+    INSERT INTO messages_fts (rowid, sender, subject, attachments, claves)
+    VALUES (new.id, new.sender, new.subject, new.attachments, new.claves);
+END;
+"""
+
+_COLUMNS = ("id", "account", "mailbox", "uid", "message_id", "sender", "subject", "date", "flags",
+            "attachments", "claves", "status", "error", "first_seen", "processed_at")
+
+
+def decode_header_value(value: Optional[str]) -> str:
+    """
+    Decodifica un encabezado RFC 2047 (=?utf-8?...?=) a texto; si no se puede, lo deja tal cual.
+    """
+    if not value:
+        return ""
+    try:
+        return str(make_header(decode_header(str(value))))
+    except Exception:
+        return str(value)
+
+
+class MessageIndex:
+    """
+    Índice local (SQLite) de los mensajes vistos por el servicio: UID, Message-ID, remitente,
+    asunto, fecha, adjuntos, claves de acceso y resultado de la entrega. Lo mantiene el
+    fetcher en cada revisión del buzón y permite responder los modos monitor y audit
+    sin consultar el servidor de correo.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # Una conexión compartida por los hilos del proceso; WAL + busy_timeout para varias réplicas
+        self._conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        try:
+            self._conn.executescript(_FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError as e:
+            # SQLite sin FTS5 o sin el tokenizador trigram: se busca con LIKE sobre la tabla
+            logger.warning(f"Índice de mensajes sin FTS5 ({e}), las búsquedas recorrerán la tabla")
+            self.fts = False
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+    def upsert_headers(self, account: str, mailbox: str, uid: str, message_id: Optional[str],
+                       sender: str, subject: str, date: str, flags: str = "") -> None:
+        """
+        Registra (o actualiza) los encabezados de un mensaje del buzón.
+        """
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO messages (account, mailbox, uid, message_id, sender, subject, date, flags, first_seen) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (account, mailbox, uid) DO UPDATE SET message_id = excluded.message_id, "
+                "sender = excluded.sender, subject = excluded.subject, date = excluded.date, flags = excluded.flags",
+                (account, mailbox, str(uid), message_id or None, decode_header_value(sender),
+                 decode_header_value(subject), date or "", flags, _now())
+            )
+
+    def update_flags(self, account: str, mailbox: str, changes: Iterable[Tuple[str, str]]) -> None:
+        """
+        Actualiza las flags de los mensajes ya indexados: (uid, flags).
+        """
+        # Con la conexión como contexto, un error hace ROLLBACK y la conexión no queda dentro de la transacción
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "UPDATE messages SET flags = ? WHERE account = ? AND mailbox = ? AND uid = ?",
+                ((flags, account, mailbox, str(uid)) for uid, flags in changes)
+            )
+
+    def relocate(self, account: str, mailbox: str, destination: str, moves: Iterable[Tuple[str, Optional[str]]]) -> None:
+        """
+        Registra que los mensajes se movieron a otra carpeta: (uid anterior, uid nuevo o None si
+        el servidor no lo informó).
+        """
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN")
+            self._conn.executemany(
+                "UPDATE OR IGNORE messages SET mailbox = ?, uid = ? WHERE account = ? AND mailbox = ? AND uid = ?",
+                ((destination, new_uid, account, mailbox, str(uid)) for uid, new_uid in moves)
+            )
+
+    def record_result(self, account: str, message_id: Optional[str], sender: str, subject: str, date: str,
+                      attachments: List[str], claves: List[str], status: str, error: Optional[str] = None) -> None:
+        """
+        Registra el resultado del procesamiento de un mensaje, buscándolo por Message-ID.
+        Si el mensaje no estaba indexado (POP3, replay, sin Message-ID) se agrega sin UID.
+        """
+        values = (" ".join(attachments), " ".join(clave for clave in claves if clave), status, error, _now())
+        with self._lock:
+            updated = 0
+            if message_id:
+                updated = self._conn.execute(
+                    "UPDATE messages SET attachments = ?, claves = ?, status = ?, error = ?, processed_at = ? "
+                    "WHERE account = ? AND message_id = ?",
+                    values + (account, message_id)
+                ).rowcount
+            if not updated:
+                self._conn.execute(
+                    "INSERT INTO messages (account, message_id, sender, subject, date, attachments, claves, "
+                    "status, error, processed_at, first_seen) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (account, message_id or None, decode_header_value(sender), decode_header_value(subject),
+                     date or "") + values + (_now(),)
+                )
+
+    def search(self, sender: Optional[str] = None, subject: Optional[str] = None, text: Optional[str] = None,
+               clave: Optional[str] = None, account: Optional[str] = None, limit: int = 20) -> List[Dict[str, object]]:
+        """
+        Busca mensajes por subcadena (sin distinguir mayúsculas) en remitente, asunto, texto
+        libre (remitente, asunto, adjuntos o claves) y clave de acceso. Los más recientes primero.
+        """
+        source = "messages_fts f JOIN messages m ON m.id = f.rowid" if self.fts else "messages m"
+        prefix = "f." if self.fts else "m."
+        conditions, params = [], []
+        for column, value in (("sender", sender), ("subject", subject), ("claves", clave)):
+            if value:
+                conditions.append(f"{prefix}{column} LIKE ?")
+                params.append(f"%{value}%")
+        if text:
+            conditions.append("(" + " OR ".join(f"{prefix}{column} LIKE ?"
+                                                for column in ("sender", "subject", "attachments", "claves")) + ")")
+            params.extend([f"%{text}%"] * 4)
+        if account:
+            conditions.append("m.account = ?")
+            params.append(account)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        query = (f"SELECT {', '.join('m.' + column for column in _COLUMNS)} FROM {source} {where} "
+                 f"ORDER BY m.id DESC LIMIT ?")
+        with self._lock:
+            rows = self._conn.execute(query, params + [int(limit)]).fetchall()
+        return [dict(zip(_COLUMNS, row)) for row in rows]
+
+    def get_sync_state(self, account: str, mailbox: str) -> Tuple[int, int, int]:
+        """
+        (UIDVALIDITY, HIGHESTMODSEQ, último UID indexado) del buzón; ceros si nunca se sincronizó.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT uidvalidity, highestmodseq, last_uid FROM sync_state WHERE account = ? AND mailbox = ?",
+                (account, mailbox)
+            ).fetchone()
+        return tuple(row) if row else (0, 0, 0)
+
+    def set_sync_state(self, account: str, mailbox: str, uidvalidity: int, highestmodseq: int, last_uid: int) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO sync_state (account, mailbox, uidvalidity, highestmodseq, last_uid) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (account, mailbox) DO UPDATE SET uidvalidity = excluded.uidvalidity, "
+                "highestmodseq = excluded.highestmodseq, last_uid = excluded.last_uid",
+                (account, mailbox, uidvalidity, highestmodseq, last_uid)
+            )
+
+    def reset_mailbox(self, account: str, mailbox: str) -> None:
+        """
+        Olvida los UID de un buzón (cambió su UIDVALIDITY): los mensajes quedan indexados sin UID.
+        """
+        with self._lock:
+            self._conn.execute("UPDATE messages SET uid = NULL WHERE account = ? AND mailbox = ?", (account, mailbox))
+            self._conn.execute("DELETE FROM sync_state WHERE account = ? AND mailbox = ?", (account, mailbox))
+
+
+def _now() -> str:
+    return datetime.now().isoformat(timespec="seconds")
+
+
+_index: Optional[MessageIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_message_index() -> Optional[MessageIndex]:
+    """
+    Índice compartido por todas las cuentas y hilos del proceso (None si MESSAGE_INDEX_FILE está vacío).
+    """
+    global _index
+    if not settings.MESSAGE_INDEX_FILE:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = MessageIndex(settings.MESSAGE_INDEX_FILE)
+        return _index
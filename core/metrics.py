@@ -0,0 +1,61 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple
+
+
+class StageTimings:
+    """
+    Tiempos acumulados por etapa del pipeline (descarga, adjuntos, XML, PDF, SMTP...)
+    y etapa en curso de cada hilo, para diagnosticar un servicio lento sin reiniciarlo.
+    """
+
+    def __init__(self):
+        self._stats: Dict[str, List[float]] = {}
+        self._current: Dict[int, Tuple[str, float]] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        thread_id = threading.get_ident()
+        previous = self._current.get(thread_id)
+        started = time.perf_counter()
+        self._current[thread_id] = (name, started)
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if previous is None:
+                self._current.pop(thread_id, None)
+            else:
+                self._current[thread_id] = previous
+            with self._lock:
+                stats = self._stats.get(name)
+                if stats is None:
+                    self._stats[name] = [1, elapsed, elapsed]
+                else:
+                    stats[0] += 1
+                    stats[1] += elapsed
+                    stats[2] = max(stats[2], elapsed)
+
+    def snapshot(self) -> Dict[str, dict]:
+        """
+        Estadísticas por etapa: cantidad, total, promedio y máximo (segundos).
+        """
+        with self._lock:
+            return {
+                name: {"count": count, "total": round(total, 3),
+                       "avg": round(total / count, 4), "max": round(maximum, 3)}
+                for name, (count, total, maximum) in self._stats.items()
+            }
+
+    def in_progress(self) -> Dict[int, Tuple[str, float]]:
+        """
+        Etapa en curso por hilo y segundos que lleva en ella.
+        """
+        now = time.perf_counter()
+        return {thread_id: (name, now - started) for thread_id, (name, started) in list(self._current.items())}
+
+
+# Instancia compartida por todo el proceso
+stage_timings = StageTimings()
@@ -0,0 +1,133 @@
+import base64
+import re
+import smtplib
+import uuid
+from email.policy import SMTP as SMTP_POLICY
+from email.utils import formatdate, getaddresses, make_msgid, quote
+from typing import BinaryIO, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+from core.attachment import Attachment, as_buffer
+
+# 57 bytes de entrada = una línea base64 de 76 caracteres; se codifican 1024 líneas por bloque
+_B64_LINE = 57
+_B64_BLOCK = _B64_LINE * 1024
+_DOT_RE = re.compile(rb"(?m)^\.")
+
+AttachmentItem = Union[Attachment, Tuple[str, bytes]]
+
+
+def _header(name: str, value: str) -> bytes:
+    """
+    Encabezado plegado a 78 columnas con CRLF, codificado (RFC 2047/2231) si no es ASCII.
+    """
+    return SMTP_POLICY.header_factory(name, value).fold(policy=SMTP_POLICY).encode("ascii")
+
+
+def _attachment_disposition(filename: str) -> bytes:
+    """
+    Content-Disposition de un adjunto: comillas y barras del nombre escapadas; la policy
+    SMTP lo pasa a RFC 2231 (filename*=utf-8'') si no es ASCII.
+    """
+    return _header("Content-Disposition", f'attachment; filename="{quote(filename)}"')
+
+
+def _base64_lines(content) -> Iterator[bytes]:
+    """
+    Codifica en base64 por bloques: líneas de 76 caracteres terminadas en CRLF, sin copiar el contenido completo.
+    """
+    view = memoryview(as_buffer(content))
+    for start in range(0, len(view), _B64_BLOCK):
+        yield base64.encodebytes(view[start:start + _B64_BLOCK]).replace(b"\n", b"\r\n")
+
+
+class OutboundMessage:
+    """
+    Email de salida (HTML + adjuntos) que se serializa por partes: los encabezados y cada
+    adjunto codificado en base64 se generan por bloques directamente hacia el socket SMTP
+    o el archivo de dry-run, sin armar el mensaje completo en memoria.
+    """
+
+    def __init__(self, sender: str, to: str, subject: str, html_content: str,
+                 cc: Optional[str] = None, attachments: Sequence[AttachmentItem] = ()):
+        self.sender = sender
+        self.to = to
+        self.cc = cc
+        self.subject = subject
+        self.html_content = html_content
+        self.attachments = list(attachments)
+        self.boundary = f"==============={uuid.uuid4().hex}=="
+
+    def recipients(self) -> List[str]:
+        return [address for _, address in getaddresses([self.to] + ([self.cc] if self.cc else [])) if address]
+
+    def chunks(self) -> Iterator[bytes]:
+        """
+        El mensaje en bloques de líneas completas terminadas en CRLF.
+        """
+        headers = [
+            _header("Content-Type", f'multipart/alternative; boundary="{self.boundary}"'),
+            b"MIME-Version: 1.0\r\n",
+            _header("From", self.sender),
+            _header("To", self.to),
+            _header("Subject", self.subject),
+            _header("Date", formatdate(localtime=True)),
+            _header("Message-ID", make_msgid()),
+        ]
+        if self.cc:
+            headers.insert(4, _header("Cc", self.cc))
+        yield b"".join(headers) + b"\r\n"
+
+        delimiter = f"--{self.boundary}\r\n".encode("ascii")
+        yield (delimiter + b'Content-Type: text/html; charset="utf-8"\r\nMIME-Version: 1.0\r\n'
+               b"Content-Transfer-Encoding: base64\r\n\r\n")
+        yield from _base64_lines(self.html_content.encode("utf-8"))
+
+        for item in self.attachments:
+            if isinstance(item, Attachment):
+                filename, content = item.filename, item.view()
+            else:
+                filename, content = item
+            yield (delimiter + b"Content-Type: application/octet-stream\r\nMIME-Version: 1.0\r\n"
+                   b"Content-Transfer-Encoding: base64\r\n"
+                   + _attachment_disposition(filename) + b"\r\n")
+            yield from _base64_lines(content)
+        yield f"--{self.boundary}--\r\n".encode("ascii")
+
+    def write_to(self, stream: BinaryIO) -> None:
+        for chunk in self.chunks():
+            stream.write(chunk)
+
+    def send(self, server: smtplib.SMTP) -> Dict[str, Tuple[int, bytes]]:
+        """
+        MAIL FROM / RCPT TO / DATA escribiendo el mensaje por bloques en el socket, con
+        dot-stuffing. Como SMTP.sendmail, lanza las excepciones de smtplib y retorna los
+        destinatarios rechazados cuando el mensaje se entregó a los demás.
+        """
+        server.ehlo_or_helo_if_needed()
+        code, response = server.mail(self.sender)
+        if code != 250:
+            server._rset()
+            raise smtplib.SMTPSenderRefused(code, response, self.sender)
+        refused = {}
+        for recipient in self.recipients():
+            code, response = server.rcpt(recipient)
+            if code not in (250, 251):
+                refused[recipient] = (code, response)
+        if refused and len(refused) == len(self.recipients()):
+            server._rset()
+            raise smtplib.SMTPRecipientsRefused(refused)
+
+        server.putcmd("data")
+        code, response = server.getreply()
+        if code != 354:
+            server._rset()
+            raise smtplib.SMTPDataError(code, response)
+        for chunk in self.chunks():
+            # Cada bloque empieza en un inicio de línea: basta con duplicar los puntos iniciales
+            server.send(_DOT_RE.sub(b"..", chunk))
+        server.send(b".\r\n")
+        code, response = server.getreply()
+        if code != 250:
+            server._rset()
+            raise smtplib.SMTPDataError(code, response)
+        return refused
@@ -1,62 +1,286 @@
+"""
+Generador del RIDE (Representación Impresa del Documento Electrónico) del SRI.
+
+Los estilos de párrafo y de tabla se construyen una sola vez por proceso; cada RIDE
+se arma directamente desde el árbol XML ya parseado (o los bytes del XML).
+"""
+
+import os
 import xml.etree.ElementTree as ET
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from io import BytesIO
+from types import SimpleNamespace
+from typing import Iterable, List, Optional, Union
+from xml.sax.saxutils import escape
+
+from reportlab.graphics.barcode import code128
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_RIGHT
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.units import cm
+from reportlab.platypus import LongTable, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+from core.attachment import Attachment, as_buffer
+from core.xml_data import TIPOS_DOCUMENTO, XMLData
+
+# Porcentajes de IVA según codigoPorcentaje del SRI
+TARIFAS_IVA = {
+    "0": "0%",
+    "2": "12%",
+    "3": "14%",
+    "4": "15%",
+    "5": "5%",
+    "6": "No Objeto de Impuesto",
+    "7": "Exento de IVA",
+    "8": "IVA diferenciado",
+    "10": "13%",
+}
+
+AMBIENTES = {"1": "PRUEBAS", "2": "PRODUCCIÓN"}
+
+# Descripciones más cortas que esto se dibujan como texto plano (sin Paragraph, mucho más rápido)
+_PLAIN_DESCRIPTION_CHARS = 45
+
+_DETAIL_WIDTHS = [2.6 * cm, 1.6 * cm, 7.2 * cm, 2.2 * cm, 1.9 * cm, 2.5 * cm]
+
+
+@lru_cache(maxsize=None)
+def _styles() -> SimpleNamespace:
+    """
+    Estilos de párrafo y de tabla del RIDE, creados una vez por proceso.
+    """
+    base = getSampleStyleSheet()["Normal"]
+    small = ParagraphStyle("ride_small", parent=base, fontSize=7.5, leading=9)
+    return SimpleNamespace(
+        title=ParagraphStyle("ride_title", parent=base, fontName="Helvetica-Bold", fontSize=11, leading=13),
+        normal=ParagraphStyle("ride_normal", parent=base, fontSize=8.5, leading=10.5),
+        small=small,
+        small_right=ParagraphStyle("ride_small_right", parent=small, alignment=TA_RIGHT),
+        box=TableStyle([
+            ("BOX", (0, 0), (-1, -1), 0.75, colors.black),
+            ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ("LEFTPADDING", (0, 0), (-1, -1), 6),
+            ("RIGHTPADDING", (0, 0), (-1, -1), 6),
+        ]),
+        header=TableStyle([
+            ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ("LEFTPADDING", (0, 0), (-1, -1), 0),
+            ("RIGHTPADDING", (1, 0), (1, 0), 0),
+        ]),
+        detail=TableStyle([
+            ("FONT", (0, 0), (-1, 0), "Helvetica-Bold", 7.5),
+            ("FONT", (0, 1), (-1, -1), "Helvetica", 7.5),
+            ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#e8e8e8")),
+            ("GRID", (0, 0), (-1, -1), 0.4, colors.black),
+            ("VALIGN", (0, 0), (-1, -1), "MIDDLE"),
+            ("ALIGN", (1, 1), (1, -1), "RIGHT"),
+            ("ALIGN", (3, 1), (-1, -1), "RIGHT"),
+            ("TOPPADDING", (0, 0), (-1, -1), 2),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 2),
+        ]),
+        totals=TableStyle([
+            ("FONT", (0, 0), (-1, -1), "Helvetica", 7.5),
+            ("FONT", (0, -1), (-1, -1), "Helvetica-Bold", 8),
+            ("GRID", (0, 0), (-1, -1), 0.4, colors.black),
+            ("ALIGN", (1, 0), (1, -1), "RIGHT"),
+            ("TOPPADDING", (0, 0), (-1, -1), 2),
+            ("BOTTOMPADDING", (0, 0), (-1, -1), 2),
+        ]),
+        bottom=TableStyle([
+            ("VALIGN", (0, 0), (-1, -1), "TOP"),
+            ("LEFTPADDING", (0, 0), (-1, -1), 0),
+            ("RIGHTPADDING", (0, 0), (-1, -1), 0),
+        ]),
+    )
+
+
+def _comprobante_root(xml: Union[bytes, memoryview, Attachment, ET.Element]) -> ET.Element:
+    """
+    Raíz del comprobante; si es un XML de autorización se toma el comprobante del CDATA.
+    """
+    root = xml if isinstance(xml, ET.Element) else ET.fromstring(bytes(as_buffer(xml)))
+    if root.tag == "autorizacion":
+        comprobante = root.findtext("comprobante")
+        if comprobante:
+            inner = ET.fromstring(comprobante.strip().encode("utf-8"))
+            # Conservar los datos de autorización, que están fuera del CDATA
+            for tag in ("numeroAutorizacion", "fechaAutorizacion"):
+                value = root.findtext(tag)
+                if value and inner.find(tag) is None:
+                    ET.SubElement(inner, tag).text = value
+            return inner
+    return root
+
+
+def _info_element(root: ET.Element) -> ET.Element:
+    """
+    Bloque de datos del comprobante (infoFactura, infoNotaCredito, infoCompRetencion...).
+    """
+    for child in root:
+        if child.tag.startswith("info") and child.tag not in ("infoTributaria", "infoAdicional"):
+            return child
+    return ET.Element("info")
+
+
+def _text(element: Optional[ET.Element], path: str, default: str = "") -> str:
+    if element is None:
+        return default
+    value = element.findtext(path)
+    return value.strip() if value else default
+
+
+def _paragraph(text: str, style) -> Paragraph:
+    return Paragraph(escape(text), style)
 
-def generar_pdf(xml_file, pdf_file=None):
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
-
-    # estilos
-    styles = getSampleStyleSheet()
-    elementos = []
-
-    # ejemplo: obtener RUC y datos principales
-    ruc_emisor = root.findtext(".//RucEmisor")  # ajustar según estructura real
-    razon_social = root.findtext(".//RazonSocial")
-    cliente = root.findtext(".//RazonSocialComprador")
-
-    elementos.append(Paragraph(f"<b>RUC:</b> {ruc_emisor}", styles['Normal']))
-    elementos.append(Paragraph(f"<b>FACTURA:</b> {razon_social}", styles['Normal']))
-    elementos.append(Paragraph(f"<b>CLIENTE:</b> {cliente}", styles['Normal']))
-    elementos.append(Spacer(1, 12))
-
-    # ejemplo tabla productos
-    data = [["Código", "Descripción", "Cant.", "P.Unit", "Desc.", "Total"]]
-    for det in root.findall(".//detalle"):
-        codigo = det.findtext("codigoPrincipal")
-        desc = det.findtext("descripcion")
-        cant = det.findtext("cantidad")
-        precio = det.findtext("precioUnitario")
-        descu = det.findtext("descuento")
-        total = det.findtext("precioTotalSinImpuesto")
-        data.append([codigo, desc, cant, precio, descu, total])
-
-    tabla = Table(data, repeatRows=1)
-    tabla.setStyle(TableStyle([
-        ("BACKGROUND", (0,0), (-1,0), colors.grey),
-        ("TEXTCOLOR", (0,0), (-1,0), colors.whitesmoke),
-        ("ALIGN", (0,0), (-1,-1), "CENTER"),
-        ("GRID", (0,0), (-1,-1), 0.5, colors.black)
-    ]))
-    elementos.append(tabla)
-
-    # ejemplo totales
-    total_con_impuestos = root.findtext(".//importeTotal")
-    elementos.append(Spacer(1, 12))
-    elementos.append(Paragraph(f"<b>Total:</b> {total_con_impuestos}", styles['Normal']))
+
+def _header(root: ET.Element, info: ET.Element, xml_data: Optional[XMLData], styles) -> Table:
+    tributaria = root.find("infoTributaria")
+    codigo = _text(tributaria, "codDoc")
+    clave = _text(tributaria, "claveAcceso")
+    numero = "-".join(filter(None, (_text(tributaria, "estab"), _text(tributaria, "ptoEmi"), _text(tributaria, "secuencial"))))
+    autorizacion = _text(root, "numeroAutorizacion") or (xml_data.numero_autorizacion if xml_data else "") or clave
+    fecha_autorizacion = _text(root, "fechaAutorizacion") or (xml_data.fecha_autorizacion if xml_data else "")
+
+    emisor = [
+        _paragraph(_text(tributaria, "razonSocial"), styles.title),
+        _paragraph(_text(tributaria, "nombreComercial"), styles.normal),
+        Spacer(1, 6),
+        _paragraph(f"Dirección Matriz: {_text(tributaria, 'dirMatriz')}", styles.small),
+        _paragraph(f"Dirección Sucursal: {_text(info, 'dirEstablecimiento')}", styles.small),
+        _paragraph(f"Obligado a llevar contabilidad: {_text(info, 'obligadoContabilidad', 'NO')}", styles.small),
+    ]
+    contribuyente = _text(info, "contribuyenteEspecial")
+    if contribuyente:
+        emisor.append(_paragraph(f"Contribuyente Especial Nro: {contribuyente}", styles.small))
+
+    documento = [
+        _paragraph(f"R.U.C.: {_text(tributaria, 'ruc')}", styles.title),
+        _paragraph(f"{TIPOS_DOCUMENTO.get(codigo, 'Comprobante').upper()} No. {numero}", styles.title),
+        _paragraph("NÚMERO DE AUTORIZACIÓN", styles.small),
+        _paragraph(autorizacion, styles.small),
+        _paragraph(f"FECHA Y HORA DE AUTORIZACIÓN: {fecha_autorizacion}", styles.small),
+        _paragraph(f"AMBIENTE: {AMBIENTES.get(_text(tributaria, 'ambiente'), '')}", styles.small),
+        _paragraph(f"EMISIÓN: {'NORMAL' if _text(tributaria, 'tipoEmision', '1') == '1' else 'INDISPONIBILIDAD'}", styles.small),
+        _paragraph("CLAVE DE ACCESO", styles.small),
+    ]
+    if clave:
+        documento.append(code128.Code128(clave, barHeight=1.1 * cm, barWidth=0.5, humanReadable=True, fontSize=6))
+
+    header = Table([[Table([[emisor]], colWidths=[8.6 * cm], style=styles.box),
+                     Table([[documento]], colWidths=[9.2 * cm], style=styles.box)]],
+                   colWidths=[9.0 * cm, 9.2 * cm], style=styles.header)
+    return header
+
+
+def _buyer(info: ET.Element, styles) -> Table:
+    razon = _text(info, "razonSocialComprador") or _text(info, "razonSocialSujetoRetenido") or _text(info, "razonSocialDestinatario")
+    identificacion = (_text(info, "identificacionComprador") or _text(info, "identificacionSujetoRetenido")
+                      or _text(info, "identificacionDestinatario"))
+    rows = [
+        [_paragraph(f"Razón Social / Nombres y Apellidos: {razon}", styles.small),
+         _paragraph(f"Identificación: {identificacion}", styles.small)],
+        [_paragraph(f"Fecha Emisión: {_text(info, 'fechaEmision')}", styles.small),
+         _paragraph(f"Dirección: {_text(info, 'direccionComprador')}", styles.small)],
+    ]
+    return Table(rows, colWidths=[11.0 * cm, 7.2 * cm], style=styles.box)
+
+
+def _details(root: ET.Element, styles) -> Optional[LongTable]:
+    rows = [["Cod. Principal", "Cant.", "Descripción", "P. Unitario", "Descuento", "Precio Total"]]
+    for detalle in root.iterfind("detalles/detalle"):
+        descripcion = _text(detalle, "descripcion")
+        rows.append([
+            _text(detalle, "codigoPrincipal") or _text(detalle, "codigoInterno"),
+            _text(detalle, "cantidad"),
+            descripcion if len(descripcion) <= _PLAIN_DESCRIPTION_CHARS else _paragraph(descripcion, styles.small),
+            _text(detalle, "precioUnitario"),
+            _text(detalle, "descuento", "0.00"),
+            _text(detalle, "precioTotalSinImpuesto"),
+        ])
+    if len(rows) == 1:
+        return None
+    # LongTable calcula el layout por filas y rinde mejor con cientos de líneas
+    return LongTable(rows, colWidths=_DETAIL_WIDTHS, repeatRows=1, style=styles.detail)
+
+
+def _totals(info: ET.Element, styles) -> Table:
+    rows = []
+    iva = []
+    for impuesto in info.iterfind("totalConImpuestos/totalImpuesto"):
+        tarifa = TARIFAS_IVA.get(_text(impuesto, "codigoPorcentaje"), _text(impuesto, "codigoPorcentaje"))
+        rows.append([f"SUBTOTAL {tarifa}", _text(impuesto, "baseImponible", "0.00")])
+        if _text(impuesto, "codigo") == "2" and _text(impuesto, "valor", "0.00") not in ("0", "0.00"):
+            iva.append([f"IVA {tarifa}", _text(impuesto, "valor")])
+    rows.append(["SUBTOTAL SIN IMPUESTOS", _text(info, "totalSinImpuestos", "0.00")])
+    rows.append(["TOTAL DESCUENTO", _text(info, "totalDescuento", "0.00")])
+    rows.extend(iva)
+    propina = _text(info, "propina")
+    if propina:
+        rows.append(["PROPINA", propina])
+    rows.append(["VALOR TOTAL", _text(info, "importeTotal") or _text(info, "valorModificacion", "0.00")])
+    return Table(rows, colWidths=[4.4 * cm, 2.4 * cm], style=styles.totals)
+
+
+def _additional_info(root: ET.Element, styles) -> Table:
+    campos = [_paragraph("Información Adicional", styles.normal)]
+    for campo in root.iterfind("infoAdicional/campoAdicional"):
+        campos.append(_paragraph(f"{campo.get('nombre', '')}: {(campo.text or '').strip()}", styles.small))
+    return Table([[campos]], colWidths=[10.8 * cm], style=styles.box)
+
+
+def generar_ride(xml: Union[bytes, memoryview, Attachment, ET.Element], xml_data: Optional[XMLData] = None) -> bytes:
+    """
+    Genera el PDF del RIDE a partir del XML del comprobante (bytes, Attachment o árbol ya parseado).
+    `xml_data` completa los datos de autorización cuando el XML no los trae.
+    """
+    styles = _styles()
+    root = _comprobante_root(xml)
+    info = _info_element(root)
+
+    elementos = [_header(root, info, xml_data, styles), Spacer(1, 8), _buyer(info, styles), Spacer(1, 8)]
+    detalles = _details(root, styles)
+    if detalles is not None:
+        elementos.extend([detalles, Spacer(1, 8)])
+    elementos.append(Table([[_additional_info(root, styles), _totals(info, styles)]],
+                           colWidths=[11.4 * cm, 6.8 * cm], style=styles.bottom))
 
     buffer = BytesIO()
-    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    doc = SimpleDocTemplate(buffer, pagesize=A4, leftMargin=1.4 * cm, rightMargin=1.4 * cm,
+                            topMargin=1.2 * cm, bottomMargin=1.2 * cm,
+                            title=f"RIDE {_text(root, 'infoTributaria/claveAcceso')}")
     doc.build(elementos)
-    pdf_bytes = buffer.getvalue()
-    buffer.close()
+    return buffer.getvalue()
+
+
+def _ride_worker(xml: bytes) -> bytes:
+    return generar_ride(xml)
+
+
+def generar_rides(xml_documents: Iterable[bytes], workers: Optional[int] = None) -> List[bytes]:
+    """
+    Genera los RIDE de muchos comprobantes repartiéndolos en un pool de procesos.
+    Retorna los PDFs en el mismo orden de entrada.
+    """
+    documents = [bytes(as_buffer(xml)) for xml in xml_documents]
+    workers = max(1, workers or os.cpu_count() or 1)
+    if workers == 1 or len(documents) <= 1:
+        return [generar_ride(xml) for xml in documents]
+    chunksize = max(1, len(documents) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=_styles) as executor:
+        return list(executor.map(_ride_worker, documents, chunksize=chunksize))
+
+
+def generar_pdf(xml_file, pdf_file=None):
+    """
+    Compatibilidad: genera el RIDE de un archivo XML y opcionalmente lo guarda en `pdf_file`.
+    """
+    with open(xml_file, 'rb') as f:
+        pdf_bytes = generar_ride(f.read())
 
     if pdf_file:
         with open(pdf_file, 'wb') as f:
             f.write(pdf_bytes)
 
     return pdf_bytes
-
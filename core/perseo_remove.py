@@ -7,10 +7,12 @@ Detecta y elimina el logo independientemente del número de páginas
 import fitz  # PyMuPDF
 import os
 import sys
-from typing import List, Tuple, Optional
+from typing import List, Tuple, Optional, Union
 import re
 import io
 
+from core.attachment import Attachment, as_buffer
+
 class PerseoLogoRemover:
     def __init__(self):
         # Patrones de texto que pueden indicar la presencia del logo PERSEO
@@ -230,22 +232,31 @@ class PerseoLogoRemover:
         return total_stats
 
 
-def limpiar_perseo_pdf_bytes(pdf_bytes: bytes) -> bytes:
+def limpiar_perseo_pdf_bytes(pdf_bytes: Union[bytes, Attachment]) -> bytes:
     """
-    Recibe un PDF en bytes, elimina el logo PERSEO en cada página y retorna el PDF limpio en bytes.
+    Recibe un PDF en bytes (o Attachment), elimina el logo PERSEO en cada página y retorna el PDF limpio en bytes.
     """
     remover = PerseoLogoRemover()
-    input_stream = io.BytesIO(pdf_bytes)
-    doc = fitz.open(stream=input_stream, filetype='pdf')
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        perseo_elements = remover.detect_perseo_elements(page)
-        if perseo_elements:
-            remover.remove_perseo_elements(page, perseo_elements)
-    output_stream = io.BytesIO()
-    doc.save(output_stream)
-    doc.close()
-    return output_stream.getvalue()
+    # PyMuPDF lee directamente de la memoryview: no se copia el PDF original
+    doc = fitz.open(stream=as_buffer(pdf_bytes), filetype='pdf')
+    try:
+        for page_num in range(len(doc)):
+            page = doc[page_num]
+            perseo_elements = remover.detect_perseo_elements(page)
+            if perseo_elements:
+                remover.remove_perseo_elements(page, perseo_elements)
+        # Sin /ID nuevo la salida es determinista: un reenvío del mismo PDF no ocupa espacio en el archivo
+        return doc.tobytes(no_new_id=True)
+    finally:
+        doc.close()
+
+
+def limpiar_perseo_pdf(pdf: Attachment) -> Attachment:
+    """
+    Limpia el logo PERSEO de un adjunto PDF y retorna el PDF limpio como Attachment
+    (volcado a disco si supera el umbral de ATTACHMENT_SPOOL_THRESHOLD).
+    """
+    return Attachment.from_bytes(pdf.filename, limpiar_perseo_pdf_bytes(pdf), 'application/pdf')
 
 
 def main():
@@ -0,0 +1,21 @@
+class AdaptivePoller:
+    """
+    Intervalo de revisión del buzón según el tráfico: vuelve al mínimo cada vez que llegan
+    mensajes y, mientras el buzón sigue vacío, crece multiplicándose por `backoff` hasta el máximo.
+    """
+
+    def __init__(self, initial: float, min_interval: float, max_interval: float, backoff: float = 2.0):
+        self.min_interval = max(1.0, float(min_interval))
+        self.max_interval = max(self.min_interval, float(max_interval))
+        self.backoff = max(1.0, float(backoff))
+        self.interval = min(self.max_interval, max(self.min_interval, float(initial)))
+
+    def record(self, found: int) -> float:
+        """
+        Registra cuántos mensajes trajo la última revisión y retorna los segundos hasta la siguiente.
+        """
+        if found:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+        return self.interval
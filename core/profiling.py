@@ -0,0 +1,143 @@
+import os
+import signal
+import sys
+import threading
+import traceback
+from datetime import datetime
+from functools import wraps
+from typing import Optional
+
+from core.logger import logger
+from core.circuit_breaker import circuit_snapshot
+from core.metrics import stage_timings
+from core.watchdog import get_watchdog
+
+# Configuración del perfilado (--profile); None = desactivado
+_profile_every: Optional[int] = None
+_profile_dir = "profiles"
+
+
+def configure_profiling(every_n: int, output_dir: str = "profiles") -> None:
+    """
+    Activa el perfilado con cProfile de process_single_email, volcando estadísticas cada `every_n` emails.
+    """
+    global _profile_every, _profile_dir
+    _profile_every = max(1, int(every_n))
+    _profile_dir = output_dir
+    logger.info(f"Perfilado activo: estadísticas cada {_profile_every} emails en {_profile_dir}/")
+
+
+def profiling_enabled() -> bool:
+    return _profile_every is not None
+
+
+class EmailProfiler:
+    """
+    Perfila cada llamada a process_single_email y acumula las estadísticas.
+
+    cProfile admite un solo perfilador activo a la vez (en Python 3.12 es global al
+    intérprete), así que si otro hilo ya está siendo perfilado, la llamada se ejecuta
+    sin perfilar: con varios workers el resultado es un muestreo de los emails.
+    """
+
+    def __init__(self, every_n: int, output_dir: str):
+        self.every_n = every_n
+        self.output_dir = output_dir
+        self._active = threading.Lock()
+        self._lock = threading.Lock()
+        self._stats = None
+        self._count = 0
+
+    def wrap(self, func):
+        import cProfile
+        import pstats
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self._active.acquire(blocking=False):
+                return func(*args, **kwargs)
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profile.disable()
+            finally:
+                self._active.release()
+                with self._lock:
+                    if self._stats is None:
+                        self._stats = pstats.Stats(profile)
+                    else:
+                        self._stats.add(profile)
+                    self._count += 1
+                    if self._count % self.every_n == 0:
+                        self._dump()
+        return wrapper
+
+    def _dump(self) -> None:
+        import io
+        import pstats
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        path = os.path.join(self.output_dir, f"profile_{datetime.now().strftime('%Y%m%d%H%M%S')}_{self._count}.prof")
+        self._stats.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(path, stream=summary).sort_stats("cumulative").print_stats(15)
+        logger.info(f"📊 Perfil de {self.every_n} emails guardado en {path}\n{summary.getvalue()}")
+        self._stats = None
+
+
+def install_profiler(processor) -> None:
+    """
+    Envuelve process_single_email del procesador si el perfilado está activo.
+    """
+    if _profile_every is None:
+        return
+    profiler = EmailProfiler(_profile_every, _profile_dir)
+    processor.process_single_email = profiler.wrap(processor.process_single_email)
+
+
+def dump_diagnostics(signum=None, frame=None) -> None:
+    """
+    Escribe en el log el stack de todos los hilos y los tiempos por etapa.
+    """
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    in_progress = stage_timings.in_progress()
+    lines = [f"=== DIAGNÓSTICO ({datetime.now().strftime('%Y-%m-%d %H:%M:%S')}, pid {os.getpid()}) ==="]
+    for thread_id, stack in sys._current_frames().items():
+        stage = in_progress.get(thread_id)
+        stage_text = f" - etapa: {stage[0]} ({stage[1]:.1f}s)" if stage else ""
+        lines.append(f"--- Hilo {names.get(thread_id, thread_id)}{stage_text} ---")
+        lines.append("".join(traceback.format_stack(stack)).rstrip())
+    lines.append("--- Tiempos por etapa (segundos) ---")
+    for name, stats in sorted(stage_timings.snapshot().items()):
+        lines.append(f"{name}: {stats['count']} veces, total {stats['total']}, "
+                     f"promedio {stats['avg']}, máximo {stats['max']}")
+    lines.append("--- Circuitos de los servidores de correo ---")
+    for name, state in sorted(circuit_snapshot().items()):
+        lines.append(f"{name}: {state['estado']}, {state['fallos']} fallos seguidos, {state['aperturas']} aperturas, "
+                     f"{state['rechazados']} conexiones rechazadas, reintento en {state['reintento_en']}s")
+    deadlines = get_watchdog().snapshot()
+    lines.append("--- Plazos vencidos / timeouts de lectura ---")
+    for name in sorted(set(deadlines["plazos_vencidos"]) | set(deadlines["timeouts_lectura"])):
+        lines.append(f"{name}: {deadlines['plazos_vencidos'].get(name, 0)} plazos vencidos, "
+                     f"{deadlines['timeouts_lectura'].get(name, 0)} timeouts de lectura")
+    logger.info("\n".join(lines))
+
+
+def _on_diagnostics_signal(signum, frame) -> None:
+    """
+    El handler corre en el hilo principal interrumpiendo lo que hacía: si este tenía tomado
+    un lock que usa el volcado (tiempos por etapa, watchdog, circuitos), esperarlo ahí
+    bloquearía el proceso. El volcado se hace en un hilo aparte.
+    """
+    threading.Thread(target=dump_diagnostics, name="diagnostico", daemon=True).start()
+
+
+def install_signal_handler() -> None:
+    """
+    Registra SIGUSR1 para volcar el diagnóstico al log (`kill -USR1 <pid>`).
+    """
+    if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, _on_diagnostics_signal)
@@ -0,0 +1,147 @@
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Optional
+
+from config import settings
+from core.logger import logger
+
+# Respuestas SMTP con las que el proveedor indica que se está enviando demasiado rápido
+THROTTLE_CODES = frozenset({421, 450, 451, 452})
+
+# Ajuste adaptativo (AIMD): se reduce a la mitad ante un rechazo y se recupera por pasos
+_DECREASE_FACTOR = 0.5
+_INCREASE_STEPS = 20
+_MIN_RATE_FRACTION = 0.05
+
+
+class TokenBucket:
+    """
+    Token bucket con tasa adaptativa: `rate` tokens por segundo hasta `capacity`.
+    La tasa baja a la mitad con throttle() y vuelve gradualmente a la configurada con success().
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.max_rate = float(rate)
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity))
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self) -> float:
+        """
+        Toma un token, esperando lo necesario. Retorna los segundos esperados.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def throttle(self) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.max_rate * _MIN_RATE_FRACTION, self.rate * _DECREASE_FACTOR)
+            # Vaciar el bucket para que no salga otra ráfaga inmediata
+            self._tokens = min(self._tokens, 0.0)
+
+    def success(self) -> None:
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.max_rate / _INCREASE_STEPS)
+
+
+class SmtpRateLimiter:
+    """
+    Limita los envíos SMTP por cuenta y por dominio de destino (token buckets adaptativos)
+    y el número de envíos simultáneos del proceso.
+    """
+
+    def __init__(self, account_rate: float, account_burst: float, domain_rate: float,
+                 domain_burst: float, max_in_flight: int):
+        self.account_rate = account_rate
+        self.account_burst = account_burst
+        self.domain_rate = domain_rate
+        self.domain_burst = domain_burst
+        self._in_flight = threading.BoundedSemaphore(max_in_flight) if max_in_flight > 0 else None
+        self._accounts: Dict[str, TokenBucket] = {}
+        self._domains: Dict[str, TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def _bucket(self, buckets: Dict[str, TokenBucket], key: str, rate: float, burst: float) -> Optional[TokenBucket]:
+        if rate <= 0:
+            return None
+        with self._lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = TokenBucket(rate, burst)
+            return bucket
+
+    def _buckets_for(self, account: str, domains: Iterable[str]):
+        buckets = [self._bucket(self._accounts, account, self.account_rate, self.account_burst)]
+        buckets.extend(self._bucket(self._domains, domain, self.domain_rate, self.domain_burst)
+                       for domain in sorted(set(domains)))
+        return [bucket for bucket in buckets if bucket is not None]
+
+    @contextmanager
+    def slot(self, account: str, domains: Iterable[str]) -> Iterator[None]:
+        """
+        Espera turno para un envío de `account` hacia `domains` y ocupa un lugar de envío simultáneo.
+        """
+        domains = list(domains)
+        waited = sum(bucket.acquire() for bucket in self._buckets_for(account, domains))
+        if waited >= 1:
+            logger.info(f"⏳ Envío a {', '.join(domains)} demorado {waited:.1f}s por límite de tasa SMTP")
+        if self._in_flight is None:
+            yield
+            return
+        with self._in_flight:
+            yield
+
+    def record(self, account: str, domains: Iterable[str], code: Optional[int]) -> None:
+        """
+        Ajusta las tasas según la respuesta del servidor: 421/45x reduce, éxito recupera.
+        """
+        buckets = self._buckets_for(account, domains)
+        if code in THROTTLE_CODES:
+            for bucket in buckets:
+                bucket.throttle()
+            logger.warning(f"🐢 Servidor SMTP respondió {code}: tasa reducida a "
+                           f"{', '.join(f'{bucket.rate:.2f}/s' for bucket in buckets) or 'sin límite'}")
+        elif code is None or 200 <= code < 300:
+            for bucket in buckets:
+                bucket.success()
+
+
+_limiter: Optional[SmtpRateLimiter] = None
+_limiter_lock = threading.Lock()
+
+
+def get_smtp_limiter() -> SmtpRateLimiter:
+    """
+    Limitador compartido por todas las cuentas y hilos del proceso. Los modos batch y replay
+    envían desde el proceso principal para que sus workers no multipliquen los límites.
+    """
+    global _limiter
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = SmtpRateLimiter(
+                settings.SMTP_RATE_PER_SECOND,
+                settings.SMTP_BURST,
+                settings.SMTP_DOMAIN_RATE_PER_SECOND,
+                settings.SMTP_DOMAIN_BURST,
+                settings.SMTP_MAX_IN_FLIGHT,
+            )
+        return _limiter
@@ -0,0 +1,18 @@
+from typing import Optional
+
+from config import settings
+
+
+def in_shard(key: int, shard_count: Optional[int] = None, shard_index: Optional[int] = None) -> bool:
+    """
+    Indica si un mensaje (por su UID IMAP o un hash de su UIDL POP3) corresponde a esta réplica.
+    Con SHARD_COUNT réplicas cada una procesa los mensajes con key % SHARD_COUNT == SHARD_INDEX,
+    así varias réplicas vacían el mismo buzón sin procesar dos veces un mensaje.
+    """
+    shard_count = settings.SHARD_COUNT if shard_count is None else shard_count
+    shard_index = settings.SHARD_INDEX if shard_index is None else shard_index
+    if shard_count <= 1:
+        return True
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"SHARD_INDEX debe estar entre 0 y {shard_count - 1} (actual: {shard_index})")
+    return key % shard_count == shard_index
@@ -0,0 +1,55 @@
+import os
+import threading
+from typing import Iterable, Set
+
+
+class UidlState:
+    """
+    Registro persistente de los UIDL de POP3 ya procesados (uno por línea, append-only),
+    para descargar solo los mensajes nuevos en cada revisión del buzón.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._seen: Set[str] = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='ascii', errors='ignore') as f:
+                self._seen.update(line.strip() for line in f if line.strip())
+
+    def __contains__(self, uid: str) -> bool:
+        return uid in self._seen
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+    def add(self, uid: str) -> None:
+        """
+        Registra un UIDL como procesado y lo persiste de inmediato.
+        """
+        with self._lock:
+            if uid in self._seen:
+                return
+            self._seen.add(uid)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, 'a', encoding='ascii') as f:
+                f.write(uid + "\n")
+
+    def compact(self, current_uids: Iterable[str]) -> int:
+        """
+        Descarta los UIDL que ya no existen en el servidor y reescribe el archivo.
+        Retorna la cantidad de UIDL descartados.
+        """
+        with self._lock:
+            current = self._seen.intersection(current_uids)
+            removed = len(self._seen) - len(current)
+            if not removed:
+                return 0
+            self._seen = current
+            temp_path = self.path + ".tmp"
+            with open(temp_path, 'w', encoding='ascii') as f:
+                f.writelines(uid + "\n" for uid in sorted(current))
+            os.replace(temp_path, self.path)
+            return removed
@@ -0,0 +1,174 @@
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, Optional, Set, Tuple
+
+from config import settings
+from core.logger import logger
+from core.metrics import stage_timings
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    Una operación de correo superó su plazo total y el watchdog cortó su conexión.
+    """
+
+    def __init__(self, name: str, seconds: float):
+        super().__init__(f"{name}: plazo de {seconds:g}s vencido, conexión cortada por el watchdog")
+        self.name = name
+        self.seconds = seconds
+
+
+class _Operation:
+    __slots__ = ("name", "seconds", "expires", "abort", "fired")
+
+    def __init__(self, name: str, seconds: float, abort: Optional[Callable[[], None]]):
+        self.name = name
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+        self.abort = abort
+        self.fired = False
+
+
+def shutdown_socket(sock: Optional[socket.socket]) -> None:
+    """
+    Corta una conexión bloqueada en otro hilo: su recv/send retorna o falla de inmediato.
+    """
+    if sock is None:
+        return
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+
+class Watchdog:
+    """
+    Hilo que vigila los plazos totales de las operaciones de correo (conexión, descarga,
+    envío SMTP...). Al vencer un plazo corta la conexión de la operación, que falla con
+    DeadlineExceeded y se reintenta en la siguiente revisión con una conexión nueva. También
+    reporta en el log, con su stack, las etapas de stage_timings que llevan más de
+    `stall_seconds` sin terminar, y cuenta los plazos vencidos y los timeouts de lectura.
+    """
+
+    def __init__(self, interval: float, stall_seconds: float):
+        self.interval = max(0.5, float(interval))
+        self.stall_seconds = float(stall_seconds)
+        self.fired: Counter = Counter()
+        self.timeouts: Counter = Counter()
+        self._operations: Dict[int, _Operation] = {}
+        self._reported: Set[Tuple[int, str]] = set()
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    @contextmanager
+    def deadline(self, name: str, seconds: float,
+                 abort: Optional[Callable[[], None]] = None) -> Iterator[None]:
+        """
+        Ejecuta el bloque con un plazo total de `seconds` (0 = sin plazo). Al vencer se
+        llama a `abort` (normalmente shutdown_socket de la conexión) desde el watchdog.
+        """
+        operation = _Operation(name, seconds, abort)
+        if seconds > 0:
+            with self._lock:
+                self._operations[id(operation)] = operation
+                self._start()
+        try:
+            yield
+        except Exception as e:
+            # imaplib/poplib/smtplib reportan la conexión cortada con errores propios (abort, EOF...)
+            if operation.fired:
+                raise DeadlineExceeded(name, seconds) from e
+            if _caused_by_timeout(e):
+                with self._lock:
+                    self.timeouts[name] += 1
+            raise
+        finally:
+            with self._lock:
+                self._operations.pop(id(operation), None)
+
+    def snapshot(self) -> Dict[str, Dict[str, int]]:
+        """
+        Plazos vencidos y timeouts de lectura por operación.
+        """
+        with self._lock:
+            return {"plazos_vencidos": dict(self.fired), "timeouts_lectura": dict(self.timeouts)}
+
+    def _start(self) -> None:
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name="watchdog", daemon=True)
+            self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            try:
+                self._check_deadlines()
+                self._check_stalls()
+            except Exception as e:
+                logger.error(f"Error en el watchdog: {e}")
+
+    def _check_deadlines(self) -> None:
+        now = time.monotonic()
+        with self._lock:
+            expired = [operation for operation in self._operations.values()
+                       if not operation.fired and now >= operation.expires]
+            for operation in expired:
+                operation.fired = True
+                self.fired[operation.name] += 1
+        for operation in expired:
+            logger.error(f"⏱️ Watchdog: {operation.name} superó su plazo de {operation.seconds:g}s, "
+                         f"se corta la conexión")
+            if operation.abort is not None:
+                operation.abort()
+
+    def _check_stalls(self) -> None:
+        if self.stall_seconds <= 0:
+            return
+        in_progress = stage_timings.in_progress()
+        stalled = {(thread_id, name): elapsed for thread_id, (name, elapsed) in in_progress.items()
+                   if elapsed >= self.stall_seconds}
+        # Cada etapa detenida se reporta una vez (hasta que termine)
+        self._reported &= set(stalled)
+        frames = sys._current_frames()
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for key, elapsed in stalled.items():
+            if key in self._reported:
+                continue
+            self._reported.add(key)
+            thread_id, name = key
+            stack = "".join(traceback.format_stack(frames[thread_id])).rstrip() if thread_id in frames else ""
+            logger.warning(f"⏱️ Watchdog: etapa {name} lleva {elapsed:.0f}s en el hilo "
+                           f"{names.get(thread_id, thread_id)}\n{stack}")
+
+
+def _caused_by_timeout(error: BaseException) -> bool:
+    """
+    smtplib e imaplib convierten el timeout del socket en sus propias excepciones
+    (SMTPServerDisconnected, IMAP4.abort) dentro del except: se busca en la cadena.
+    """
+    while error is not None:
+        if isinstance(error, TimeoutError):
+            return True
+        error = error.__cause__ or error.__context__
+    return False
+
+
+_watchdog: Optional[Watchdog] = None
+_watchdog_lock = threading.Lock()
+
+
+def get_watchdog() -> Watchdog:
+    """
+    Watchdog compartido por todas las cuentas y hilos del proceso.
+    """
+    global _watchdog
+    with _watchdog_lock:
+        if _watchdog is None:
+            # Las etapas sin conexión que cortar (PDF, XML...) se reportan al doble del plazo de correo
+            _watchdog = Watchdog(settings.WATCHDOG_INTERVAL, settings.MAIL_OPERATION_TIMEOUT * 2)
+        return _watchdog
@@ -0,0 +1,52 @@
+import threading
+import time
+from typing import Any, List, Optional
+
+
+class WindowBuffer:
+    """
+    Buffer acotado en memoria que acumula elementos y se vacía al llenarse
+    o al cumplirse la ventana de tiempo desde el primer elemento recibido.
+    """
+
+    def __init__(self, max_items: int, window_seconds: float):
+        self.max_items = max(1, int(max_items))
+        self.window_seconds = max(0.0, float(window_seconds))
+        self._items: List[Any] = []
+        self._opened_at: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def add(self, item: Any) -> bool:
+        """
+        Agrega un elemento. Retorna True si el buffer alcanzó su capacidad
+        y debe vaciarse.
+        """
+        with self._lock:
+            if not self._items:
+                self._opened_at = time.monotonic()
+            self._items.append(item)
+            return len(self._items) >= self.max_items
+
+    def is_due(self, now: Optional[float] = None) -> bool:
+        """
+        Indica si la ventana de tiempo del buffer ya expiró.
+        """
+        with self._lock:
+            if not self._items or self._opened_at is None:
+                return False
+            now = time.monotonic() if now is None else now
+            return now - self._opened_at >= self.window_seconds
+
+    def drain(self) -> List[Any]:
+        """
+        Retorna todos los elementos acumulados y deja el buffer vacío.
+        """
+        with self._lock:
+            items = self._items
+            self._items = []
+            self._opened_at = None
+            return items
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
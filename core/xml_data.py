@@ -1,10 +1,30 @@
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, field, fields
+from typing import Iterator, Optional, Tuple
 
-@dataclass
+# Textos descriptivos de los códigos del SRI
+TIPOS_DOCUMENTO = {
+    "01": "Factura",
+    "03": "Liquidación de Compra de Bienes y Prestación de Servicios",
+    "04": "Nota de Crédito",
+    "05": "Nota de Débito",
+    "06": "Guía de Remisión",
+    "07": "Comprobante de Retención"
+}
+
+TIPOS_EMISION = {
+    "1": "Emisión Normal",
+    "2": "Emisión por Indisponibilidad del Sistema"
+}
+
+# Campos de los que dependen los valores derivados en caché
+_DERIVED_SOURCES = frozenset({"estab", "pto_emi", "secuencial", "codigo_documento", "tipo_emision"})
+
+@dataclass(slots=True)
 class XMLData:
     """
-    Clase para almacenar los datos extraídos de un XML de documento electrónico del SRI
+    Clase para almacenar los datos extraídos de un XML de documento electrónico del SRI.
+    Usa __slots__ (sin __dict__ por instancia) y guarda en caché los valores derivados,
+    que se recalculan solo si cambia alguno de los campos de los que dependen.
     """
     email_destinatario: str
     clave_acceso: str = ""
@@ -13,7 +33,7 @@ class XMLData:
     razon_social_comprador: str = ""
     fecha_emision: str = ""
     numero_factura: str = ""  # Mantener por compatibilidad
-    
+
     # Nuevos campos agregados
     estab: str = ""                    # Establecimiento
     pto_emi: str = ""                  # Punto de emisión
@@ -23,7 +43,10 @@ class XMLData:
     tipo_emision: str = ""             # Tipo de emisión (1, 2)
     fecha_autorizacion: str = ""       # Fecha de autorización
     estado_autorizacion: str = ""      # Estado de la autorización
-    
+
+    # (numero_comprobante, tipo_documento_texto, tipo_emision_texto), calculado en el primer uso
+    _derived: Optional[Tuple[str, str, str]] = field(default=None, init=False, repr=False, compare=False)
+
     def __post_init__(self):
         """
         Validaciones y ajustes post-inicialización
@@ -33,67 +56,70 @@ class XMLData:
             self.numero_factura = self.secuencial
         elif self.numero_factura and not self.secuencial:
             self.secuencial = self.numero_factura
-    
+
+    def __setattr__(self, name: str, value) -> None:
+        object.__setattr__(self, name, value)
+        if name in _DERIVED_SOURCES:
+            object.__setattr__(self, "_derived", None)
+
+    def _get_derived(self) -> Tuple[str, str, str]:
+        derived = self._derived
+        if derived is None:
+            numero_comprobante = ""
+            if self.estab and self.pto_emi and self.secuencial:
+                numero_comprobante = f"{self.estab}-{self.pto_emi}-{self.secuencial}"
+            derived = (
+                numero_comprobante,
+                TIPOS_DOCUMENTO.get(self.codigo_documento, f"Documento tipo {self.codigo_documento}"),
+                TIPOS_EMISION.get(self.tipo_emision, f"Emisión tipo {self.tipo_emision}"),
+            )
+            object.__setattr__(self, "_derived", derived)
+        return derived
+
     def get_numero_comprobante(self) -> str:
         """
         Genera el número de comprobante en formato: estab-ptoEmi-secuencial
         """
-        if self.estab and self.pto_emi and self.secuencial:
-            return f"{self.estab}-{self.pto_emi}-{self.secuencial}"
-        return ""
-    
+        return self._get_derived()[0]
+
     def get_tipo_documento_texto(self) -> str:
         """
         Convierte el código de tipo de documento a texto descriptivo
         """
-        tipos_documento = {
-            "01": "Factura",
-            "03": "Liquidación de Compra de Bienes y Prestación de Servicios",
-            "04": "Nota de Crédito",
-            "05": "Nota de Débito", 
-            "06": "Guía de Remisión",
-            "07": "Comprobante de Retención"
-        }
-        return tipos_documento.get(self.codigo_documento, f"Documento tipo {self.codigo_documento}")
-    
+        return self._get_derived()[1]
+
     def get_tipo_emision_texto(self) -> str:
         """
         Convierte el código de tipo de emisión a texto descriptivo
         """
-        tipos_emision = {
-            "1": "Emisión Normal",
-            "2": "Emisión por Indisponibilidad del Sistema"
-        }
-        return tipos_emision.get(self.tipo_emision, f"Emisión tipo {self.tipo_emision}")
-    
+        return self._get_derived()[2]
+
     def is_authorized(self) -> bool:
         """
         Verifica si el documento está autorizado
         """
         return self.estado_autorizacion.upper() == "AUTORIZADO"
-    
+
+    def items(self) -> Iterator[Tuple[str, str]]:
+        """
+        Pares (campo, valor) de los datos extraídos, sin construir un diccionario
+        (las plantillas los recorren igual que el antiguo xml_data.__dict__).
+        """
+        for data_field in _PUBLIC_FIELDS:
+            yield data_field, getattr(self, data_field)
+
     def to_dict(self) -> dict:
         """
         Convierte la instancia a diccionario para fácil serialización
         """
-        return {
-            "email_destinatario": self.email_destinatario,
-            "clave_acceso": self.clave_acceso,
-            "total_con_impuestos": self.total_con_impuestos,
-            "razon_social": self.razon_social,
-            "razon_social_comprador": self.razon_social_comprador,
-            "fecha_emision": self.fecha_emision,
-            "numero_factura": self.numero_factura,
-            "estab": self.estab,
-            "pto_emi": self.pto_emi,
-            "secuencial": self.secuencial,
-            "numero_autorizacion": self.numero_autorizacion,
-            "codigo_documento": self.codigo_documento,
-            "tipo_emision": self.tipo_emision,
-            "fecha_autorizacion": self.fecha_autorizacion,
-            "estado_autorizacion": self.estado_autorizacion,
+        data = dict(self.items())
+        data.update({
             "numero_comprobante": self.get_numero_comprobante(),
             "tipo_documento_texto": self.get_tipo_documento_texto(),
             "tipo_emision_texto": self.get_tipo_emision_texto(),
             "is_authorized": self.is_authorized()
-        }
\ No newline at end of file
+        })
+        return data
+
+
+_PUBLIC_FIELDS = tuple(data_field.name for data_field in fields(XMLData) if not data_field.name.startswith("_"))
@@ -2,20 +2,107 @@ import argparse
 from services.email_service import EmailXMLProcessor
 from services.templates_service import TemplatesService
 from core.logger import logger
+from core.message_index import get_message_index
+from core.profiling import configure_profiling, install_signal_handler
 from config import settings
 from datetime import datetime
 import json
+import os
+import signal
+
+
+def _on_sigterm(signum, frame) -> None:
+    """
+    SIGTERM (docker stop, systemd) detiene el proceso igual que Ctrl+C: se ejecutan los
+    finally que envían los emails agrupados y el resumen pendientes.
+    """
+    raise KeyboardInterrupt
 
 
 def main():
     parser = argparse.ArgumentParser(description='Servicio de procesamiento de correos XML')
-    parser.add_argument('--mode', choices=['service', 'test', 'monitor'], default='service')
+    parser.add_argument('--mode', choices=['service', 'test', 'monitor', 'replay', 'batch', 'audit', 'archive'], default='service')
     parser.add_argument('--test-type', choices=['processing', 'client', 'both'], default='both')
     parser.add_argument('--interval', type=int, default=30)
-    parser.add_argument('--email-sender', type=str, help='Email del remitente a buscar en modo monitor')
-    parser.add_argument('--email-subject', type=str, help='Asunto del email a buscar en modo monitor')
+    parser.add_argument('--email-sender', type=str, help='Email del remitente a buscar en modo monitor o audit')
+    parser.add_argument('--email-subject', type=str, help='Asunto del email a buscar en modo monitor o audit')
+    parser.add_argument('--source', type=str, help='mbox, Maildir o carpeta de .eml a reprocesar en modo replay')
+    parser.add_argument('--dry-run', action='store_true', help='En modo replay o batch, guardar los emails en --output-dir en lugar de enviarlos')
+    parser.add_argument('--output-dir', type=str, default='replay_output', help='Carpeta de salida del dry-run o del modo archive')
+    parser.add_argument('--workers', type=int, default=None, help='Procesos en paralelo (por defecto, uno por núcleo)')
+    parser.add_argument('--input-dir', type=str, help='Carpeta con XML y PDF a entregar en modo batch')
+    parser.add_argument('--watch', action='store_true', help='En modo batch, seguir vigilando la carpeta (inotify o sondeo cada --interval)')
+    parser.add_argument('--profile', action='store_true', help='Perfilar con cProfile el procesamiento de cada email')
+    parser.add_argument('--profile-every', type=int, default=50, help='Emails por cada volcado de estadísticas de --profile')
+    parser.add_argument('--profile-dir', type=str, default='profiles', help='Carpeta de los archivos .prof de --profile')
+    parser.add_argument('--clave', type=str, help='Clave de acceso a buscar en modo audit o a recuperar en modo archive')
+    parser.add_argument('--search', type=str, help='Texto a buscar en remitente, asunto, adjuntos o claves en modo audit')
+    parser.add_argument('--limit', type=int, default=20, help='Máximo de resultados del modo audit')
+    parser.add_argument('--checkpoint', type=str, default=None, help='Archivo de checkpoint del modo batch (por defecto INPUT_DIR/.batch_checkpoint)')
     args = parser.parse_args()
 
+    # kill -USR1 <pid> escribe en el log los stacks de los hilos y los tiempos por etapa
+    install_signal_handler()
+    signal.signal(signal.SIGTERM, _on_sigterm)
+    if args.profile:
+        configure_profiling(args.profile_every, args.profile_dir)
+
+    if args.mode == 'replay':
+        if not args.source:
+            print("Error: Modo replay requiere --source.")
+            print("Uso: python main.py --mode replay --source ruta/ [--dry-run --output-dir salida/] [--workers 8]")
+            return
+        from services.replay_service import run_replay
+        run_replay(args.source, args.output_dir if args.dry_run else None, args.workers)
+        return
+
+    if args.mode == 'audit':
+        # Consulta el índice local de mensajes, sin conectarse al servidor de correo
+        index = get_message_index()
+        if index is None:
+            print("Error: Modo audit requiere MESSAGE_INDEX_FILE.")
+            return
+        rows = index.search(sender=args.email_sender, subject=args.email_subject, text=args.search,
+                            clave=args.clave, limit=args.limit)
+        for row in rows:
+            print(json.dumps(row, ensure_ascii=False))
+        logger.info(f"Modo audit: {len(rows)} mensajes encontrados en {index.path}")
+        return
+
+    if args.mode == 'archive':
+        # Recupera del archivo legal el XML y los PDFs entregados de una clave de acceso
+        from core.archive_store import get_archive_store
+        store = get_archive_store()
+        if store is None or not args.clave:
+            print("Error: Modo archive requiere ARCHIVE_DIR y --clave.")
+            print("Uso: python main.py --mode archive --clave <clave de acceso> [--output-dir salida/]")
+            return
+        files = store.get(args.clave)
+        os.makedirs(args.output_dir, exist_ok=True)
+        for filename, content in files:
+            path = os.path.join(args.output_dir, os.path.basename(filename))
+            with open(path, 'wb') as f:
+                f.write(content)
+            print(path)
+        logger.info(f"Modo archive: {len(files)} archivos de {args.clave} en {args.output_dir}")
+        return
+
+    if args.mode == 'batch':
+        if not args.input_dir:
+            print("Error: Modo batch requiere --input-dir.")
+            print("Uso: python main.py --mode batch --input-dir carpeta/ [--watch] [--workers 8] [--dry-run --output-dir salida/]")
+            return
+        from services.batch_service import run_batch
+        processor = EmailXMLProcessor(dry_run_dir=args.output_dir if args.dry_run else None)
+        run_batch(processor, args.input_dir, args.workers, args.watch, args.interval or 30, args.checkpoint)
+        return
+
+    if args.mode == 'service' and settings.ACCOUNTS_FILE:
+        from core.email_config import load_accounts
+        from services.account_service import run_accounts
+        run_accounts(load_accounts(settings.ACCOUNTS_FILE), args.interval)
+        return
+
     processor = EmailXMLProcessor()
 
     if args.mode == 'test':
@@ -74,14 +161,31 @@ def main():
             return
         
         try:
-            # Conectar al buzón y obtener todos los emails
-            logger.info("Conectando al buzón para buscar email específico...")
-            emails = processor.get_unread_emails_imap()
-            logger.info(f"Total de emails en buzón: {len(emails)}")
+            # Primero el índice local: encuentra también emails ya leídos o procesados
+            # y descarga solo ese UID, sin recorrer el buzón
+            target_email = None
+            emails = []
+            index = get_message_index()
+            if index is not None:
+                for hit in index.search(sender=args.email_sender, subject=args.email_subject,
+                                        account=processor.config.name, limit=5):
+                    if not hit['uid'] or not hit['mailbox']:
+                        continue
+                    logger.info(f"🗂️ Email en el índice - UID {hit['uid']} ({hit['mailbox']}), "
+                                f"estado: {hit['status']}, claves: {hit['claves'] or 'N/A'}")
+                    target_email = processor.get_imap_message(hit['uid'], hit['mailbox'])
+                    if target_email is not None:
+                        logger.info(f"✅ Email encontrado - Remitente: {target_email.get('From')}, Asunto: {target_email.get('Subject')}")
+                        break
+
+            if target_email is None:
+                # Conectar al buzón y obtener todos los emails
+                logger.info("Conectando al buzón para buscar email específico...")
+                emails = processor.get_unread_emails_imap()
+                logger.info(f"Total de emails en buzón: {len(emails)}")
             
             # Buscar el email que coincida con los criterios
-            target_email = None
-            for email_msg in emails:
+            for email_msg in emails if target_email is None else []:
                 sender = email_msg.get('From', '').lower()
                 subject = email_msg.get('Subject', '').lower()
                 
@@ -109,7 +213,7 @@ def main():
                     criteria.append(f"asunto: '{args.email_subject}'")
                 
                 # Crear contexto para notificar email no encontrado
-                context = {
+                contexts = [{
                     "fecha_procesamiento": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
                     "entorno": settings.ENVIRONMENT,
                     "email_origen": "monitor@webpos.com",
@@ -126,7 +230,7 @@ def main():
                         "mensaje": f"No se encontró email con criterios: {', '.join(criteria)}",
                         "total_emails_revisados": len(emails)
                     }
-                }
+                }]
             else:
                 # Procesar el email encontrado y extraer datos reales
                 sender = target_email.get('From', 'Desconocido')
@@ -135,49 +239,49 @@ def main():
                 
                 # Extraer adjuntos usando el sistema existente
                 from services.attachment_handler import extract_attachments
-                from services.xml_processor import process_xml_file
                 
                 attachments = extract_attachments(target_email)
-                logger.info(f"📎 Adjuntos encontrados: {[att[0] for att in attachments]}")
-                
-                xml_data = None
-                xml_filename = ""
-                
-                # Procesar XML usando el sistema existente
-                for filename, content in attachments:
-                    logger.info(f"🔄 Procesando adjunto: {filename}")
-                    if filename.lower().endswith(('.xml', '.zip')):
-                        xml_data = process_xml_file(content)
-                        xml_filename = filename
-                        logger.info(f"✅ Datos extraídos del XML: {xml_data}")
-                        break
+                logger.info(f"📎 Adjuntos encontrados: {[att.filename for att in attachments]}")
                 
-                if xml_data:
-                    # Crear contexto con datos reales extraídos del email específico
-                    context = {
-                        "fecha_procesamiento": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-                        "entorno": settings.ENVIRONMENT,
-                        "email_origen": sender,
-                        "asunto_original": subject,
-                        "xml_filename": xml_filename,
-                        "email_extraido": xml_data.email_destinatario,
-                        "clave_acceso": xml_data.clave_acceso,
-                        "total_con_impuestos": xml_data.total_con_impuestos,
-                        "razon_social": xml_data.razon_social,
-                        "fecha_emision": xml_data.fecha_emision,
-                        "numero_factura": xml_data.numero_factura,
-                        "adjuntos_procesados": [att[0] for att in attachments],
-                        "xml_data": xml_data.__dict__ if hasattr(xml_data, '__dict__') else xml_data
-                    }
-                    logger.info(f"📊 DATOS EXTRAÍDOS PARA MONITOR:")
-                    logger.info(f"   👤 Cliente: {xml_data.razon_social}")
-                    logger.info(f"   📧 Email destino: {xml_data.email_destinatario}")
-                    logger.info(f"   🧾 Factura: {xml_data.numero_factura}")
-                    logger.info(f"   💰 Total: {xml_data.total_con_impuestos}")
-                    logger.info(f"   🔑 Clave: {xml_data.clave_acceso}")
-                else:
+                documents = []
+                try:
+                    # Procesar todos los XML del email (sueltos o dentro de ZIP) usando el sistema existente
+                    documents = processor.prepare_documents(attachments)
+                    contexts = []
+                    for document in documents:
+                        xml_data = document.xml_data
+                        # Crear contexto con datos reales extraídos del email específico
+                        contexts.append({
+                            "fecha_procesamiento": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+                            "entorno": settings.ENVIRONMENT,
+                            "email_origen": sender,
+                            "asunto_original": subject,
+                            "xml_filename": document.xml_filename,
+                            "email_extraido": xml_data.email_destinatario,
+                            "clave_acceso": xml_data.clave_acceso,
+                            "total_con_impuestos": xml_data.total_con_impuestos,
+                            "razon_social": xml_data.razon_social,
+                            "fecha_emision": xml_data.fecha_emision,
+                            "numero_factura": xml_data.numero_factura,
+                            "adjuntos_procesados": [att.filename for att in attachments],
+                            "xml_data": xml_data
+                        })
+                        logger.info(f"📊 DATOS EXTRAÍDOS PARA MONITOR ({document.xml_filename}):")
+                        logger.info(f"   👤 Cliente: {xml_data.razon_social}")
+                        logger.info(f"   📧 Email destino: {xml_data.email_destinatario}")
+                        logger.info(f"   🧾 Factura: {xml_data.numero_factura}")
+                        logger.info(f"   💰 Total: {xml_data.total_con_impuestos}")
+                        logger.info(f"   🔑 Clave: {xml_data.clave_acceso}")
+                finally:
+                    # Liberar los adjuntos (archivos temporales y mmap), igual que en el servicio
+                    for document in documents:
+                        document.xml_attachment.close()
+                    for attachment in attachments:
+                        attachment.close()
+
+                if not contexts:
                     logger.error("❌ No se pudo extraer datos del XML en el email encontrado")
-                    context = {
+                    contexts.append({
                         "fecha_procesamiento": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
                         "entorno": settings.ENVIRONMENT,
                         "email_origen": sender,
@@ -189,29 +293,30 @@ def main():
                         "razon_social": "Error al procesar XML del email encontrado",
                         "fecha_emision": datetime.now().strftime("%d/%m/%Y"),
                         "numero_factura": "Error",
-                        "adjuntos_procesados": [att[0] for att in attachments] if attachments else [],
+                        "adjuntos_procesados": [att.filename for att in attachments] if attachments else [],
                         "xml_data": {"error": f"No se pudo procesar XML del email: {subject}"}
-                    }
+                    })
             
-            # Enviar email de monitoreo a MONITOR_EMAIL
-            logger.info(f"📤 ENVIANDO REPORTE DE MONITOR")
-            logger.info(f"📧 Destino: {monitor_email}")
-            
-            html = ts.render("email_template.html", context)
-            result = processor.email_service.send_email(
-                monitor_email, 
-                f"[{settings.ENVIRONMENT.upper()}] MONITOR - Email Específico Procesado", 
-                html
-            )
-            
-            if result:
-                logger.info(f"✅ Reporte de monitor enviado exitosamente a {monitor_email}")
-                if context['clave_acceso'] != 'N/A' and context['clave_acceso'] != 'Error':
-                    logger.info(f"📋 RESUMEN: Factura #{context['numero_factura']} | Total: {context['total_con_impuestos']} | Cliente: {context['razon_social']}")
+            # Enviar un email de monitoreo a MONITOR_EMAIL por cada documento encontrado
+            for context in contexts:
+                logger.info(f"📤 ENVIANDO REPORTE DE MONITOR")
+                logger.info(f"📧 Destino: {monitor_email}")
+                
+                html = ts.render("email_template.html", context)
+                result = processor.email_service.send_email(
+                    monitor_email, 
+                    f"[{settings.ENVIRONMENT.upper()}] MONITOR - Email Específico Procesado", 
+                    html
+                )
+                
+                if result:
+                    logger.info(f"✅ Reporte de monitor enviado exitosamente a {monitor_email}")
+                    if context['clave_acceso'] != 'N/A' and context['clave_acceso'] != 'Error':
+                        logger.info(f"📋 RESUMEN: Factura #{context['numero_factura']} | Total: {context['total_con_impuestos']} | Cliente: {context['razon_social']}")
+                    else:
+                        logger.info(f"📋 RESUMEN: {context['razon_social']}")
                 else:
-                    logger.info(f"📋 RESUMEN: {context['razon_social']}")
-            else:
-                logger.error(f"❌ Error al enviar reporte de monitor a {monitor_email}")
+                    logger.error(f"❌ Error al enviar reporte de monitor a {monitor_email}")
                 
         except Exception as e:
             logger.error(f"💥 Error crítico en modo monitor: {e}")
@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Benchmark del generador de RIDE (core/pdf.py): páginas por segundo con facturas
+sintéticas de muchas líneas de detalle, en un solo proceso y con el pool de generar_rides.
+
+Uso:
+    python scripts/bench_ride.py [--invoices 20] [--lines 300] [--workers 4]
+"""
+
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from core.pdf import generar_ride, generar_rides  # noqa: E402
+
+_PAGE_RE = re.compile(rb"/Type\s*/Page[^s]")
+
+
+def sample_invoice(lines: int, index: int = 0) -> bytes:
+    """
+    Factura del SRI con `lines` líneas de detalle (descripciones cortas y largas).
+    """
+    detalles = "".join(
+        f"<detalle><codigoPrincipal>P{i:05d}</codigoPrincipal>"
+        f"<descripcion>{'Producto ' + str(i) if i % 3 else 'Servicio profesional de mantenimiento preventivo y correctivo, ítem ' + str(i)}</descripcion>"
+        f"<cantidad>{i % 7 + 1}.00</cantidad><precioUnitario>10.00</precioUnitario><descuento>0.00</descuento>"
+        f"<precioTotalSinImpuesto>{(i % 7 + 1) * 10:.2f}</precioTotalSinImpuesto></detalle>"
+        for i in range(lines)
+    )
+    clave = f"{index:049d}"
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><factura id="comprobante" version="1.1.0">'
+        "<infoTributaria><ambiente>2</ambiente><tipoEmision>1</tipoEmision><razonSocial>EMPRESA DEMO S.A.</razonSocial>"
+        "<nombreComercial>DEMO</nombreComercial><ruc>1790000000001</ruc>"
+        f"<claveAcceso>{clave}</claveAcceso><codDoc>01</codDoc><estab>001</estab><ptoEmi>001</ptoEmi>"
+        f"<secuencial>{index:09d}</secuencial><dirMatriz>Av. Principal 123, Quito</dirMatriz></infoTributaria>"
+        "<infoFactura><fechaEmision>01/01/2025</fechaEmision><dirEstablecimiento>Av. Principal 123</dirEstablecimiento>"
+        "<obligadoContabilidad>SI</obligadoContabilidad><razonSocialComprador>CLIENTE DEMO</razonSocialComprador>"
+        "<identificacionComprador>0999999999001</identificacionComprador><totalSinImpuestos>1000.00</totalSinImpuestos>"
+        "<totalDescuento>0.00</totalDescuento><totalConImpuestos><totalImpuesto><codigo>2</codigo>"
+        "<codigoPorcentaje>4</codigoPorcentaje><baseImponible>1000.00</baseImponible><valor>150.00</valor>"
+        "</totalImpuesto></totalConImpuestos><propina>0.00</propina><importeTotal>1150.00</importeTotal></infoFactura>"
+        f"<detalles>{detalles}</detalles>"
+        '<infoAdicional><campoAdicional nombre="Email">cliente@demo.com</campoAdicional></infoAdicional></factura>'
+    ).encode("utf-8")
+
+
+def count_pages(pdf: bytes) -> int:
+    return len(_PAGE_RE.findall(pdf))
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmark de generación de RIDE")
+    parser.add_argument("--invoices", type=int, default=20)
+    parser.add_argument("--lines", type=int, default=300, help="Líneas de detalle por factura")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    invoices = [sample_invoice(args.lines, i) for i in range(args.invoices)]
+    generar_ride(invoices[0])  # calentar estilos y fuentes
+
+    started = time.perf_counter()
+    pages = sum(count_pages(generar_ride(xml)) for xml in invoices)
+    elapsed = time.perf_counter() - started
+    print(f"1 proceso:   {args.invoices} facturas x {args.lines} líneas, {pages} páginas "
+          f"en {elapsed:.2f}s -> {pages / elapsed:.1f} páginas/s")
+
+    started = time.perf_counter()
+    pages = sum(count_pages(pdf) for pdf in generar_rides(invoices, args.workers))
+    elapsed = time.perf_counter() - started
+    print(f"{args.workers} procesos: {args.invoices} facturas x {args.lines} líneas, {pages} páginas "
+          f"en {elapsed:.2f}s -> {pages / elapsed:.1f} páginas/s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Verificación de tiempo de arranque del servicio usando `python -X importtime`.
+
+Importa `main` en un proceso nuevo, falla si el tiempo acumulado supera el
+presupuesto o si se cargan dependencias pesadas que deben importarse de forma
+diferida (PyMuPDF, Jinja2, ReportLab).
+
+Uso:
+    python scripts/check_import_time.py [--budget-ms 250] [--top 15]
+"""
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+
+# Módulos que no deben cargarse al importar main
+DEFERRED_MODULES = ("fitz", "pymupdf", "jinja2", "reportlab")
+
+_LINE_RE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)$")
+
+
+def measure(module: str = "main"):
+    """
+    Ejecuta el import en un intérprete limpio y retorna [(módulo, self_us, cumulative_us, nivel)].
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=root, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"No se pudo importar {module}:\n{result.stderr}")
+    entries = []
+    for line in result.stderr.splitlines():
+        match = _LINE_RE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            entries.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+    return entries
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Chequeo de regresión del tiempo de importación")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--budget-ms", type=float, default=float(os.getenv("IMPORT_TIME_BUDGET_MS", "250")))
+    parser.add_argument("--top", type=int, default=15)
+    args = parser.parse_args()
+
+    entries = measure(args.module)
+    total_us = next((cum for name, _, cum, _ in reversed(entries) if name == args.module), 0)
+
+    print(f"Tiempo de importación de '{args.module}': {total_us / 1000:.1f} ms (presupuesto {args.budget_ms:.0f} ms)")
+    print(f"Módulos más costosos (acumulado):")
+    for name, _, cumulative_us, _ in sorted(entries, key=lambda e: e[2], reverse=True)[:args.top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    ok = True
+    loaded = sorted({name for name, _, _, _ in entries if name.split(".")[0] in DEFERRED_MODULES})
+    if loaded:
+        ok = False
+        print(f"ERROR: dependencias pesadas importadas al arrancar: {', '.join(loaded)}")
+    if total_us / 1000 > args.budget_ms:
+        ok = False
+        print(f"ERROR: el tiempo de importación supera el presupuesto")
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
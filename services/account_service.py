@@ -0,0 +1,50 @@
+import threading
+import time
+from typing import List
+
+from core.email_config import EmailConfig
+from core.logger import logger
+
+
+def _run_account(processor, check_interval: int) -> None:
+    """
+    Ciclo de servicio de una cuenta; un error de conexión no detiene a las demás cuentas.
+    """
+    while True:
+        try:
+            processor.run_service(check_interval)
+            return
+        except Exception as e:
+            logger.error(f"Error en la cuenta {processor.config.name}: {e}")
+            if check_interval <= 0:
+                return
+            time.sleep(check_interval)
+
+
+def run_accounts(accounts: List[EmailConfig], check_interval: int) -> None:
+    """
+    Atiende varias cuentas en un mismo proceso: cada cuenta tiene su propio
+    EmailXMLProcessor (con sus workers de entrega y su digest) en un hilo dedicado.
+    """
+    from services.email_service import EmailXMLProcessor
+
+    logger.info(f"=== INICIANDO SERVICIO MULTICUENTA - {len(accounts)} cuentas: "
+                f"{', '.join(account.name for account in accounts)} ===")
+    threads, processors = [], []
+    for account in accounts:
+        processor = EmailXMLProcessor(account=account)
+        processors.append(processor)
+        thread = threading.Thread(target=_run_account, args=(processor, check_interval),
+                                  name=f"cuenta-{account.name}", daemon=True)
+        thread.start()
+        threads.append(thread)
+
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        logger.info("Servicio multicuenta detenido")
+    finally:
+        # Los hilos de las cuentas son daemon y no llegan a sus finally: enviar lo pendiente aquí
+        for processor in processors:
+            processor.flush_pending()
@@ -1,22 +1,54 @@
+import binascii
 import email
-from typing import List, Tuple
+import quopri
+from typing import List, Optional
+from core.attachment import Attachment
 from core.logger import logger
 
-def extract_attachments(email_msg: email.message.Message) -> List[Tuple[str, bytes]]:
+# Bytes iniciales que se inspeccionan para validar y detectar el tipo de archivo
+SNIFF_SIZE = 1000
+
+# Caracteres base64 necesarios para decodificar SNIFF_SIZE bytes
+_SNIFF_B64_CHARS = -(-SNIFF_SIZE // 3) * 4
+
+# Content-types que pueden contener un documento electrónico
+ATTACHMENT_TYPES = frozenset({
+    'application/xml',
+    'text/xml',
+    'application/zip',
+    'application/pdf',
+    'application/octet-stream'
+})
+
+# Extensiones que procesa el servicio y el tipo detectado que deben tener
+EXPECTED_TYPES = {
+    'xml': 'XML',
+    'zip': 'ZIP',
+    'pdf': 'PDF'
+}
+
+def extract_attachments(email_msg: email.message.Message, spool_threshold: Optional[int] = None) -> List[Attachment]:
     """
-    Extrae todos los adjuntos de un mensaje de email.
+    Extrae los adjuntos relevantes (XML, ZIP, PDF) de un mensaje de email.
+
+    La relevancia de cada parte se decide con sus encabezados y con una muestra
+    de SNIFF_SIZE bytes; solo se decodifica el payload de las partes aceptadas.
     
     Args:
         email_msg: Mensaje de email del cual extraer adjuntos
+        spool_threshold: Umbral de volcado a disco de los adjuntos (por defecto ATTACHMENT_SPOOL_THRESHOLD)
         
     Returns:
-        Lista de tuplas (filename, content) con los adjuntos encontrados
+        Lista de Attachment con los adjuntos encontrados (decodificados una sola vez)
     """
     attachments = []
     
     try:
         # Procesar todas las partes del email
         for part in email_msg.walk():
+            if part.is_multipart():
+                continue
+
             # Obtener el content-disposition
             content_disposition = part.get("Content-Disposition", "")
             content_type = part.get_content_type()
@@ -26,62 +58,112 @@ def extract_attachments(email_msg: email.message.Message) -> List[Tuple[str, byt
             logger.info(f"  Content-Disposition: {content_disposition}")
             
             # Verificar si es un adjunto
-            if "attachment" in content_disposition or _is_attachment_by_type(content_type):
-                filename = part.get_filename()
-                
-                # Si no hay filename en Content-Disposition, intentar obtenerlo de otro lado
-                if not filename:
-                    filename = _extract_filename_from_content_type(part)
-                
-                # Si aún no hay filename, generar uno basado en el content-type
+            if not ("attachment" in content_disposition or _is_attachment_by_type(content_type)):
+                continue
+
+            filename = part.get_filename()
+            
+            # Si no hay filename en Content-Disposition, intentar obtenerlo de otro lado
+            if not filename:
+                filename = _extract_filename_from_content_type(part)
+
+            # Descartar por encabezados los adjuntos que no pueden ser documentos (imágenes, etc.)
+            if not _is_relevant_by_headers(filename, content_type):
+                logger.info(f"  ⏭️  Adjunto omitido sin decodificar: {filename or 'sin nombre'} ({content_type})")
+                continue
+
+            try:
+                # Muestra de tamaño fijo: el tipo se detecta una sola vez por parte
+                header = _sniff_part(part)
+                detected_type = _detect_file_type(header)
+
+                # Si aún no hay filename, generar uno basado en el tipo detectado o el content-type
                 if not filename:
-                    filename = _generate_filename_from_content_type(content_type)
+                    filename = _generate_filename_from_content_type(content_type, detected_type)
                 
                 logger.info(f"  Filename detectado: {filename}")
-                
+
+                # Validar que el contenido coincida con la extensión antes de decodificar
+                if not _validate_content_type(filename, detected_type, header):
+                    logger.warning(f"⚠️  Contenido no coincide con la extensión: {filename}")
+                    continue
+
                 # Obtener el contenido del adjunto
-                try:
-                    payload = part.get_payload(decode=True)
-                    if payload:
-                        # Validar que el contenido coincida con la extensión
-                        if _validate_content_type(filename, payload):
-                            attachments.append((filename, payload))
-                            logger.info(f"✅ Adjunto extraído: {filename} ({len(payload)} bytes)")
-                        else:
-                            logger.warning(f"⚠️  Contenido no coincide con la extensión: {filename}")
-                    else:
-                        logger.warning(f"⚠️  No se pudo obtener contenido del adjunto: {filename}")
-                        
-                except Exception as e:
-                    logger.error(f"❌ Error extrayendo contenido del adjunto {filename}: {e}")
+                attachment = Attachment.from_part(part, filename, spool_threshold)
+                if attachment:
+                    attachment.detected_type = detected_type
+                    attachments.append(attachment)
+                    logger.info(f"✅ Adjunto extraído: {attachment!r}")
+                else:
+                    logger.warning(f"⚠️  No se pudo obtener contenido del adjunto: {filename}")
+                    
+            except Exception as e:
+                logger.error(f"❌ Error extrayendo contenido del adjunto {filename}: {e}")
                     
     except Exception as e:
         logger.error(f"❌ Error general extrayendo adjuntos: {e}")
     
     logger.info(f"📎 Total de adjuntos extraídos: {len(attachments)}")
-    for filename, content in attachments:
-        logger.info(f"   - {filename}: {len(content)} bytes, tipo detectado: {_detect_file_type(content)}")
+    for attachment in attachments:
+        logger.info(f"   - {attachment.filename}: {attachment.size} bytes, tipo detectado: {attachment.detected_type}")
     
     return attachments
 
+def may_contain_attachments(headers: email.message.Message) -> bool:
+    """
+    Pre-filtro con solo los encabezados del mensaje (p. ej. POP3 TOP n 0): un mensaje
+    puede traer documentos si es multipart o si su cuerpo es directamente un adjunto relevante.
+    """
+    content_type = headers.get_content_type()
+    if content_type.startswith('multipart/'):
+        return True
+    filename = headers.get_filename() or _extract_filename_from_content_type(headers)
+    return _is_relevant_by_headers(filename, content_type)
+
 def _is_attachment_by_type(content_type: str) -> bool:
     """
     Determina si un content-type corresponde a un tipo de adjunto esperado.
     """
-    attachment_types = [
-        'application/xml',
-        'text/xml',
-        'application/zip',
-        'application/pdf',
-        'application/octet-stream'
-    ]
-    return content_type in attachment_types
+    return content_type in ATTACHMENT_TYPES
+
+def _get_extension(filename: str) -> str:
+    """
+    Extensión del archivo en minúsculas, sin el punto.
+    """
+    return filename.lower().rsplit('.', 1)[-1] if filename and '.' in filename else ''
+
+def _is_relevant_by_headers(filename: str, content_type: str) -> bool:
+    """
+    Decide solo con los encabezados si una parte puede contener un documento:
+    extensión conocida (xml, zip, pdf) o un content-type de documento.
+    """
+    return _get_extension(filename) in EXPECTED_TYPES or content_type in ATTACHMENT_TYPES
+
+def _sniff_part(part: email.message.Message) -> bytes:
+    """
+    Decodifica solo los primeros SNIFF_SIZE bytes del payload de una parte.
+    """
+    payload = part.get_payload()
+    if not isinstance(payload, str):
+        return b""
+    encoding = str(part.get('Content-Transfer-Encoding', '')).strip().lower()
+
+    if encoding == 'base64':
+        # Tomar el doble de caracteres para cubrir los saltos de línea intercalados
+        prefix = "".join(payload[:_SNIFF_B64_CHARS * 2].split())[:_SNIFF_B64_CHARS]
+        prefix = prefix[:len(prefix) - len(prefix) % 4]
+        try:
+            return binascii.a2b_base64(prefix)[:SNIFF_SIZE]
+        except binascii.Error:
+            return b""
+    if encoding == 'quoted-printable':
+        return quopri.decodestring(payload[:SNIFF_SIZE * 3].encode('ascii', 'replace'))[:SNIFF_SIZE]
+    return payload[:SNIFF_SIZE].encode('utf-8', 'surrogateescape')
 
 def _extract_filename_from_content_type(part: email.message.Message) -> str:
     """
     Intenta extraer el filename del Content-Type si no está en Content-Disposition.
     """
-    content_type = part.get_content_type()
     params = part.get_params()
     
     if params:
@@ -91,12 +173,19 @@ def _extract_filename_from_content_type(part: email.message.Message) -> str:
     
     return ""
 
-def _generate_filename_from_content_type(content_type: str) -> str:
+def _generate_filename_from_content_type(content_type: str, detected_type: str = "") -> str:
     """
-    Genera un filename basado en el content-type.
+    Genera un filename basado en el tipo detectado o, en su defecto, en el content-type.
     """
     import uuid
     unique_id = str(uuid.uuid4())[:8]
+
+    if detected_type.startswith('XML'):
+        return f'documento_{unique_id}.xml'
+    if detected_type == 'PDF':
+        return f'documento_{unique_id}.pdf'
+    if detected_type == 'ZIP':
+        return f'archivo_{unique_id}.zip'
     
     type_extensions = {
         'application/xml': f'documento_{unique_id}.xml',
@@ -108,44 +197,21 @@ def _generate_filename_from_content_type(content_type: str) -> str:
     
     return type_extensions.get(content_type, f'archivo_{unique_id}.dat')
 
-def _validate_content_type(filename: str, content: bytes) -> bool:
+def _validate_content_type(filename: str, detected_type: str, header: bytes) -> bool:
     """
-    Valida que el contenido del archivo coincida con su extensión.
+    Valida que el tipo detectado por contenido coincida con la extensión del archivo.
     """
-    if not filename or not content:
+    if not filename or not header:
         return False
     
     # Obtener extensión del archivo
-    extension = filename.lower().split('.')[-1] if '.' in filename else ''
-    
-    # Detectar tipo de archivo por contenido
-    detected_type = _detect_file_type(content)
-    
-    # Validaciones específicas
-    if extension == 'xml':
-        # XML debe comenzar con declaración XML o <
-        is_xml = (
-            content.startswith(b'<?xml') or 
-            content.startswith(b'<') or
-            b'<autorizacion>' in content[:1000] or
-            b'<factura' in content[:1000]
-        )
-        if not is_xml:
-            logger.error(f"❌ Archivo {filename} tiene extensión .xml pero el contenido no es XML:")
-            logger.error(f"   Primeros 100 caracteres: {content[:100]}")
-            return False
-    
-    elif extension == 'pdf':
-        # PDF debe comenzar con %PDF
-        if not content.startswith(b'%PDF'):
-            logger.error(f"❌ Archivo {filename} tiene extensión .pdf pero el contenido no es PDF")
-            return False
-    
-    elif extension == 'zip':
-        # ZIP debe comenzar con PK
-        if not content.startswith(b'PK'):
-            logger.error(f"❌ Archivo {filename} tiene extensión .zip pero el contenido no es ZIP")
-            return False
+    extension = _get_extension(filename)
+    expected_type = EXPECTED_TYPES.get(extension)
+
+    if expected_type and not detected_type.startswith(expected_type):
+        logger.error(f"❌ Archivo {filename} tiene extensión .{extension} pero el contenido no es {expected_type}")
+        logger.error(f"   Primeros 100 caracteres: {header[:100]}")
+        return False
     
     logger.info(f"✅ Validación exitosa: {filename} - Tipo detectado: {detected_type}")
     return True
@@ -157,21 +223,21 @@ def _detect_file_type(content: bytes) -> str:
     if not content:
         return "vacío"
     
-    # Primeros bytes para detectar tipo
-    header = content[:20]
-    
     if content.startswith(b'%PDF'):
         return "PDF"
     elif content.startswith(b'PK'):
         return "ZIP"
-    elif content.startswith(b'<?xml') or content.startswith(b'<'):
+
+    # Ignorar BOM y espacios iniciales antes de buscar marcas XML
+    sample = content[:SNIFF_SIZE].lstrip(b'\xef\xbb\xbf \t\r\n')
+    if sample.startswith(b'<'):
         return "XML"
-    elif b'<autorizacion>' in content[:1000]:
+    elif b'<autorizacion>' in sample:
         return "XML de Autorización"
-    elif b'<factura' in content[:1000] or b'<notaCredito' in content[:1000]:
+    elif b'<factura' in sample or b'<notaCredito' in sample:
         return "XML de Comprobante"
     else:
-        return f"Desconocido (primeros bytes: {header.hex()[:20]}...)"
+        return f"Desconocido (primeros bytes: {content[:20].hex()[:20]}...)"
 
 def debug_email_structure(email_msg: email.message.Message) -> None:
     """
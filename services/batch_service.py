@@ -0,0 +1,266 @@
+import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing.util import Finalize
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import settings
+from core.archive_store import flush_archive_store
+from core.logger import logger
+
+# Índice de PDFs disponible en cada proceso worker (se carga en _init_worker)
+_pdf_index: Dict[str, str] = {}
+
+# Una clave de acceso del SRI tiene 49 dígitos
+_CLAVE_RE = re.compile(r"\d{49}")
+
+# XML en vuelo por worker antes de esperar resultados
+_IN_FLIGHT_PER_WORKER = 4
+
+
+def scan_input_dir(input_dir: str, settle_seconds: float = 0) -> Tuple[List[str], Dict[str, str]]:
+    """
+    Recorre la carpeta de entrada y retorna (rutas relativas de XML, índice de PDFs).
+    El índice asocia al PDF su nombre base y cualquier clave de acceso presente en el nombre.
+    Se ignoran los archivos modificados hace menos de `settle_seconds` (aún copiándose).
+    """
+    xml_files = []
+    pdf_index = {}
+    now = time.time()
+    for root, _, files in os.walk(input_dir):
+        for name in files:
+            lower = name.lower()
+            if not lower.endswith(('.xml', '.pdf')):
+                continue
+            path = os.path.join(root, name)
+            if settle_seconds and now - os.path.getmtime(path) < settle_seconds:
+                continue
+            rel_path = os.path.relpath(path, input_dir)
+            if lower.endswith('.xml'):
+                xml_files.append(rel_path)
+            else:
+                pdf_index.setdefault(os.path.splitext(rel_path)[0].lower(), rel_path)
+                for clave in _CLAVE_RE.findall(name):
+                    pdf_index.setdefault(clave, rel_path)
+    xml_files.sort()
+    return xml_files, pdf_index
+
+
+def _init_worker(pdf_index: Dict[str, str]) -> None:
+    global _pdf_index
+    _pdf_index = pdf_index
+    # Los workers terminan sin atexit: terminar de escribir el archivo legal si lo usaron
+    Finalize(None, flush_archive_store, exitpriority=9)
+
+
+def _find_pdf(xml_rel_path: str, clave_acceso: str) -> Optional[str]:
+    """
+    Busca el PDF de un XML por nombre base (misma carpeta) o por clave de acceso.
+    """
+    pdf = _pdf_index.get(os.path.splitext(xml_rel_path)[0].lower())
+    if not pdf and clave_acceso:
+        pdf = _pdf_index.get(clave_acceso)
+    return pdf
+
+
+def _prepare_xml(input_dir: str, xml_rel_path: str) -> Tuple[str, list, str]:
+    """
+    Tarea del worker: parsea el XML, ubica su PDF y lo limpia con limpiar_perseo_pdf_bytes
+    (o genera el RIDE si el XML no tiene PDF).
+    Retorna (ruta XML, [(xml_filename, xml_bytes, xml_data, pdf_filename, pdf_limpio)], error).
+    """
+    from core.perseo_remove import limpiar_perseo_pdf_bytes
+    from services.xml_processor import iter_parsed_documents
+
+    try:
+        with open(os.path.join(input_dir, xml_rel_path), 'rb') as f:
+            xml_bytes = f.read()
+        prepared = []
+        documents = iter_parsed_documents(xml_bytes, os.path.basename(xml_rel_path))
+        for xml_filename, content, xml_data, xml_root in documents:
+            pdf_filename, pdf_limpio = "", None
+            pdf_rel_path = _find_pdf(xml_rel_path, xml_data.clave_acceso)
+            if pdf_rel_path:
+                with open(os.path.join(input_dir, pdf_rel_path), 'rb') as f:
+                    pdf_limpio = limpiar_perseo_pdf_bytes(f.read())
+                pdf_filename = os.path.basename(pdf_rel_path)
+            elif settings.RIDE_ENABLED:
+                # XML sin PDF: el RIDE se genera aquí, en el pool de procesos
+                from core.pdf import generar_ride
+                pdf_limpio = generar_ride(xml_root, xml_data)
+                pdf_filename = f"RIDE_{xml_data.clave_acceso or os.path.splitext(xml_filename)[0]}.pdf"
+            prepared.append((xml_filename, bytes(content), xml_data, pdf_filename, pdf_limpio))
+        if not prepared:
+            return xml_rel_path, [], "No se pudo extraer datos del XML"
+        return xml_rel_path, prepared, ""
+    except Exception as e:
+        return xml_rel_path, [], str(e)
+
+
+class BatchCheckpoint:
+    """
+    Registro append-only de los XML ya entregados, para retomar un backfill interrumpido.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.done: Set[str] = set()
+        # Fallidos de esta ejecución: no se reintentan en cada pasada del modo --watch
+        self.failed: Set[str] = set()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        self.done.add(json.loads(line)['xml'])
+                    except (ValueError, KeyError):
+                        continue
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def mark(self, xml_rel_path: str, clave_acceso: str = "") -> None:
+        self.done.add(xml_rel_path)
+        self._file.write(json.dumps({"xml": xml_rel_path, "clave_acceso": clave_acceso,
+                                     "fecha": time.strftime('%Y-%m-%d %H:%M:%S')}) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class _DirectoryWatcher:
+    """
+    Espera cambios en la carpeta con inotify (paquete opcional inotify_simple);
+    si no está disponible, espera el intervalo de sondeo.
+    """
+
+    def __init__(self, input_dir: str):
+        self._inotify = None
+        try:
+            from inotify_simple import INotify, flags
+            self._inotify = INotify()
+            self._inotify.add_watch(input_dir, flags.CLOSE_WRITE | flags.MOVED_TO)
+            logger.info(f"Vigilando {input_dir} con inotify")
+        except ImportError:
+            logger.info(f"inotify_simple no instalado, vigilando {input_dir} por sondeo")
+        except OSError as e:
+            logger.warning(f"No se pudo usar inotify en {input_dir} ({e}), vigilando por sondeo")
+
+    def wait(self, timeout: float) -> None:
+        if self._inotify is None:
+            time.sleep(timeout)
+            return
+        if self._inotify.read(timeout=int(timeout * 1000)):
+            # Dar tiempo a que llegue la pareja XML/PDF del mismo comprobante
+            time.sleep(settings.BATCH_SETTLE_SECONDS)
+
+
+def run_batch(processor, input_dir: str, workers: Optional[int] = None, watch: bool = False,
+              poll_interval: int = 30, checkpoint_path: Optional[str] = None) -> dict:
+    """
+    Entrega por lotes los XML (y sus PDFs) de una carpeta: parseo y limpieza de PDFs en un
+    pool de procesos, envío con las plantillas y send_email del servicio, y checkpoint de avance.
+    """
+    if not os.path.isdir(input_dir):
+        raise FileNotFoundError(f"No se encontró la carpeta de entrada: {input_dir}")
+
+    workers = max(1, workers or os.cpu_count() or 1)
+    checkpoint = BatchCheckpoint(checkpoint_path or settings.BATCH_CHECKPOINT_FILE
+                                 or os.path.join(input_dir, '.batch_checkpoint'))
+    stats = {'total': 0, 'ok': 0, 'failed': 0, 'skipped': 0, 'errors': []}
+    logger.info(f"=== MODO BATCH - Carpeta: {input_dir}, workers: {workers}, "
+                f"{len(checkpoint.done)} XML ya entregados según checkpoint ===")
+
+    watcher = _DirectoryWatcher(input_dir) if watch else None
+    started = time.monotonic()
+    try:
+        while True:
+            _run_batch_pass(processor, input_dir, workers, checkpoint, stats, settle=watch)
+            if not watcher:
+                break
+            watcher.wait(poll_interval)
+    except KeyboardInterrupt:
+        logger.info("Modo batch interrumpido, el avance quedó registrado en el checkpoint")
+    finally:
+        checkpoint.close()
+        if processor.bundler:
+            processor.bundler.flush()
+        if processor.digest:
+            processor.digest.flush()
+
+    elapsed = time.monotonic() - started
+    logger.info(f"=== BATCH COMPLETADO: {stats['total']} XML, {stats['ok']} entregados, "
+                f"{stats['failed']} con error, {stats['skipped']} omitidos por checkpoint, {elapsed:.1f}s ===")
+    for error in stats['errors']:
+        logger.warning(f"   - {error}")
+    return stats
+
+
+def _run_batch_pass(processor, input_dir: str, workers: int, checkpoint: BatchCheckpoint,
+                    stats: dict, settle: bool = False) -> None:
+    """
+    Procesa todos los XML pendientes encontrados en una pasada por la carpeta.
+    """
+    from core.attachment import Attachment
+    from core.document import ElectronicDocument
+
+    xml_files, pdf_index = scan_input_dir(input_dir, settings.BATCH_SETTLE_SECONDS if settle else 0)
+    pending_files = [path for path in xml_files if path not in checkpoint.done and path not in checkpoint.failed]
+    if not settle:
+        stats['skipped'] += len(xml_files) - len(pending_files)
+    if not pending_files:
+        return
+    logger.info(f"XML pendientes en {input_dir}: {len(pending_files)}")
+
+    lock = threading.Lock()
+
+    def deliver(result) -> None:
+        xml_rel_path, prepared, error = result
+        ok = not error
+        for xml_filename, xml_bytes, xml_data, pdf_filename, pdf_limpio in prepared:
+            document = ElectronicDocument(xml_filename, Attachment.from_bytes(xml_filename, xml_bytes, 'application/xml'), xml_data)
+            if pdf_limpio is not None:
+                document.pdfs.append(Attachment.from_bytes(pdf_filename, pdf_limpio, 'application/pdf'))
+            adjuntos = [xml_filename] + ([pdf_filename] if pdf_filename else [])
+            try:
+                # Los PDFs ya vienen limpios desde el worker
+                ok = processor.deliver_document(document, f"Carpeta: {input_dir}", f"Ingreso por lotes: {xml_rel_path}",
+                                                adjuntos, clean_pdfs=False) and ok
+            finally:
+                document.xml_attachment.close()
+                for pdf in document.pdfs:
+                    pdf.close()
+        with lock:
+            stats['total'] += 1
+            if ok:
+                stats['ok'] += 1
+                checkpoint.mark(xml_rel_path, prepared[0][2].clave_acceso)
+            else:
+                stats['failed'] += 1
+                checkpoint.failed.add(xml_rel_path)
+                stats['errors'].append(f"{xml_rel_path}: {error or 'error de envío'}")
+
+    delivery_workers = max(1, settings.DELIVERY_WORKERS)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(pdf_index,)) as pool, \
+            ThreadPoolExecutor(max_workers=delivery_workers) as senders:
+        preparing, sending = set(), set()
+
+        def send(done) -> None:
+            nonlocal sending
+            for future in done:
+                sending.add(senders.submit(deliver, future.result()))
+            # Contrapresión: no acumular PDFs limpios más rápido de lo que se envían
+            while len(sending) >= delivery_workers * _IN_FLIGHT_PER_WORKER:
+                finished, sending = wait(sending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+
+        for xml_rel_path in pending_files:
+            preparing.add(pool.submit(_prepare_xml, input_dir, xml_rel_path))
+            if len(preparing) >= workers * _IN_FLIGHT_PER_WORKER:
+                done, preparing = wait(preparing, return_when=FIRST_COMPLETED)
+                send(done)
+        send(wait(preparing)[0])
+        for future in wait(sending)[0]:
+            future.result()
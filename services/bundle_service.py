@@ -0,0 +1,279 @@
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections.abc import Mapping
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from config import settings
+from core.attachment import Attachment
+from core.document import DocumentContext
+from core.logger import logger
+from core.window_buffer import WindowBuffer
+from services.templates_service import TemplatesService
+
+# (carpeta en el spool o None, contexto del documento, copias de sus adjuntos) de cada documento agrupado
+BundleItem = Tuple[Optional[str], Mapping, List[Attachment]]
+
+
+class _Bundle:
+    """
+    Documentos pendientes para un mismo destinatario y el tamaño total de sus adjuntos.
+    """
+
+    def __init__(self, max_items: int, window_seconds: float):
+        self.buffer = WindowBuffer(max_items, window_seconds)
+        self.size = 0
+
+
+class _BundleSpool:
+    """
+    Copia en disco de los documentos que esperan en un email agrupado, para que un reinicio
+    no los pierda: cada documento es una carpeta con su contexto y sus adjuntos, que se borra
+    recién cuando el email se envió. Cada proceso escribe en una sesión propia, bloqueada
+    mientras vive; al iniciar se adoptan los documentos de las sesiones cuyo proceso terminó.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.session = os.path.join(directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(self.session, exist_ok=True)
+        self._lock_file = open(os.path.join(self.session, "lock"), "w")
+        _try_lock(self._lock_file)
+
+    def save(self, recipient: str, context: DocumentContext, attachments: List[Attachment]) -> str:
+        """
+        Guarda un documento y retorna su carpeta. Se escribe en una carpeta temporal que se
+        renombra al final: una carpeta sin .tmp siempre está completa.
+        """
+        entry = os.path.join(self.session, uuid.uuid4().hex)
+        temp = entry + ".tmp"
+        os.makedirs(temp)
+        files = []
+        for n, attachment in enumerate(attachments):
+            with open(os.path.join(temp, f"{n:02d}"), "wb") as f:
+                f.write(attachment.view())
+            files.append({"filename": attachment.filename, "content_type": attachment.content_type})
+        with open(os.path.join(temp, "documento.json"), "w", encoding="utf-8") as f:
+            json.dump({"recipient": recipient, "context": context.dump(), "files": files},
+                      f, ensure_ascii=False, default=str)
+        os.rename(temp, entry)
+        return entry
+
+    def remove(self, entry: Optional[str]) -> None:
+        if entry:
+            shutil.rmtree(entry, ignore_errors=True)
+
+    def recover(self) -> List[Tuple[str, BundleItem]]:
+        """
+        Adopta los documentos de las sesiones de procesos terminados y los retorna como
+        (destinatario, documento). Los que no se pueden leer quedan en disco y se reportan.
+        """
+        recovered = []
+        for name in sorted(os.listdir(self.directory)):
+            session = os.path.join(self.directory, name)
+            if session == self.session or not os.path.isdir(session):
+                continue
+            with open(os.path.join(session, "lock"), "a") as lock_file:
+                if not _try_lock(lock_file):
+                    continue  # el proceso dueño sigue vivo
+                for entry_name in sorted(os.listdir(session)):
+                    source = os.path.join(session, entry_name)
+                    if entry_name == "lock" or entry_name.endswith(".tmp") or not os.path.isdir(source):
+                        continue
+                    entry = os.path.join(self.session, entry_name)
+                    try:
+                        os.rename(source, entry)
+                        recovered.append(self._load(entry))
+                    except Exception as e:
+                        logger.error(f"No se pudo recuperar el documento agrupado {source}: {e}")
+            shutil.rmtree(session, ignore_errors=True)
+        return recovered
+
+    def _load(self, entry: str) -> Tuple[str, BundleItem]:
+        with open(os.path.join(entry, "documento.json"), encoding="utf-8") as f:
+            data = json.load(f)
+        copies = []
+        for n, info in enumerate(data["files"]):
+            with open(os.path.join(entry, f"{n:02d}"), "rb") as f:
+                copies.append(Attachment.from_bytes(info["filename"], f.read(), info["content_type"]))
+        return data["recipient"], (entry, DocumentContext.load(data["context"]), copies)
+
+
+def _try_lock(f) -> bool:
+    """
+    Bloqueo exclusivo sin espera de una sesión del spool (se libera al terminar el proceso).
+    Sin fcntl (Windows) no hay bloqueo: las sesiones de otros procesos se consideran terminadas.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return True
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+class ClientBundler:
+    """
+    Agrupa los emails de cliente por destinatario (email_destinatario del XML): los documentos
+    que llegan dentro de la ventana de tiempo se envían en un único email con una tabla
+    resumen (bundle_template.html) y todos sus XML y PDFs, hasta BUNDLE_MAX_DOCUMENTS
+    documentos o BUNDLE_MAX_MB de adjuntos por email. Mientras esperan, los documentos
+    quedan también en BUNDLE_SPOOL_DIR; si un envío falla se reintentan en la ventana siguiente.
+    """
+
+    def __init__(self, email_service, max_items: int = settings.BUNDLE_MAX_DOCUMENTS,
+                 window_seconds: float = settings.BUNDLE_WINDOW_MINUTES * 60,
+                 max_bytes: int = settings.BUNDLE_MAX_MB * 1024 * 1024):
+        self.email_service = email_service
+        self.max_items = max(1, int(max_items))
+        self.window_seconds = window_seconds
+        self.max_bytes = max_bytes
+        self._bundles: Dict[str, _Bundle] = {}
+        # Emails que fallaron o se recuperaron del spool: (hora de reintento, destinatario, documentos)
+        self._retries: List[Tuple[float, str, List[BundleItem]]] = []
+        self._lock = threading.Lock()
+        self._spool: Optional[_BundleSpool] = None
+        # En dry-run no se usa el spool: un reinicio en producción enviaría esos documentos de verdad
+        if settings.BUNDLE_SPOOL_DIR and not getattr(email_service, "dry_run_dir", None):
+            self._spool = _BundleSpool(os.path.join(settings.BUNDLE_SPOOL_DIR, email_service.config.name))
+        logger.info(f"Agrupación de emails de cliente activa: ventana de {window_seconds / 60:g} min, "
+                    f"máximo {self.max_items} documentos o {max_bytes // (1024 * 1024)} MB por email")
+        if self._spool:
+            recovered = self._spool.recover()
+            if recovered:
+                logger.warning(f"♻️ {len(recovered)} documentos agrupados sin enviar recuperados de "
+                               f"{settings.BUNDLE_SPOOL_DIR}, se envían en la próxima revisión")
+            by_recipient: Dict[str, List[BundleItem]] = {}
+            for recipient, item in recovered:
+                by_recipient.setdefault(recipient, []).append(item)
+            self._retries = [(0.0, recipient, chunk) for recipient, items in by_recipient.items()
+                             for chunk in self._split(items)]
+
+    def add(self, recipient: str, context: Mapping, attachments: List[Attachment]) -> bool:
+        """
+        Agrega un documento al email pendiente del destinatario. Los adjuntos se copian (el
+        llamador puede cerrarlos) y se guardan en el spool antes de retornar. Si el documento
+        no cabe en el email pendiente, este se envía antes; si el email queda lleno se envía
+        de inmediato. Retorna False solo si no se pudo guardar el documento.
+        """
+        copies = [Attachment.from_bytes(att.filename, att.getvalue(), att.content_type) for att in attachments]
+        entry = None
+        if self._spool:
+            try:
+                entry = self._spool.save(recipient, context, copies)
+            except Exception as e:
+                logger.error(f"No se pudo guardar en el spool el documento para {recipient}: {e}")
+                for copy in copies:
+                    copy.close()
+                return False
+        size = sum(len(copy) for copy in copies)
+        ready: List[List[BundleItem]] = []
+        with self._lock:
+            bundle = self._bundles.get(recipient)
+            if bundle is not None and bundle.size + size > self.max_bytes and len(bundle.buffer):
+                # No cabe: se envía lo acumulado y el documento abre un email nuevo
+                ready.append(self._drain(recipient))
+                bundle = None
+            if bundle is None:
+                bundle = self._bundles[recipient] = _Bundle(self.max_items, self.window_seconds)
+            bundle.size += size
+            if bundle.buffer.add((entry, context, copies)) or bundle.size >= self.max_bytes:
+                ready.append(self._drain(recipient))
+        for items in ready:
+            self._send(recipient, items)
+        return True
+
+    def flush_if_due(self) -> None:
+        """
+        Envía los emails cuya ventana de tiempo ya expiró.
+        """
+        now = time.monotonic()
+        with self._lock:
+            ready = [(recipient, self._drain(recipient)) for recipient, bundle in list(self._bundles.items())
+                     if bundle.buffer.is_due()]
+            ready.extend((recipient, items) for retry_at, recipient, items in self._retries if retry_at <= now)
+            self._retries = [retry for retry in self._retries if retry[0] > now]
+        for recipient, items in ready:
+            self._send(recipient, items)
+
+    def flush(self) -> bool:
+        """
+        Envía todos los emails pendientes. Los que fallan quedan en el spool para el próximo inicio.
+        """
+        with self._lock:
+            ready = [(recipient, self._drain(recipient)) for recipient in list(self._bundles)]
+            ready.extend((recipient, items) for _, recipient, items in self._retries)
+            self._retries = []
+        return all([self._send(recipient, items, retry=False) for recipient, items in ready])
+
+    def _split(self, items: List[BundleItem]) -> List[List[BundleItem]]:
+        """
+        Reparte los documentos de un destinatario en emails dentro de los límites de cantidad y tamaño.
+        """
+        chunks: List[List[BundleItem]] = []
+        size = 0
+        for item in items:
+            item_size = sum(len(copy) for copy in item[2])
+            if not chunks or len(chunks[-1]) >= self.max_items or size + item_size > self.max_bytes:
+                chunks.append([])
+                size = 0
+            chunks[-1].append(item)
+            size += item_size
+        return chunks
+
+    def _drain(self, recipient: str) -> List[BundleItem]:
+        return self._bundles.pop(recipient).buffer.drain()
+
+    def _send(self, recipient: str, items: List[BundleItem], retry: bool = True) -> bool:
+        if not items:
+            return True
+        result = False
+        try:
+            attachments = [attachment for _, _, copies in items for attachment in copies]
+            documentos = [context for _, context, _ in items]
+            if len(items) == 1:
+                # Un solo documento en la ventana: el email de cliente de siempre
+                html = TemplatesService.render("webpos_template.html", documentos[0])
+                subject = "Su Documento Electrónico - WebPOS"
+            else:
+                html = TemplatesService.render("bundle_template.html", {
+                    "fecha_procesamiento": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+                    "razon_social": documentos[0]["razon_social"],
+                    "documentos": documentos,
+                    "total_documentos": len(documentos),
+                })
+                subject = f"Sus Documentos Electrónicos - WebPOS ({len(documentos)} documentos)"
+            logger.info(f"📬 Enviando {len(items)} documentos agrupados a {recipient}: "
+                        f"{[attachment.filename for attachment in attachments]}")
+            result = self.email_service.send_email(recipient, subject, html, attachments)
+            claves = [context["clave_acceso"] for context in documentos]
+            if result:
+                logger.info(f"Email agrupado enviado correctamente a {recipient} ({len(items)} documentos)")
+                for _, context, copies in items:
+                    self.email_service._archive_document(context["clave_acceso"] or context["xml_filename"], copies)
+            else:
+                logger.error(f"Error al enviar email agrupado a {recipient}. Claves incluidas: {claves}")
+            return result
+        except Exception as e:
+            logger.error(f"Error al enviar email agrupado a {recipient}: {e}")
+            return False
+        finally:
+            if result or not retry:
+                # Enviado, o al cerrar: los no enviados quedan en el spool para el próximo inicio
+                for entry, _, copies in items:
+                    if result and self._spool:
+                        self._spool.remove(entry)
+                    for attachment in copies:
+                        attachment.close()
+            else:
+                logger.warning(f"📬 {len(items)} documentos para {recipient} se reintentan en "
+                               f"{self.window_seconds / 60:g} min")
+                with self._lock:
+                    self._retries.append((time.monotonic() + self.window_seconds, recipient, items))
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections.abc import Mapping
+from datetime import datetime
+from typing import List
+
+from config import settings
+from core.logger import logger
+from core.window_buffer import WindowBuffer
+from services.templates_service import TemplatesService
+
+class ProcessingDigest:
+    """
+    Acumula los contextos de procesamiento y envía un único email resumen
+    (digest_template.html) por ventana de tiempo o al alcanzar el máximo de documentos.
+    """
+
+    def __init__(self, email_service, max_items: int = settings.DIGEST_MAX_ITEMS,
+                 window_seconds: int = settings.DIGEST_WINDOW_SECONDS):
+        self.email_service = email_service
+        self.buffer = WindowBuffer(max_items, window_seconds)
+        self.window_seconds = window_seconds
+        # Documentos de un resumen que no se pudo enviar: van en el siguiente, a más tardar en una ventana
+        self._failed: List[Mapping] = []
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+        logger.info(f"Modo digest activo: máximo {self.buffer.max_items} documentos o {window_seconds}s por resumen")
+
+    def add(self, context: Mapping) -> None:
+        """
+        Registra un documento procesado. Si el buffer se llena se envía el resumen.
+        Se guarda el contexto tal cual (DocumentContext es de solo lectura y no copia los datos del XML).
+        """
+        if self.buffer.add(context):
+            logger.info("Digest lleno, enviando resumen de procesamiento")
+            self.flush()
+
+    def flush_if_due(self) -> None:
+        """
+        Envía el resumen si la ventana de tiempo ya expiró o toca reintentar uno que falló.
+        """
+        with self._lock:
+            retry_due = bool(self._failed) and time.monotonic() >= self._retry_at
+        if retry_due or self.buffer.is_due():
+            self.flush()
+
+    def flush(self) -> bool:
+        """
+        Envía el resumen con todos los documentos acumulados, incluidos los de un resumen
+        anterior que falló. Si el envío falla, los documentos se reintentan en la próxima ventana.
+        """
+        with self._lock:
+            documentos: List[Mapping] = self._failed + self.buffer.drain()
+            self._failed = []
+        if not documentos:
+            return True
+
+        environment = self.email_service.environment
+        context = {
+            "fecha_procesamiento": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+            "entorno": environment,
+            "documentos": documentos,
+            "total_documentos": len(documentos),
+        }
+        html = TemplatesService.render("digest_template.html", context)
+        smtp_user = self.email_service.config.smtp_user
+        result = self.email_service.send_email(
+            smtp_user,
+            f"[{environment.upper()}] Resumen de procesamiento - {len(documentos)} documentos",
+            html,
+            add_confirmation_cc=False
+        )
+        if result:
+            logger.info(f"Resumen de procesamiento enviado a {smtp_user} ({len(documentos)} documentos)")
+        else:
+            claves = [doc["clave_acceso"] for doc in documentos]
+            logger.error(f"Error al enviar resumen de procesamiento a {smtp_user}. Claves incluidas: {claves}. "
+                         f"Se reintenta en {self.window_seconds}s")
+            with self._lock:
+                self._failed = documentos + self._failed
+                self._retry_at = time.monotonic() + self.window_seconds
+        return result
@@ -3,78 +3,322 @@ import smtplib
 import poplib
 import email
 import imaplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
+from email.parser import BytesFeedParser, BytesHeaderParser
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import Dict, Iterator, List, Tuple, Optional, Union
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import json
+import re
+import time
+import uuid
+import zlib
 
 from config import settings
-from core.logger import logger
+from core.logger import logger, cleanup_old_logs
 from core.email_config import EmailConfig
+from core.admission import get_memory_budget
+from core.archive_store import get_archive_store
+from core.circuit_breaker import CircuitOpen, get_circuit_breaker
+from core.message_index import get_message_index
+from core.metrics import stage_timings
+from core.outbound import OutboundMessage
+from core.poller import AdaptivePoller
+from core.profiling import install_profiler
+from core.rate_limiter import THROTTLE_CODES, get_smtp_limiter
+from core.scheduler import MessageScheduler, document_type_hint
+from core.watchdog import get_watchdog, shutdown_socket
+from core.sharding import in_shard
 from core.xml_data import XMLData
-from services.attachment_handler import extract_attachments
-from services.xml_processor import process_xml_file
+from services.attachment_handler import extract_attachments, may_contain_attachments
+from services.xml_processor import iter_parsed_documents
 from services.templates_service import render_processing_template, render_client_template, TemplatesService
-from core.perseo_remove import limpiar_perseo_pdf_bytes
+from services.digest_service import ProcessingDigest
+from services.bundle_service import ClientBundler
+from core.attachment import Attachment
+from core.document import DocumentContext, ElectronicDocument, pair_pdfs
+from core.uidl_state import UidlState
+
+# UIDs por comando al consultar tamaños con FETCH (RFC822.SIZE)
+_IMAP_FETCH_BATCH = 500
+_IMAP_UID_RE = re.compile(rb"UID (\d+)")
+_IMAP_SIZE_RE = re.compile(rb"RFC822\.SIZE (\d+)")
+_IMAP_FLAGS_RE = re.compile(rb"FLAGS \(([^)]*)\)")
+_IMAP_INDEX_HEADERS = 'BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID)]'
+_IMAP_DELIMITER_RE = re.compile(rb'\) "(\\?.)"')
+_IMAP_SCHEDULE_ITEMS = '(RFC822.SIZE INTERNALDATE BODYSTRUCTURE BODY.PEEK[HEADER.FIELDS (FROM)])'
+_IMAP_FILENAME_RE = re.compile(rb'"(?:FILE)?NAME" "([^"]*)"', re.I)
+
+# (remitente, hora de llegada epoch, nombres de los adjuntos) de un mensaje pendiente, para el scheduler
+ScheduleInfo = Tuple[str, Optional[float], List[str]]
+
+
+def _mail_deadline(name: str, conn):
+    """
+    Plazo total (MAIL_OPERATION_TIMEOUT) de una operación sobre una conexión IMAP, POP3 o
+    SMTP: al vencer, el watchdog corta el socket y la operación falla con DeadlineExceeded.
+    """
+    return get_watchdog().deadline(name, settings.MAIL_OPERATION_TIMEOUT,
+                                   lambda: shutdown_socket(getattr(conn, 'sock', None)))
+
+
+def _connection_failure(error: BaseException) -> bool:
+    """
+    Errores que cuentan para el circuit breaker: el servidor no respondió (conexión rechazada,
+    timeout, conexión cortada). Los rechazos del servidor (autenticación, 5xx) no cuentan.
+    """
+    if isinstance(error, smtplib.SMTPException) and not isinstance(error, smtplib.SMTPServerDisconnected):
+        return False
+    return isinstance(error, (OSError, EOFError, imaplib.IMAP4.abort))
+
+
+def _set_read_timeout(conn) -> None:
+    """
+    Timeout de cada lectura/escritura (MAIL_READ_TIMEOUT) una vez establecida la conexión.
+    """
+    sock = getattr(conn, 'sock', None)
+    if sock is not None and settings.MAIL_READ_TIMEOUT > 0:
+        sock.settimeout(settings.MAIL_READ_TIMEOUT)
+
+
+# Respuesta de STATUS: * STATUS INBOX (UNSEEN 3 UIDNEXT 120)
+_STATUS_RE = re.compile(rb"\b(UNSEEN|UIDNEXT)\s+(\d+)", re.IGNORECASE)
+
+
+def _imap_uid_set(uids: List[bytes]) -> str:
+    """
+    Conjunto de UIDs en formato IMAP compacto: [1, 2, 3, 7] -> "1:3,7".
+    """
+    ranges = []
+    for uid in sorted(int(uid) for uid in uids):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ",".join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+
+def _imap_quote(mailbox: str) -> str:
+    """
+    Nombre de carpeta como cadena IMAP entre comillas.
+    """
+    return '"' + mailbox.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def _expand_uid_set(uid_set: str) -> List[str]:
+    """
+    Inversa de _imap_uid_set: "1:3,7" -> ["1", "2", "3", "7"].
+    """
+    uids = []
+    for part in uid_set.split(","):
+        start, _, end = part.partition(":")
+        low, high = sorted((int(start), int(end or start)))
+        uids.extend(str(uid) for uid in range(low, high + 1))
+    return uids
+
 
 class EmailXMLProcessor:
-    def __init__(self):
-        self.config = self._load_config()
+    def __init__(self, dry_run_dir: Optional[str] = None, account: Optional[EmailConfig] = None):
+        # Sin cuenta explícita se usa la configurada en las variables de entorno
+        self.config = account or self._load_config()
         self.environment = settings.ENVIRONMENT
         self.test_email = settings.TEST_EMAIL
-        self.attachments_dir = Path("attachments")
-        self.attachments_dir.mkdir(exist_ok=True)
-        logger.info(f"Servicio iniciado en modo: {self.environment}")
+        self._attachments_dir = Path("attachments")
+        # En dry-run los emails se escriben como .eml en esta carpeta en lugar de enviarse
+        self.dry_run_dir = Path(dry_run_dir) if dry_run_dir else None
+        if self.dry_run_dir:
+            self.dry_run_dir.mkdir(parents=True, exist_ok=True)
+        account_label = f", cuenta: {self.config.name}" if account else ""
+        logger.info(f"Servicio iniciado en modo: {self.environment}{account_label}{' (dry-run)' if self.dry_run_dir else ''}")
         self.email_service = self
+        self.digest = ProcessingDigest(self) if settings.DIGEST_ENABLED else None
+        # Emails de cliente agrupados por destinatario (BUNDLE_WINDOW_MINUTES = 0 desactiva)
+        self.bundler = ClientBundler(self) if settings.BUNDLE_WINDOW_MINUTES > 0 else None
+        # Carpetas de archivo ya creadas en el servidor -> nombre con el separador del servidor
+        self._imap_folders = {}
+        # (uid, procesado) de los emails que no se pudieron mover por una conexión cortada
+        self._pending_moves: List[Tuple[bytes, bool]] = []
+        # Sesión IMAP que queda abierta entre revisiones para STATUS (POLL_STATUS_CHECK) y el
+        # (UNSEEN, UIDNEXT) de INBOX tras la última revisión completa
+        self._status_conn: Optional[imaplib.IMAP4] = None
+        self._inbox_status: Optional[Tuple[int, int]] = None
+        self._last_full_check = 0.0
+        install_profiler(self)
+
+    @property
+    def attachments_dir(self) -> Path:
+        """
+        Carpeta de adjuntos, creada en el primer uso.
+        """
+        self._attachments_dir.mkdir(exist_ok=True)
+        return self._attachments_dir
 
     def _load_config(self) -> EmailConfig:
-        return EmailConfig(
-            pop_server=settings.POP_SERVER,
-            pop_port=settings.POP_PORT,
-            pop_user=settings.POP_USER,
-            pop_password=settings.POP_PASSWORD,
-            smtp_server=settings.SMTP_SERVER,
-            smtp_port=settings.SMTP_PORT,
-            smtp_user=settings.SMTP_USER,
-            smtp_password=settings.SMTP_PASSWORD,
-            smtp_use_ssl=settings.SMTP_USE_SSL
-        )
+        return EmailConfig.from_settings()
 
     def connect_pop(self) -> poplib.POP3:
+        breaker = get_circuit_breaker('pop3', self.config.pop_server, self.config.pop_port)
         try:
-            pop_conn = poplib.POP3(self.config.pop_server, self.config.pop_port)
-            pop_conn.user(self.config.pop_user)
-            pop_conn.pass_(self.config.pop_password)
+            with breaker.guard(_connection_failure):
+                pop_conn = poplib.POP3(self.config.pop_server, self.config.pop_port,
+                                       timeout=settings.MAIL_CONNECT_TIMEOUT or None)
+                _set_read_timeout(pop_conn)
+                with _mail_deadline("pop3 conexión", pop_conn):
+                    pop_conn.user(self.config.pop_user)
+                    pop_conn.pass_(self.config.pop_password)
             return pop_conn
+        except CircuitOpen:
+            raise
         except Exception as e:
             logger.error(f"Error conectando a POP3: {e}")
             raise
 
     def get_unread_emails(self) -> List[email.message.Message]:
+        """
+        Descarga los mensajes POP3 nuevos (UIDL no registrados) y los marca como vistos.
+        """
         pop_conn = self.connect_pop()
+        state = UidlState(self.config.pop_uidl_state_file)
         emails = []
         try:
-            num_messages = len(pop_conn.list()[1])
-            logger.info(f"Total de mensajes en el buzón: {num_messages}")
-            for i in range(1, num_messages + 1):
-                raw_email = b"\n".join(pop_conn.retr(i)[1])
-                email_message = email.message_from_bytes(raw_email)
-                emails.append(email_message)
+            for uid, num, _, _ in self._iter_new_pop_messages(pop_conn, state):
+                emails.append(self._retr_pop_message(pop_conn, num))
+                state.add(uid)
         finally:
             pop_conn.quit()
         return emails
 
+    def process_pop_mailbox(self) -> int:
+        """
+        Procesa los mensajes POP3 nuevos uno a uno, sin mantenerlos todos en memoria.
+        Los que exceden el presupuesto de memoria se procesan con los adjuntos volcados a disco.
+        Con POP_DELETE_AFTER_DELIVERY los entregados se borran (DELE) al cerrar la sesión.
+        Con SCHEDULER_ENABLED se procesan en el orden del scheduler (prioridad, tamaño, antigüedad).
+        Retorna la cantidad de mensajes procesados.
+        """
+        pop_conn = self.connect_pop()
+        state = UidlState(self.config.pop_uidl_state_file)
+        budget = get_memory_budget()
+        processed = 0
+        try:
+            messages = self._iter_new_pop_messages(pop_conn, state)
+            if settings.SCHEDULER_ENABLED:
+                messages = self._schedule_pop(messages)
+            for uid, num, size, _ in messages:
+                processed += 1
+                logger.info(f"Procesando email POP3 #{processed} (UIDL {uid}, {size} bytes)")
+                cost = budget.estimate(size)
+                try:
+                    # Se reserva antes de descargar el cuerpo
+                    with budget.reserve(cost):
+                        email_message = self._retr_pop_message(pop_conn, num)
+                        ok = self.process_single_email(email_message, 0 if budget.is_oversized(cost) else None)
+                except Exception as e:
+                    logger.error(f"Error procesando email POP3 {uid}: {e}")
+                    ok = False
+                # Como el \Seen de IMAP: el mensaje no se vuelve a descargar aunque haya fallado
+                state.add(uid)
+                if ok and settings.POP_DELETE_AFTER_DELIVERY:
+                    pop_conn.dele(num)
+                    logger.info(f"🗑️ Email POP3 {uid} marcado para borrar")
+        finally:
+            # QUIT confirma los DELE; si la sesión se corta, el servidor los descarta
+            pop_conn.quit()
+        return processed
+
+    def _iter_new_pop_messages(self, pop_conn: poplib.POP3,
+                               state: UidlState) -> Iterator[Tuple[str, int, int, email.message.Message]]:
+        """
+        Genera (uidl, número, tamaño, encabezados) de los mensajes aún no procesados, para descargarlos con RETR. Antes de descargar
+        un cuerpo se revisan sus encabezados con TOP n 0; los que no pueden traer adjuntos
+        se registran como vistos sin descargarse.
+        """
+        with _mail_deadline("pop3 búsqueda", pop_conn):
+            uidl_entries = pop_conn.uidl()[1]
+            list_entries = pop_conn.list()[1]
+        uidls = {}
+        for entry in uidl_entries:
+            num, uid = entry.decode('ascii', 'replace').split(None, 1)
+            uidls[uid] = int(num)
+        removed = state.compact(uidls)
+        if removed:
+            logger.info(f"UIDL ya borrados del servidor descartados del estado: {removed}")
+
+        sizes = {}
+        for entry in list_entries:
+            num, size = entry.split()[:2]
+            sizes[int(num)] = int(size)
+
+        new_messages = sorted((num, uid) for uid, num in uidls.items()
+                              if uid not in state and in_shard(zlib.crc32(uid.encode())))
+        logger.info(f"Total de mensajes en el buzón: {len(uidls)}, nuevos: {len(new_messages)}")
+        for num, uid in new_messages:
+            headers = BytesHeaderParser().parsebytes(b"\n".join(pop_conn.top(num, 0)[1]))
+            if not may_contain_attachments(headers):
+                logger.info(f"⏭️  Email POP3 {uid} omitido sin descargar: {headers.get('Subject', 'Sin asunto')} "
+                            f"({headers.get_content_type()})")
+                state.add(uid)
+                continue
+            yield uid, num, sizes.get(num, 0), headers
+
+    @staticmethod
+    def _schedule_pop(messages: Iterator[Tuple[str, int, int, email.message.Message]]
+                      ) -> Iterator[Tuple[str, int, int, email.message.Message]]:
+        """
+        Ordena los mensajes POP3 nuevos con el scheduler. POP3 no informa la hora de llegada
+        ni los adjuntos antes de descargar: se usan el encabezado Date y el remitente.
+        """
+        scheduler = MessageScheduler.from_settings()
+        for message in messages:
+            headers = message[3]
+            try:
+                received_at = parsedate_to_datetime(headers.get('Date')).timestamp()
+            except (TypeError, ValueError):
+                received_at = None
+            scheduler.push(message, message[2], headers.get('From', ''), received_at)
+        while scheduler:
+            yield scheduler.pop()
+
+    @staticmethod
+    def _retr_pop_message(pop_conn: poplib.POP3, num: int) -> email.message.Message:
+        """
+        Descarga un mensaje con RETR pasando cada línea al parser a medida que llega,
+        en lugar de acumular la lista de líneas y unirlas en un solo bloque de bytes.
+        """
+        # poplib.retr() siempre acumula las líneas; se usa su protocolo de bajo nivel
+        with stage_timings.stage("descarga"), _mail_deadline("pop3 descarga", pop_conn):
+            pop_conn._putcmd(f'RETR {num}')
+            pop_conn._getresp()
+            parser = BytesFeedParser()
+            line, _ = pop_conn._getline()
+            while line != b'.':
+                if line.startswith(b'..'):
+                    line = line[1:]
+                parser.feed(line + b"\n")
+                line, _ = pop_conn._getline()
+            return parser.close()
+
     def connect_imap(self) -> imaplib.IMAP4_SSL:
+        breaker = get_circuit_breaker('imap', self.config.imap_server, self.config.imap_port)
         try:
-            if settings.IMAP_USE_SSL:
-                imap_conn = imaplib.IMAP4_SSL(settings.IMAP_SERVER, settings.IMAP_PORT)
-            else:
-                imap_conn = imaplib.IMAP4(settings.IMAP_SERVER, settings.IMAP_PORT)
-            imap_conn.login(settings.IMAP_USER, settings.IMAP_PASSWORD)
+            with breaker.guard(_connection_failure):
+                if self.config.imap_use_ssl:
+                    imap_conn = imaplib.IMAP4_SSL(self.config.imap_server, self.config.imap_port,
+                                                  timeout=settings.MAIL_CONNECT_TIMEOUT or None)
+                else:
+                    imap_conn = imaplib.IMAP4(self.config.imap_server, self.config.imap_port,
+                                              timeout=settings.MAIL_CONNECT_TIMEOUT or None)
+                _set_read_timeout(imap_conn)
+                with _mail_deadline("imap conexión", imap_conn):
+                    imap_conn.login(self.config.imap_user, self.config.imap_password)
+                    # Tras el login el servidor puede anunciar más capacidades (MOVE, UIDPLUS, CONDSTORE...)
+                    typ, data = imap_conn.capability()
+            if typ == 'OK' and data and data[-1]:
+                imap_conn.capabilities = tuple(data[-1].decode('ascii', 'ignore').upper().split())
             return imap_conn
+        except CircuitOpen:
+            raise
         except Exception as e:
             logger.error(f"Error conectando a IMAP: {e}")
             raise
@@ -83,20 +327,350 @@ class EmailXMLProcessor:
         imap_conn = self.connect_imap()
         emails = []
         try:
-            imap_conn.select('INBOX')
-            typ, data = imap_conn.search(None, 'UNSEEN')
-            for num in data[0].split():
-                typ, msg_data = imap_conn.fetch(num, '(RFC822)')
-                raw_email = msg_data[0][1]
-                email_message = email.message_from_bytes(raw_email)
-                emails.append(email_message)
-                imap_conn.store(num, '+FLAGS', '\\Seen')
+            self._select_inbox(imap_conn)
+            for uid, _ in self._search_unseen_imap(imap_conn):
+                email_message = self._fetch_imap_message(imap_conn, uid)
+                if email_message is not None:
+                    emails.append(email_message)
         finally:
             imap_conn.logout()
         return emails
 
+    def _search_unseen_imap(self, imap_conn: imaplib.IMAP4,
+                            details: Optional[Dict[bytes, ScheduleInfo]] = None) -> List[Tuple[bytes, int]]:
+        """
+        Retorna (uid, tamaño RFC822) de los mensajes no leídos de este shard, sin descargarlos.
+        Con `details` también consulta, en el mismo FETCH, remitente, INTERNALDATE y nombres
+        de los adjuntos (BODYSTRUCTURE) para el scheduler.
+        """
+        # Comandos por UID: estables entre sesiones, permiten repartir el buzón entre réplicas
+        typ, data = imap_conn.uid('SEARCH', None, 'UNSEEN')
+        uids = [uid for uid in data[0].split() if in_shard(int(uid))]
+        if settings.SHARD_COUNT > 1:
+            logger.info(f"Shard {settings.SHARD_INDEX}/{settings.SHARD_COUNT}: {len(uids)} de {len(data[0].split())} no leídos")
+
+        sizes = {}
+        for start in range(0, len(uids), _IMAP_FETCH_BATCH):
+            chunk = b",".join(uids[start:start + _IMAP_FETCH_BATCH])
+            if details is not None:
+                typ, data = imap_conn.uid('FETCH', chunk, _IMAP_SCHEDULE_ITEMS)
+                for response, headers in self._iter_fetch_literals(data):
+                    uid_match = _IMAP_UID_RE.search(response)
+                    size_match = _IMAP_SIZE_RE.search(response)
+                    if not uid_match or not size_match:
+                        continue
+                    sizes[uid_match.group(1)] = int(size_match.group(1))
+                    received = imaplib.Internaldate2tuple(response)
+                    details[uid_match.group(1)] = (
+                        BytesHeaderParser().parsebytes(headers).get('From', ''),
+                        time.mktime(received) if received else None,
+                        [name.decode('utf-8', 'replace') for name in _IMAP_FILENAME_RE.findall(response)]
+                    )
+                continue
+            typ, data = imap_conn.uid('FETCH', chunk, '(RFC822.SIZE)')
+            for item in data or []:
+                response = item[0] if isinstance(item, tuple) else item
+                uid_match = _IMAP_UID_RE.search(response or b"")
+                size_match = _IMAP_SIZE_RE.search(response or b"")
+                if uid_match and size_match:
+                    sizes[uid_match.group(1)] = int(size_match.group(1))
+        return [(uid, sizes.get(uid, 0)) for uid in uids]
+
+    def _fetch_imap_message(self, imap_conn: imaplib.IMAP4, uid: bytes) -> Optional[email.message.Message]:
+        """
+        Descarga un mensaje por UID y lo marca como leído.
+        """
+        with stage_timings.stage("descarga"), _mail_deadline("imap descarga", imap_conn):
+            typ, msg_data = imap_conn.uid('FETCH', uid, '(RFC822)')
+            if not msg_data or not isinstance(msg_data[0], tuple):
+                # Otro proceso lo movió o borró entre SEARCH y FETCH
+                return None
+            imap_conn.uid('STORE', uid, '+FLAGS', '\\Seen')
+        return email.message_from_bytes(msg_data[0][1])
+
+    def process_imap_mailbox(self) -> int:
+        """
+        Procesa los mensajes IMAP no leídos con MESSAGE_WORKERS hilos. Cada descarga espera
+        a que el presupuesto de memoria (MEMORY_BUDGET_MB) tenga espacio para el mensaje; los
+        mensajes que lo exceden se procesan solos, con los adjuntos volcados a disco.
+        Con SCHEDULER_ENABLED se descargan en el orden del scheduler en lugar del orden del buzón.
+        Al terminar, aunque la revisión se haya cortado a la mitad, los emails procesados se
+        mueven en bloque a las carpetas de archivo.
+        Retorna la cantidad de mensajes procesados.
+        """
+        budget = get_memory_budget()
+        imap_conn = self.connect_imap()
+        processed = 0
+        outcomes = []
+        try:
+            details = {} if settings.SCHEDULER_ENABLED else None
+            # La sincronización del índice lleva plazos propios por tanda, fuera del de la búsqueda
+            self._select_inbox(imap_conn)
+            if self._pending_moves:
+                # Movidas que no se pudieron hacer porque se cortó la conexión en la revisión anterior
+                pending_moves, self._pending_moves = self._pending_moves, []
+                self._archive_imap(imap_conn, pending_moves)
+            with _mail_deadline("imap búsqueda", imap_conn):
+                pending = self._search_unseen_imap(imap_conn, details)
+            logger.info(f"Correos no leídos encontrados: {len(pending)}")
+            order = self._iter_scheduled_imap(imap_conn, pending, details) if details is not None else pending
+            with ThreadPoolExecutor(max_workers=max(1, settings.MESSAGE_WORKERS)) as executor:
+                for uid, size in order:
+                    cost = budget.estimate(size)
+                    oversized = budget.is_oversized(cost)
+                    reserved = budget.acquire(cost)
+                    try:
+                        email_message = self._fetch_imap_message(imap_conn, uid)
+                    except Exception:
+                        budget.release(reserved)
+                        raise
+                    if email_message is None:
+                        budget.release(reserved)
+                        continue
+                    processed += 1
+                    logger.info(f"Procesando email #{processed} de {len(pending)} (UID {uid.decode()}, {size} bytes)")
+                    if oversized:
+                        logger.warning(f"Email UID {uid.decode()} excede el presupuesto de memoria, "
+                                       f"se procesa en modo exclusivo con adjuntos en disco")
+                        try:
+                            outcomes.append((uid, self._process_admitted(email_message, spool_threshold=0)))
+                        finally:
+                            budget.release(reserved)
+                        continue
+                    future = executor.submit(self._process_admitted, email_message)
+                    future.add_done_callback(lambda _, reserved=reserved: budget.release(reserved))
+                    outcomes.append((uid, future))
+        finally:
+            # Al salir del executor todos los emails terminaron (también si hubo una excepción):
+            # se archivan en bloque. Ya quedaron \Seen, la próxima búsqueda (UNSEEN) no los vería
+            try:
+                self._archive_imap(imap_conn, [(uid, outcome if isinstance(outcome, bool) else outcome.result())
+                                               for uid, outcome in outcomes])
+            finally:
+                imap_conn.logout()
+        return processed
+
+    def _iter_scheduled_imap(self, imap_conn: imaplib.IMAP4, pending: List[Tuple[bytes, int]],
+                             details: Dict[bytes, ScheduleInfo]) -> Iterator[Tuple[bytes, int]]:
+        """
+        Genera los mensajes pendientes en el orden del scheduler. Mientras queden en cola,
+        cada SCHEDULER_RESCAN_SECONDS se buscan los que llegaron después (se agregan a
+        `pending`), para que un documento urgente no espere a que termine una cola larga.
+        """
+        scheduler = MessageScheduler.from_settings()
+        queued = set()
+
+        def enqueue(messages: List[Tuple[bytes, int]]) -> int:
+            added = 0
+            for uid, size in messages:
+                if uid in queued:
+                    continue
+                queued.add(uid)
+                sender, received_at, filenames = details.get(uid, ("", None, []))
+                scheduler.push((uid, size), size, sender, received_at, document_type_hint(filenames))
+                added += 1
+            return added
+
+        enqueue(pending)
+        rescan_at = time.monotonic() + settings.SCHEDULER_RESCAN_SECONDS
+        while scheduler:
+            if settings.SCHEDULER_RESCAN_SECONDS > 0 and time.monotonic() >= rescan_at:
+                with _mail_deadline("imap búsqueda", imap_conn):
+                    arrived = [message for message in self._search_unseen_imap(imap_conn, details)
+                               if message[0] not in queued]
+                if enqueue(arrived):
+                    pending.extend(arrived)
+                    logger.info(f"Correos nuevos agregados a la cola: {len(arrived)} ({len(scheduler)} en cola)")
+                rescan_at = time.monotonic() + settings.SCHEDULER_RESCAN_SECONDS
+            yield scheduler.pop()
+
+    def _archive_imap(self, imap_conn: imaplib.IMAP4, outcomes: List[Tuple[bytes, bool]]) -> None:
+        """
+        Mueve los emails procesados a IMAP_PROCESSED_FOLDER y los fallidos a IMAP_ERROR_FOLDER,
+        un comando por carpeta (y por cada _IMAP_FETCH_BATCH UIDs) en lugar de uno por email.
+        """
+        processed_folder = datetime.now().strftime(settings.IMAP_PROCESSED_FOLDER) if settings.IMAP_PROCESSED_FOLDER else ""
+        targets = {}
+        for uid, ok in outcomes:
+            folder = processed_folder if ok else settings.IMAP_ERROR_FOLDER
+            if folder:
+                targets.setdefault(folder, []).append(uid)
+        for folder, uids in targets.items():
+            try:
+                with _mail_deadline("imap archivo", imap_conn):
+                    self._move_imap(imap_conn, uids, folder)
+                logger.info(f"📦 {len(uids)} emails movidos a {folder}")
+            except Exception as e:
+                logger.error(f"Error moviendo {len(uids)} emails a {folder}: {e}")
+                if _connection_failure(e):
+                    # Conexión cortada: se reintenta al inicio de la próxima revisión
+                    self._pending_moves.extend((uid, folder == processed_folder) for uid in uids)
+                # Rechazada por el servidor: quedan en INBOX marcados como leídos
+
+    def _move_imap(self, imap_conn: imaplib.IMAP4, uids: List[bytes], folder: str) -> None:
+        """
+        UID MOVE de los mensajes a la carpeta; sin MOVE, COPY + \\Deleted + EXPUNGE
+        (UID EXPUNGE con UIDPLUS, para no borrar otros mensajes marcados). Con el índice
+        activo registra la nueva ubicación usando los UID de la respuesta COPYUID.
+        """
+        mailbox = self._imap_folder(imap_conn, folder)
+        index = get_message_index()
+        capabilities = imap_conn.capabilities
+        for start in range(0, len(uids), _IMAP_FETCH_BATCH):
+            chunk = uids[start:start + _IMAP_FETCH_BATCH]
+            uid_set = _imap_uid_set(chunk)
+            imap_conn.response('COPYUID')  # descarta respuestas COPYUID anteriores
+            if 'MOVE' in capabilities:
+                typ, data = imap_conn.uid('MOVE', uid_set, _imap_quote(mailbox))
+            else:
+                typ, data = imap_conn.uid('COPY', uid_set, _imap_quote(mailbox))
+                if typ == 'OK':
+                    imap_conn.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+                    if 'UIDPLUS' in capabilities:
+                        imap_conn.uid('EXPUNGE', uid_set)
+                    else:
+                        imap_conn.expunge()
+            if typ != 'OK':
+                raise imaplib.IMAP4.error(f"{typ} {data}")
+            if index is not None:
+                moved = dict.fromkeys(_expand_uid_set(uid_set))
+                for copyuid in imap_conn.response('COPYUID')[1]:
+                    parts = (copyuid or b'').decode('ascii', 'ignore').split()
+                    if len(parts) == 3:
+                        moved.update(zip(_expand_uid_set(parts[1]), _expand_uid_set(parts[2])))
+                index.relocate(self.config.name, 'INBOX', mailbox, moved.items())
+
+    def _imap_folder(self, imap_conn: imaplib.IMAP4, folder: str) -> str:
+        """
+        Nombre de la carpeta con el separador jerárquico del servidor, creándola la primera vez.
+        """
+        mailbox = self._imap_folders.get(folder)
+        if mailbox is None:
+            typ, data = imap_conn.list('""', '""')
+            delimiter_match = _IMAP_DELIMITER_RE.search(data[0] or b'') if typ == 'OK' and data else None
+            delimiter = delimiter_match.group(1).decode()[-1] if delimiter_match else '/'
+            mailbox = folder.replace('/', delimiter)
+            # NO si ya existe; las carpetas intermedias las crea el servidor
+            imap_conn.create(_imap_quote(mailbox))
+            self._imap_folders[folder] = mailbox
+        return mailbox
+
+    def _select_inbox(self, imap_conn: imaplib.IMAP4) -> None:
+        """
+        Selecciona INBOX y, con el índice de mensajes activo, lo sincroniza. Si el servidor
+        soporta CONDSTORE se habilita antes del SELECT para obtener HIGHESTMODSEQ.
+        """
+        index = get_message_index()
+        condstore = index is not None and 'CONDSTORE' in imap_conn.capabilities and 'ENABLE' in imap_conn.capabilities
+        with _mail_deadline("imap selección", imap_conn):
+            if condstore:
+                imap_conn.enable('CONDSTORE')
+            imap_conn.select('INBOX')
+        if index is None:
+            return
+        try:
+            with stage_timings.stage("indice"):
+                self._sync_index(imap_conn, index, condstore)
+        except Exception as e:
+            # El índice es auxiliar: un error al sincronizarlo no detiene el procesamiento
+            logger.error(f"Error sincronizando el índice de mensajes: {e}")
+
+    def _sync_index(self, imap_conn: imaplib.IMAP4, index, condstore: bool) -> None:
+        """
+        Indexa los encabezados de los mensajes con UID mayor al último indexado y, con
+        CONDSTORE, actualiza las flags de los que cambiaron desde el último HIGHESTMODSEQ.
+        Cada comando tiene su propio plazo: la primera sincronización de un buzón grande
+        puede tardar más que MAIL_OPERATION_TIMEOUT en total.
+        """
+        account, mailbox = self.config.name, 'INBOX'
+        uidvalidity = int((imap_conn.response('UIDVALIDITY')[1] or [b'0'])[-1] or 0)
+        highestmodseq = int((imap_conn.response('HIGHESTMODSEQ')[1] or [b'0'])[-1] or 0) if condstore else 0
+        known_validity, known_modseq, last_uid = index.get_sync_state(account, mailbox)
+        if known_validity and known_validity != uidvalidity:
+            logger.warning(f"UIDVALIDITY de {mailbox} cambió ({known_validity} -> {uidvalidity}), se reindexa el buzón")
+            index.reset_mailbox(account, mailbox)
+            known_modseq, last_uid = 0, 0
+
+        # Mensajes nuevos: solo encabezados, sin marcar como leídos
+        with _mail_deadline("imap índice", imap_conn):
+            typ, data = imap_conn.uid('SEARCH', None, f'UID {last_uid + 1}:*')
+        new_uids = [uid for uid in (data[0] or b'').split() if int(uid) > last_uid]
+        for start in range(0, len(new_uids), _IMAP_FETCH_BATCH):
+            with _mail_deadline("imap índice", imap_conn):
+                typ, data = imap_conn.uid('FETCH', b",".join(new_uids[start:start + _IMAP_FETCH_BATCH]),
+                                          f'(UID FLAGS {_IMAP_INDEX_HEADERS})')
+            for response, headers in self._iter_fetch_literals(data):
+                uid_match = _IMAP_UID_RE.search(response)
+                if not uid_match:
+                    continue
+                parsed = BytesHeaderParser().parsebytes(headers)
+                index.upsert_headers(account, mailbox, uid_match.group(1).decode(), parsed.get('Message-ID'),
+                                     parsed.get('From', ''), parsed.get('Subject', ''), parsed.get('Date', ''),
+                                     self._imap_flags(response))
+            # Avance guardado por tanda: una interrupción retoma desde aquí. El HIGHESTMODSEQ
+            # nuevo se guarda recién después de actualizar las flags
+            last_uid = max([last_uid] + [int(uid) for uid in new_uids[start:start + _IMAP_FETCH_BATCH]])
+            index.set_sync_state(account, mailbox, uidvalidity, known_modseq, last_uid)
+
+        # Cambios de flags en los ya indexados (leídos, marcados...) desde la última revisión
+        if condstore and known_modseq and last_uid and highestmodseq > known_modseq:
+            with _mail_deadline("imap índice", imap_conn):
+                typ, data = imap_conn.uid('FETCH', f'1:{last_uid}', f'(UID FLAGS) (CHANGEDSINCE {known_modseq})')
+            changes = []
+            for item in data or []:
+                response = item[0] if isinstance(item, tuple) else item
+                uid_match = _IMAP_UID_RE.search(response or b"")
+                if uid_match:
+                    changes.append((uid_match.group(1).decode(), self._imap_flags(response)))
+            index.update_flags(account, mailbox, changes)
+        index.set_sync_state(account, mailbox, uidvalidity, highestmodseq, last_uid)
+        if new_uids:
+            logger.info(f"Índice de mensajes: {len(new_uids)} nuevos en {mailbox} (último UID {last_uid})")
+
+    @staticmethod
+    def _iter_fetch_literals(data) -> Iterator[Tuple[bytes, bytes]]:
+        """
+        Recorre una respuesta FETCH con literales: (línea de respuesta, contenido). Las flags
+        que el servidor envía después del literal se agregan a la línea de respuesta.
+        """
+        items = list(data or [])
+        for position, item in enumerate(items):
+            if not isinstance(item, tuple):
+                continue
+            response, content = item
+            trailer = items[position + 1] if position + 1 < len(items) else b""
+            if isinstance(trailer, bytes):
+                response += trailer
+            yield response, content
+
+    @staticmethod
+    def _imap_flags(response: bytes) -> str:
+        flags_match = _IMAP_FLAGS_RE.search(response or b"")
+        return flags_match.group(1).decode('ascii', 'ignore') if flags_match else ""
+
+    def get_imap_message(self, uid: str, mailbox: str = 'INBOX') -> Optional[email.message.Message]:
+        """
+        Descarga un único mensaje por UID sin marcarlo como leído (búsquedas del modo monitor).
+        """
+        imap_conn = self.connect_imap()
+        try:
+            imap_conn.select(_imap_quote(mailbox), readonly=True)
+            typ, msg_data = imap_conn.uid('FETCH', str(uid), '(BODY.PEEK[])')
+            if not msg_data or not isinstance(msg_data[0], tuple):
+                return None
+            return email.message_from_bytes(msg_data[0][1])
+        finally:
+            imap_conn.logout()
+
+    def _process_admitted(self, email_msg: email.message.Message, spool_threshold: Optional[int] = None) -> bool:
+        try:
+            return self.process_single_email(email_msg, spool_threshold)
+        except Exception as e:
+            logger.error(f"Error procesando email: {e}")
+            return False
+
     def send_email(self, to_email: str, subject: str, html_content: str,
-                   attachments: List[Tuple[str, bytes]] = None, add_confirmation_cc: bool = True) -> bool:
+                   attachments: List[Union[Attachment, Tuple[str, bytes]]] = None, add_confirmation_cc: bool = True) -> bool:
         try:
             logger.info(f"Preparando email para enviar. Destino: {to_email}, Asunto: '{subject}'")
             confirmation_email = getattr(settings, 'CONFIRMATION_EMAIL', None)
@@ -104,186 +678,443 @@ class EmailXMLProcessor:
             logger.info(f"Email al que se envió: {to_email}")
             if confirmation_email and add_confirmation_cc:
                 logger.info(f"Email confirmation (CC): {confirmation_email}")
-            msg = MIMEMultipart('alternative')
-            msg['From'] = self.config.smtp_user
-            msg['To'] = to_email
-            msg['Subject'] = subject
-            if confirmation_email and add_confirmation_cc:
-                msg['Cc'] = confirmation_email
-            msg.attach(MIMEText(html_content, 'html', 'utf-8'))
-
-            if attachments:
-                for filename, content in attachments:
-                    attachment = MIMEApplication(content)
-                    attachment.add_header('Content-Disposition', 'attachment', filename=filename)
-                    msg.attach(attachment)
-
-            server = smtplib.SMTP(self.config.smtp_server, self.config.smtp_port)
-            if self.config.smtp_use_ssl:
-                server.starttls()
-            server.login(self.config.smtp_user, self.config.smtp_password)
-            server.send_message(msg)
-            server.quit()
+            # Los adjuntos se codifican en base64 por bloques al escribir el mensaje (SMTP o dry-run)
+            msg = OutboundMessage(
+                self.config.smtp_user, to_email, subject, html_content,
+                cc=confirmation_email if confirmation_email and add_confirmation_cc else None,
+                attachments=attachments or ()
+            )
+
+            if self.dry_run_dir:
+                return self._write_dry_run(msg, to_email)
+
+            with stage_timings.stage("smtp"):
+                self._smtp_deliver(msg)
             logger.info(f"Email enviado exitosamente a: {to_email}")
             return True
         except Exception as e:
             logger.error(f"Error enviando email a {to_email}: {e}")
             return False
 
-    def process_single_email(self, email_msg: email.message.Message) -> bool:
+    def _smtp_deliver(self, msg: OutboundMessage) -> None:
+        """
+        Envía el mensaje respetando el limitador SMTP (por cuenta, por dominio y envíos
+        simultáneos). Ante 421/45x la tasa se reduce y se reintenta hasta SMTP_TRANSIENT_RETRIES veces.
+        """
+        domains = {address.rsplit('@', 1)[-1].lower() for address in msg.recipients() if '@' in address}
+        limiter = get_smtp_limiter()
+        # Sin respuesta del servidor (caído, timeout) se abre el circuito y los envíos fallan sin conectar
+        breaker = get_circuit_breaker('smtp', self.config.smtp_server, self.config.smtp_port)
+        attempts = max(0, settings.SMTP_TRANSIENT_RETRIES) + 1
+        for attempt in range(1, attempts + 1):
+            code, error = None, None
+            with limiter.slot(self.config.smtp_user, domains), breaker.guard(_connection_failure):
+                try:
+                    server = smtplib.SMTP(self.config.smtp_server, self.config.smtp_port,
+                                          timeout=settings.MAIL_CONNECT_TIMEOUT or None)
+                    _set_read_timeout(server)
+                    with _mail_deadline("smtp envío", server):
+                        if self.config.smtp_use_ssl:
+                            server.starttls()
+                        server.login(self.config.smtp_user, self.config.smtp_password)
+                        refused = msg.send(server)
+                        server.quit()
+                    if refused:
+                        logger.warning(f"Destinatarios rechazados por el servidor SMTP: {', '.join(refused)}")
+                except smtplib.SMTPResponseException as e:
+                    code, error = e.smtp_code, e
+                except smtplib.SMTPRecipientsRefused as e:
+                    codes = [refused[0] for refused in e.recipients.values()]
+                    code = next((c for c in codes if c in THROTTLE_CODES), codes[0] if codes else 550)
+                    error = e
+            limiter.record(self.config.smtp_user, domains, code)
+            if error is None:
+                return
+            if code not in THROTTLE_CODES or attempt == attempts:
+                raise error
+            logger.warning(f"Servidor SMTP limitó el envío ({code}), reintento {attempt} de {attempts - 1}")
+
+    def _write_dry_run(self, msg: OutboundMessage, to_email: str) -> bool:
+        """
+        Guarda el mensaje renderizado en la carpeta de dry-run en lugar de enviarlo.
+        """
+        filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{os.getpid()}_{uuid.uuid4().hex[:8]}.eml"
+        path = self.dry_run_dir / filename
+        with open(path, 'wb') as f:
+            msg.write_to(f)
+        logger.info(f"[DRY-RUN] Email para {to_email} guardado en: {path}")
+        return True
+
+    def process_single_email(self, email_msg: email.message.Message, spool_threshold: Optional[int] = None) -> bool:
         sender = email_msg.get('From', 'Desconocido')
         subject = email_msg.get('Subject', 'Sin asunto')
         logger.info(f"Procesando email de: {sender}, Asunto: {subject}")
 
-        attachments = extract_attachments(email_msg)
-        logger.info(f"Adjuntos encontrados: {[att[0] for att in attachments]}")
+        with stage_timings.stage("adjuntos"):
+            attachments = extract_attachments(email_msg, spool_threshold)
+        logger.info(f"Adjuntos encontrados: {[att.filename for att in attachments]}")
         if not attachments:
             logger.warning("No se encontraron adjuntos en el email.")
+            self.index_result(email_msg, [], [], 'sin_adjuntos')
             return False
 
-        xml_data = None
-        xml_filename = ""
+        names = [att.filename for att in attachments]
+        claves: List[str] = []
+        try:
+            ok = self._process_attachments(sender, subject, attachments, claves)
+        except Exception as e:
+            self.index_result(email_msg, names, claves, 'error', str(e))
+            raise
+        finally:
+            for attachment in attachments:
+                attachment.close()
+        self.index_result(email_msg, names, claves, 'entregado' if ok else ('fallido' if claves else 'sin_xml'))
+        return ok
+
+    def index_result(self, email_msg: email.message.Message, attachment_names: List[str], claves: List[str],
+                     status: str, error: Optional[str] = None) -> None:
+        """
+        Registra en el índice de mensajes los adjuntos, claves de acceso y resultado del email
+        (de `email_msg` solo se leen los encabezados).
+        En dry-run no se registra: pisaría el resultado real de la entrega.
+        """
+        index = get_message_index()
+        if index is None or self.dry_run_dir:
+            return
+        try:
+            index.record_result(self.config.name, email_msg.get('Message-ID'), email_msg.get('From', ''),
+                                email_msg.get('Subject', ''), email_msg.get('Date', ''),
+                                attachment_names, claves, status, error)
+        except Exception as e:
+            logger.error(f"Error registrando el resultado en el índice de mensajes: {e}")
+
+    def _process_attachments(self, sender: str, subject: str, attachments: List[Attachment], claves: List[str]) -> bool:
+        """
+        Entrega los documentos de los adjuntos; agrega a `claves` las claves de acceso encontradas.
+        """
+        with stage_timings.stage("xml"):
+            documents = self.prepare_documents(attachments)
+        claves.extend(document.xml_data.clave_acceso for document in documents)
+        if not documents:
+            logger.error(f"No se pudo extraer datos del XML en los adjuntos: {[att.filename for att in attachments]}")
+            return False
+
+        adjuntos_procesados = [att.filename for att in attachments]
+        try:
+            if len(documents) == 1:
+                return self.deliver_document(documents[0], sender, subject, adjuntos_procesados)
+
+            # Un envío por documento, en paralelo
+            workers = max(1, min(settings.DELIVERY_WORKERS, len(documents)))
+            logger.info(f"Email con {len(documents)} documentos, entregando con {workers} workers")
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(
+                    lambda doc: self.deliver_document(doc, sender, subject, adjuntos_procesados),
+                    documents
+                ))
+            logger.info(f"Entregas completadas: {sum(results)} de {len(results)} exitosas")
+            return all(results)
+        finally:
+            for document in documents:
+                document.xml_attachment.close()
+
+    @staticmethod
+    def prepare_documents(attachments: List[Attachment]) -> List[ElectronicDocument]:
+        """
+        Extrae todos los documentos XML de los adjuntos (XML sueltos y ZIP)
+        y les asocia sus PDFs por clave de acceso o nombre de archivo.
+        No usa el estado del procesador: los workers de replay lo llaman sin crear uno.
+        """
+        documents = []
+        claves = set()
         pdf_attachments = []
 
-        for filename, content in attachments:
+        for attachment in attachments:
+            filename = attachment.filename
             logger.info(f"Procesando adjunto: {filename}")
             if filename.lower().endswith(('.xml', '.zip')):
-                xml_data = process_xml_file(content)
-                xml_filename = filename
-                logger.info(f"Datos extraídos del XML: {xml_data}")
+                for xml_filename, xml_content, xml_data, xml_root in iter_parsed_documents(attachment):
+                    xml_filename = os.path.basename(xml_filename)
+                    logger.info(f"Datos extraídos del XML {xml_filename}: {xml_data}")
+                    if xml_data.clave_acceso and xml_data.clave_acceso in claves:
+                        logger.warning(f"Documento duplicado en el email, se omite: {xml_filename} ({xml_data.clave_acceso})")
+                        continue
+                    claves.add(xml_data.clave_acceso)
+                    if not isinstance(xml_content, Attachment):
+                        xml_content = Attachment.from_bytes(xml_filename, xml_content, 'application/xml')
+                    documents.append(ElectronicDocument(xml_filename, xml_content, xml_data, xml_root=xml_root))
             elif filename.lower().endswith('.pdf'):
-                pdf_attachments.append((filename, content))
+                pdf_attachments.append(attachment)
 
-        if not xml_data:
-            logger.error(f"No se pudo extraer datos del XML en el adjunto: {xml_filename}")
-            return False
+        pair_pdfs(documents, pdf_attachments)
+        for document in documents:
+            if document.pdfs or not settings.RIDE_ENABLED:
+                # El árbol solo hace falta para el RIDE
+                document.xml_root = None
+        return documents
+
+    def deliver_document(self, document: ElectronicDocument, sender: str, subject: str,
+                         adjuntos_procesados: List[str], clean_pdfs: bool = True) -> bool:
+        """
+        Envía el email de cliente (y el de procesamiento o su entrada en el digest) de un documento.
+        Con clean_pdfs=False los PDFs del documento se adjuntan tal cual (ya vienen limpios).
+        """
+        xml_data = document.xml_data
+        xml_filename = document.xml_filename
 
         destination_email = self.test_email if self.environment == 'test' else xml_data.email_destinatario
         logger.info(f"Email destino para cliente: {destination_email}")
 
-        # Construir número de comprobante: estab + ptoEmi + secuencial
-        numero_comprobante = ""
-        if xml_data.estab and xml_data.pto_emi and xml_data.secuencial:
-            numero_comprobante = f"{xml_data.estab}-{xml_data.pto_emi}-{xml_data.secuencial}"
-        
-        # Obtener texto descriptivo usando los métodos de XMLData
-        tipo_documento_texto = xml_data.get_tipo_documento_texto()
-        tipo_emision_texto = xml_data.get_tipo_emision_texto()
-
         # *** CAMBIO PRINCIPAL: Usar el mismo contexto y plantillas que en main.py ***
-        context = {
-            "fecha_procesamiento": datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
-            "entorno": self.environment,
-            "email_origen": sender,
-            "asunto_original": subject,
-            "xml_filename": xml_filename,
-            "email_extraido": xml_data.email_destinatario,
-            "clave_acceso": xml_data.clave_acceso,
-            "total_con_impuestos": xml_data.total_con_impuestos,
-            "razon_social": xml_data.razon_social_comprador or xml_data.razon_social,
-            "fecha_emision": xml_data.fecha_emision,
-            "numero_factura": xml_data.numero_factura,
-            "adjuntos_procesados": [att[0] for att in attachments],
-            "xml_data": xml_data.__dict__,
-            
-            # *** NUEVOS CAMPOS AGREGADOS ***
-            "numero_comprobante": numero_comprobante,
-            "numero_autorizacion": xml_data.numero_autorizacion,
-            "estab": xml_data.estab,
-            "pto_emi": xml_data.pto_emi,
-            "secuencial": xml_data.secuencial,
-            "codigo_documento": xml_data.codigo_documento,
-            "tipo_documento_texto": tipo_documento_texto,
-            "tipo_emision": xml_data.tipo_emision,
-            "tipo_emision_texto": tipo_emision_texto
-        }
+        # Vista de solo lectura: los datos del XML (número de comprobante, tipo de documento...)
+        # se leen de xml_data al renderizar, sin copiarlos a un diccionario por email
+        context = DocumentContext(
+            xml_data,
+            fecha_procesamiento=datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
+            entorno=self.environment,
+            email_origen=sender,
+            asunto_original=subject,
+            xml_filename=xml_filename,
+            adjuntos_procesados=adjuntos_procesados
+        )
         
         logger.info(f"=== SERVICIO - CONTEXTO PARA PLANTILLAS ===")
-        logger.info(f"Número de comprobante generado: {numero_comprobante}")
-        logger.info(f"Tipo de documento: {xml_data.codigo_documento} - {tipo_documento_texto}")
-        logger.info(f"Tipo de emisión: {xml_data.tipo_emision} - {tipo_emision_texto}")
-        #logger.info(f"Contexto completo: {json.dumps(context, indent=2, ensure_ascii=False)}")
+        logger.info(f"Número de comprobante generado: {xml_data.get_numero_comprobante()}")
+        logger.info(f"Tipo de documento: {xml_data.codigo_documento} - {xml_data.get_tipo_documento_texto()}")
+        logger.info(f"Tipo de emisión: {xml_data.tipo_emision} - {xml_data.get_tipo_emision_texto()}")
 
         # Email de procesamiento - MISMO que en main.py
-        logger.info("=== ENVIANDO EMAIL DE PROCESSING (email_template.html) ===")
         ts = TemplatesService()  # Usar instancia como en main.py
-        processing_html = ts.render("email_template.html", context)
-        #logger.info(f"HTML generado para email_template.html (primeros 200 chars): {processing_html[:200]}...")
-        result_proc = self.send_email(
-            self.config.smtp_user, 
-            f"[{self.environment.upper()}] XML Procesado - {xml_filename}", 
-            processing_html,
-            add_confirmation_cc=False
-        )
-        if result_proc:
-            logger.info(f"Email de procesamiento enviado correctamente a {self.config.smtp_user}")
+        if self.digest:
+            # En modo digest el email de procesamiento se agrupa en el resumen
+            result_proc = True
         else:
-            logger.error(f"Error al enviar email de procesamiento a {self.config.smtp_user}")
+            logger.info("=== ENVIANDO EMAIL DE PROCESSING (email_template.html) ===")
+            with stage_timings.stage("plantillas"):
+                processing_html = ts.render("email_template.html", context)
+            #logger.info(f"HTML generado para email_template.html (primeros 200 chars): {processing_html[:200]}...")
+            result_proc = self.send_email(
+                self.config.smtp_user, 
+                f"[{self.environment.upper()}] XML Procesado - {xml_filename}", 
+                processing_html,
+                add_confirmation_cc=False
+            )
+            if result_proc:
+                logger.info(f"Email de procesamiento enviado correctamente a {self.config.smtp_user}")
+            else:
+                logger.error(f"Error al enviar email de procesamiento a {self.config.smtp_user}")
 
         # Email de cliente - MISMO que en main.py (usar webpos_template.html)
         logger.info("=== ENVIANDO EMAIL DE CLIENTE (webpos_template.html) ===")
-        client_html = ts.render("webpos_template.html", context)  
-        
-        # Adjuntar solo el XML y los PDFs correctamente
-        xml_attachment = None
-        for filename, content in attachments:
-            if filename.lower().endswith('.xml'):
-                xml_attachment = (filename, content)
-        client_attachments = []
-        if xml_attachment:
-            client_attachments.append(xml_attachment)
-        # Limpiar PDFs antes de adjuntar usando perseo_remove
+        with stage_timings.stage("plantillas"):
+            client_html = ts.render("webpos_template.html", context)
         
-        for filename, content in pdf_attachments:
-            pdf_limpio = limpiar_perseo_pdf_bytes(content)
-            client_attachments.append((filename, pdf_limpio))
+        # Adjuntar solo el XML del documento y sus PDFs
+        client_attachments = [document.xml_attachment]
+        # Limpiar PDFs antes de adjuntar usando perseo_remove (PyMuPDF se importa recién aquí)
+        pdfs_limpios = []
+        if clean_pdfs:
+            from core.perseo_remove import limpiar_perseo_pdf
+            with stage_timings.stage("pdf"):
+                pdfs_limpios = [limpiar_perseo_pdf(pdf) for pdf in document.pdfs]
+            client_attachments.extend(pdfs_limpios)
+        else:
+            client_attachments.extend(document.pdfs)
+        if not document.pdfs and settings.RIDE_ENABLED:
+            # El proveedor envió el XML sin PDF: generar el RIDE
+            ride = self._generate_ride(document)
+            if ride is not None:
+                pdfs_limpios.append(ride)
+                client_attachments.append(ride)
 
         confirmation_email = getattr(settings, 'CONFIRMATION_EMAIL', None)
         # Log de archivos adjuntos y hora de envío
         hora_envio = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        archivos = [fn for fn, _ in client_attachments]
+        archivos = [att.filename for att in client_attachments]
         logger.info(f"Hora de envío: {hora_envio}")
         logger.info(f"Archivos enviados: {archivos}")
         logger.info(f"Email destino: {destination_email}")
         if confirmation_email:
             logger.info(f"Email CC: {confirmation_email}")
 
-        result_client = self.send_email(
-            destination_email, 
-            "Su Documento Electrónico - WebPOS", 
-            client_html, 
-            client_attachments
-        )
-        if result_client:
+        try:
+            if self.bundler:
+                # El documento espera en el email agrupado del destinatario, guardado en BUNDLE_SPOOL_DIR
+                # hasta que se envía (se archiva al enviarse)
+                result_client = self.bundler.add(destination_email, context, client_attachments)
+            else:
+                result_client = self.send_email(
+                    destination_email, 
+                    "Su Documento Electrónico - WebPOS", 
+                    client_html, 
+                    client_attachments
+                )
+                if result_client:
+                    self._archive_document(xml_data.clave_acceso or xml_filename, client_attachments)
+        finally:
+            for pdf_limpio in pdfs_limpios:
+                pdf_limpio.close()
+        if self.bundler:
+            if result_client:
+                logger.info(f"Documento agregado al email agrupado de {destination_email}")
+        elif result_client:
             logger.info(f"Email de cliente enviado correctamente a {destination_email}")
         else:
             logger.error(f"Error al enviar email de cliente a {destination_email}")
+
+        if self.digest:
+            if result_client:
+                self.digest.add(context)
+            else:
+                # Los errores no esperan al resumen: se notifican de inmediato
+                context = context.with_values(error_envio=f"No se pudo enviar el documento a {destination_email}")
+                result_proc = self.send_email(
+                    self.config.smtp_user,
+                    f"[{self.environment.upper()}] ERROR de envío - {xml_filename}",
+                    ts.render("email_template.html", context),
+                    add_confirmation_cc=False
+                )
             
         return result_proc and result_client
 
-    def run_service(self, check_interval: int = settings.CHECK_INTERVAL):
-        logger.info("=== INICIANDO SERVICIO - PROCESANDO EMAILS REALES ===")
-        emails = self.get_unread_emails_imap()
-        logger.info(f"Correos no leídos encontrados: {len(emails)}")
-        if not emails:
+    def _archive_document(self, clave_acceso: str, attachments: List[Attachment]) -> None:
+        """
+        Encola en el archivo legal (ARCHIVE_DIR) el XML y los PDFs tal como se entregaron.
+        """
+        store = get_archive_store()
+        if store is None or self.dry_run_dir:
+            return
+        try:
+            store.submit(clave_acceso, [(attachment.filename, attachment.view()) for attachment in attachments])
+        except Exception as e:
+            logger.error(f"Error archivando el documento {clave_acceso}: {e}")
+
+    def check_mailbox(self) -> int:
+        """
+        Revisa el buzón con el protocolo configurado (MAIL_PROTOCOL) y procesa los correos nuevos.
+        Retorna la cantidad de correos procesados.
+        """
+        if self.config.mail_protocol == 'pop3':
+            processed = self.process_pop_mailbox()
+        else:
+            processed = self.process_imap_mailbox()
+        if not processed:
             logger.info("No hay correos nuevos para procesar.")
-        for idx, email_msg in enumerate(emails):
-            logger.info(f"Procesando email #{idx+1} de {len(emails)}")
-            self.process_single_email(email_msg)
-        if check_interval > 0:
-            import time
+        return processed
+
+    def _generate_ride(self, document: ElectronicDocument) -> Optional[Attachment]:
+        """
+        Genera el RIDE (PDF) de un documento que llegó sin PDF. ReportLab se importa recién aquí.
+        """
+        from core.pdf import generar_ride
+        try:
+            with stage_timings.stage("ride"):
+                # Desde el árbol que ya parseó xml_processor, sin copiar ni volver a parsear el XML
+                xml = document.xml_root if document.xml_root is not None else document.xml_attachment
+                pdf_bytes = generar_ride(xml, document.xml_data)
+        except Exception as e:
+            logger.error(f"No se pudo generar el RIDE de {document.xml_filename}: {e}")
+            return None
+        filename = f"RIDE_{document.xml_data.clave_acceso or document.basename}.pdf"
+        logger.info(f"🧾 RIDE generado para {document.xml_filename}: {filename} ({len(pdf_bytes)} bytes)")
+        return Attachment.from_bytes(filename, pdf_bytes, 'application/pdf')
+
+    def _read_inbox_status(self) -> Optional[Tuple[int, int]]:
+        """
+        (UNSEEN, UIDNEXT) de INBOX con STATUS en la sesión que se mantiene abierta entre
+        revisiones, sin SELECT ni búsqueda. Si falla se cierra la sesión (se reabre en la
+        siguiente consulta) y retorna None.
+        """
+        try:
+            if self._status_conn is None:
+                self._status_conn = self.connect_imap()
+            with _mail_deadline("imap estado", self._status_conn):
+                typ, data = self._status_conn.status('INBOX', '(UNSEEN UIDNEXT)')
+            values = {}
+            if typ == 'OK' and data and data[0]:
+                values = {key.upper(): int(value) for key, value in _STATUS_RE.findall(data[0])}
+            if b'UNSEEN' not in values or b'UIDNEXT' not in values:
+                raise imaplib.IMAP4.error(f"respuesta STATUS inesperada: {typ} {data}")
+            return values[b'UNSEEN'], values[b'UIDNEXT']
+        except CircuitOpen:
+            raise
+        except Exception as e:
+            logger.warning(f"No se pudo consultar STATUS de INBOX, se hace la revisión completa: {e}")
+            self._close_status_conn()
+            return None
+
+    def _close_status_conn(self) -> None:
+        conn, self._status_conn = self._status_conn, None
+        if conn is not None:
+            try:
+                conn.logout()
+            except Exception:
+                pass
+
+    def _poll_mailbox(self) -> int:
+        """
+        Revisión del modo servicio. Con IMAP y POLL_STATUS_CHECK, si STATUS muestra el mismo
+        UNSEEN y UIDNEXT que tras la última revisión completa (y no venció
+        POLL_FULL_CHECK_SECONDS) no hay nada nuevo y se omiten el login, el SELECT y la búsqueda.
+        Retorna la cantidad de correos procesados.
+        """
+        use_status = self.config.mail_protocol != 'pop3' and settings.POLL_STATUS_CHECK
+        if not use_status:
+            return self.check_mailbox()
+        before = self._read_inbox_status()
+        if (before is not None and before == self._inbox_status
+                and time.monotonic() - self._last_full_check < settings.POLL_FULL_CHECK_SECONDS):
+            return 0
+        self._inbox_status = None
+        processed = self.check_mailbox()
+        self._last_full_check = time.monotonic()
+        after = self._read_inbox_status()
+        # Si llegó un correo durante la revisión (cambió UIDNEXT) no se guarda el estado:
+        # la siguiente revisión vuelve a ser completa
+        if before is not None and after is not None and after[1] == before[1]:
+            self._inbox_status = after
+        return processed
+
+    def run_service(self, check_interval: int = settings.CHECK_INTERVAL):
+        logger.info(f"=== INICIANDO SERVICIO - PROCESANDO EMAILS REALES ({self.config.mail_protocol.upper()}, {self.config.name}) ===")
+        cleanup_old_logs()
+        TemplatesService.preload()
+        if check_interval <= 0:
+            try:
+                self.check_mailbox()
+            finally:
+                self.flush_pending()
+            return
+        # check_interval es el intervalo inicial; luego se adapta al tráfico (POLL_ADAPTIVE)
+        poller = AdaptivePoller(check_interval, settings.POLL_MIN_INTERVAL, settings.POLL_MAX_INTERVAL,
+                                settings.POLL_BACKOFF_FACTOR) if settings.POLL_ADAPTIVE else None
+        try:
+            processed = self._poll_mailbox()
             while True:
+                if self.bundler:
+                    self.bundler.flush_if_due()
+                if self.digest:
+                    self.digest.flush_if_due()
+                time.sleep(poller.record(processed) if poller else check_interval)
+                processed = 0
                 try:
-                    emails = self.get_unread_emails_imap()
-                    logger.info(f"Correos no leídos encontrados: {len(emails)}")
-                    if not emails:
-                        logger.info("No hay correos nuevos para procesar.")
-                    for idx, email_msg in enumerate(emails):
-                        logger.info(f"Procesando email #{idx+1} de {len(emails)}")
-                        self.process_single_email(email_msg)
+                    processed = self._poll_mailbox()
+                except CircuitOpen as e:
+                    logger.warning(f"⏸️ {e}")
                 except Exception as e:
                     logger.error(f"Error en servicio: {e}")
-                time.sleep(check_interval)
+        finally:
+            # Ctrl+C o SIGTERM: enviar lo pendiente antes de salir
+            self.flush_pending()
+
+    def flush_pending(self) -> None:
+        """
+        Envía los emails agrupados y el resumen de procesamiento pendientes.
+        """
+        if self.bundler:
+            self.bundler.flush()
+        if self.digest:
+            self.digest.flush()
 
     def test_send_email(self, test_type: str = "both"):
         from services.templates_service import test_processing_template, test_client_template
@@ -0,0 +1,192 @@
+import email
+import email.message
+import mailbox
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from typing import Iterator, List, Optional, Tuple
+
+from config import settings
+from core.logger import logger
+
+# Mensajes en vuelo por worker antes de esperar resultados
+_IN_FLIGHT_PER_WORKER = 4
+
+# Encabezados del mensaje original que usa el índice de mensajes
+_INDEX_HEADERS = ('From', 'Subject', 'Date', 'Message-ID')
+
+
+def iter_source_messages(source: str) -> Iterator[Tuple[str, bytes]]:
+    """
+    Genera (identificador, bytes del mensaje) desde un mbox, un Maildir o una
+    carpeta de archivos .eml, leyendo un mensaje a la vez.
+    """
+    if os.path.isdir(source):
+        if all(os.path.isdir(os.path.join(source, sub)) for sub in ('cur', 'new', 'tmp')):
+            maildir = mailbox.Maildir(source, factory=None, create=False)
+            for key in maildir.iterkeys():
+                yield key, maildir.get_bytes(key)
+            return
+        for root, _, files in os.walk(source):
+            for name in sorted(files):
+                if name.lower().endswith('.eml'):
+                    path = os.path.join(root, name)
+                    with open(path, 'rb') as f:
+                        yield path, f.read()
+        return
+
+    mbox = mailbox.mbox(source, factory=None, create=False)
+    try:
+        for key in mbox.iterkeys():
+            yield f"{os.path.basename(source)}#{key}", mbox.get_bytes(key)
+    finally:
+        mbox.close()
+
+
+def _prepare_message(key: str, raw: bytes) -> Tuple[str, email.message.Message, List[str], list, str]:
+    """
+    Tarea del worker: extrae los adjuntos del mensaje, parsea sus XML, limpia los PDFs con
+    limpiar_perseo_pdf_bytes (o genera el RIDE si el XML no tiene PDF). El envío lo hace el
+    proceso principal, con un único limitador SMTP para todos los workers.
+    Retorna (identificador, encabezados, nombres de adjuntos,
+    [(xml_filename, xml_bytes, xml_data, [(pdf_filename, pdf_limpio)])], error).
+    """
+    from core.perseo_remove import limpiar_perseo_pdf_bytes
+    from services.attachment_handler import extract_attachments
+    from services.email_service import EmailXMLProcessor
+
+    headers = email.message.Message()
+    names: List[str] = []
+    try:
+        email_msg = email.message_from_bytes(raw)
+        # Solo los encabezados que registra el índice de mensajes viajan al proceso principal
+        for name in _INDEX_HEADERS:
+            if email_msg.get(name) is not None:
+                headers[name] = email_msg.get(name)
+        attachments = extract_attachments(email_msg)
+        try:
+            names = [attachment.filename for attachment in attachments]
+            documents = EmailXMLProcessor.prepare_documents(attachments)
+            try:
+                prepared = []
+                for document in documents:
+                    pdfs = [(pdf.filename, limpiar_perseo_pdf_bytes(pdf)) for pdf in document.pdfs]
+                    if not pdfs and settings.RIDE_ENABLED:
+                        # XML sin PDF: el RIDE se genera aquí, en el pool de procesos
+                        from core.pdf import generar_ride
+                        xml = document.xml_root if document.xml_root is not None else document.xml_attachment
+                        try:
+                            pdfs.append((f"RIDE_{document.xml_data.clave_acceso or document.basename}.pdf",
+                                         generar_ride(xml, document.xml_data)))
+                        except Exception as e:
+                            logger.error(f"No se pudo generar el RIDE de {document.xml_filename}: {e}")
+                    prepared.append((document.xml_filename, document.xml_attachment.getvalue(),
+                                     document.xml_data, pdfs))
+            finally:
+                for document in documents:
+                    document.xml_attachment.close()
+        finally:
+            for attachment in attachments:
+                attachment.close()
+        return key, headers, names, prepared, ""
+    except Exception as e:
+        return key, headers, names, [], str(e)
+
+
+def run_replay(source: str, dry_run_dir: Optional[str] = None, workers: Optional[int] = None) -> dict:
+    """
+    Reprocesa un archivo de correos (mbox, Maildir o carpeta .eml) con el mismo
+    pipeline que el servicio: extracción, parseo y limpieza de PDFs repartidos entre
+    varios procesos; envío desde este proceso con DELIVERY_WORKERS hilos, como el modo batch,
+    para que los límites SMTP (SMTP_RATE_PER_SECOND, SMTP_MAX_IN_FLIGHT...) no se multipliquen
+    por la cantidad de workers.
+    """
+    from core.attachment import Attachment
+    from core.document import ElectronicDocument
+    from services.email_service import EmailXMLProcessor
+
+    if not os.path.exists(source):
+        raise FileNotFoundError(f"No se encontró la fuente de correos: {source}")
+
+    workers = max(1, workers or os.cpu_count() or 1)
+    stats = {'total': 0, 'ok': 0, 'failed': 0, 'errors': []}
+    logger.info(f"=== MODO REPLAY - Fuente: {source}, workers: {workers}"
+                f"{', dry-run en ' + dry_run_dir if dry_run_dir else ''} ===")
+    processor = EmailXMLProcessor(dry_run_dir=dry_run_dir)
+    lock = threading.Lock()
+
+    def deliver(result) -> None:
+        key, headers, names, prepared, error = result
+        sender = headers.get('From', 'Desconocido')
+        subject = headers.get('Subject', 'Sin asunto')
+        logger.info(f"Procesando email de: {sender}, Asunto: {subject}")
+        claves = [xml_data.clave_acceso for _, _, xml_data, _ in prepared]
+        ok = bool(prepared) and not error
+        try:
+            for xml_filename, xml_bytes, xml_data, pdfs in prepared:
+                document = ElectronicDocument(xml_filename, Attachment.from_bytes(xml_filename, xml_bytes, 'application/xml'), xml_data)
+                document.pdfs.extend(Attachment.from_bytes(pdf_filename, pdf_limpio, 'application/pdf')
+                                     for pdf_filename, pdf_limpio in pdfs)
+                try:
+                    # Los PDFs ya vienen limpios desde el worker
+                    ok = processor.deliver_document(document, sender, subject, names, clean_pdfs=False) and ok
+                finally:
+                    document.xml_attachment.close()
+                    for pdf in document.pdfs:
+                        pdf.close()
+        except Exception as e:
+            ok, error = False, str(e)
+        if error:
+            processor.index_result(headers, names, claves, 'error', error)
+        elif not names:
+            processor.index_result(headers, [], [], 'sin_adjuntos')
+        else:
+            processor.index_result(headers, names, claves, 'entregado' if ok else ('fallido' if claves else 'sin_xml'))
+        with lock:
+            if ok:
+                stats['ok'] += 1
+            else:
+                stats['failed'] += 1
+                stats['errors'].append(f"{key}: {error or 'no procesado'}")
+
+    started = time.monotonic()
+    delivery_workers = max(1, settings.DELIVERY_WORKERS)
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool, \
+                ThreadPoolExecutor(max_workers=delivery_workers) as senders:
+            preparing, sending = set(), set()
+
+            def send(done) -> None:
+                nonlocal sending
+                for future in done:
+                    sending.add(senders.submit(deliver, future.result()))
+                # Contrapresión: no acumular mensajes preparados más rápido de lo que se envían
+                while len(sending) >= delivery_workers * _IN_FLIGHT_PER_WORKER:
+                    finished, sending = wait(sending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        future.result()
+
+            for key, raw in iter_source_messages(source):
+                stats['total'] += 1
+                preparing.add(pool.submit(_prepare_message, key, raw))
+                if len(preparing) >= workers * _IN_FLIGHT_PER_WORKER:
+                    done, preparing = wait(preparing, return_when=FIRST_COMPLETED)
+                    send(done)
+            send(wait(preparing)[0])
+            for future in wait(sending)[0]:
+                future.result()
+    finally:
+        if processor.bundler:
+            processor.bundler.flush()
+        if processor.digest:
+            processor.digest.flush()
+
+    elapsed = time.monotonic() - started
+    rate = stats['total'] / elapsed * 60 if elapsed > 0 else 0
+    stats['elapsed_seconds'] = round(elapsed, 2)
+    logger.info(f"=== REPLAY COMPLETADO: {stats['total']} mensajes, {stats['ok']} exitosos, "
+                f"{stats['failed']} con error, {elapsed:.1f}s ({rate:.0f} mensajes/min) ===")
+    for error in stats['errors']:
+        logger.warning(f"   - {error}")
+    return stats
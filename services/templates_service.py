@@ -1,11 +1,10 @@
-from jinja2 import Template
+from collections import ChainMap
+from collections.abc import Mapping
 from datetime import datetime
+from functools import lru_cache
 from core.xml_data import XMLData
-from jinja2 import Environment, FileSystemLoader
 from config import settings
 
-env = Environment(loader=FileSystemLoader(settings.TEMPLATES_DIR))
-
 import os
 TEMPLATES_DIR = os.path.join(os.path.dirname(__file__), '../templates')
 
@@ -15,7 +14,40 @@ processing_template_str = """<html><body><h1>Procesamiento XML</h1>
 client_template_str = """<html><body><h1>Documento Electrónico</h1>
 <p>Cliente: {{ razon_social }}</p></body></html>"""
 
+@lru_cache(maxsize=64)
+def _build_template(path: str, mtime: float) -> str:
+    """
+    Fuente de la plantilla lista para renderizar: con TEMPLATES_COMPACT el CSS se aplica en
+    línea y el HTML se minifica. Se calcula una vez por versión (mtime) del archivo.
+    """
+    with open(path, encoding="utf-8") as f:
+        source = f.read()
+    if settings.TEMPLATES_COMPACT and path.endswith(".html"):
+        from core.html_compact import compact_html
+        source = compact_html(source)
+    return source
+
+def _load_template(name: str):
+    """
+    Cargador de Jinja: (fuente compacta, ruta, función que indica si el archivo no cambió).
+    """
+    from jinja2.loaders import split_template_path
+    path = os.path.join(settings.TEMPLATES_DIR, *split_template_path(name))
+    if not os.path.isfile(path):
+        return None
+    mtime = os.path.getmtime(path)
+    return _build_template(path, mtime), path, lambda: os.path.isfile(path) and os.path.getmtime(path) == mtime
+
+@lru_cache(maxsize=None)
+def get_env():
+    """
+    Entorno Jinja2 global, creado en el primer render (jinja2 se importa de forma diferida).
+    """
+    from jinja2 import Environment, FunctionLoader
+    return Environment(loader=FunctionLoader(_load_template))
+
 def render_processing_template(xml_data: XMLData, email_origen: str, xml_filename: str, adjuntos: list) -> str:
+    from jinja2 import Template
     template = Template(processing_template_str)
     return template.render(
         fecha_procesamiento=datetime.now().strftime("%d/%m/%Y %H:%M:%S"),
@@ -32,6 +64,7 @@ def render_processing_template(xml_data: XMLData, email_origen: str, xml_filenam
     )
 
 def render_client_template(xml_data: XMLData) -> str:
+    from jinja2 import Template
     template = Template(client_template_str)
     return template.render(
         razon_social=xml_data.razon_social or "Cliente",
@@ -66,8 +99,24 @@ class TemplatesService:
         return test_client_template()
 
     @staticmethod
-    def render(template_name: str, context: dict) -> str:
-        # Usa la instancia global 'env' definida arriba
-        global env
+    def preload() -> None:
+        """
+        Compila al inicio las plantillas HTML (CSS en línea y minificado) para que el primer email no espere.
+        """
+        env = get_env()
+        for name in sorted(os.listdir(settings.TEMPLATES_DIR)):
+            if name.endswith(".html"):
+                env.get_template(name)
+
+    @staticmethod
+    def render(template_name: str, context: Mapping) -> str:
+        # Usa la instancia global del entorno, creada en el primer render
+        env = get_env()
         template = env.get_template(template_name)
-        return template.render(**context)
\ No newline at end of file
+        # shared=True usa el mapping como contexto sin copiarlo (render(**context) crea un dict nuevo);
+        # ChainMap agrega los globales del entorno, que shared=True no incluye
+        template_context = template.new_context(ChainMap(context, env.globals), shared=True)
+        try:
+            return env.concat(template.root_render_func(template_context))
+        except Exception:
+            return env.handle_exception()
\ No newline at end of file
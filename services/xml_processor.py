@@ -1,20 +1,65 @@
 import zipfile, io
 import xml.etree.ElementTree as ET
-from typing import Optional
+from typing import Iterator, Optional, Tuple, Union
+from config import settings
+from core.attachment import Attachment
 from core.logger import logger
 from core.xml_data import XMLData
 
-def process_xml_file(xml_content: bytes) -> Optional[XMLData]:
+# Tamaño de bloque al descomprimir entradas de un ZIP
+_ZIP_READ_CHUNK = 64 * 1024
+
+def process_xml_file(xml_content: Union[bytes, Attachment]) -> Optional[XMLData]:
+    """
+    Procesa un XML (o el primer XML de un ZIP) y retorna sus datos.
+    """
+    for _, _, xml_data in iter_xml_documents(xml_content):
+        return xml_data
+    return None
+
+def iter_xml_documents(content: Union[bytes, Attachment],
+                       filename: str = "") -> Iterator[Tuple[str, Union[bytes, Attachment], XMLData]]:
+    """
+    Genera (filename, contenido_xml, XMLData) por cada documento del adjunto:
+    uno para un XML suelto y uno por cada entrada .xml válida si es un ZIP.
+    """
+    for xml_filename, xml_content, xml_data, _ in iter_parsed_documents(content, filename):
+        yield xml_filename, xml_content, xml_data
+
+def iter_parsed_documents(content: Union[bytes, Attachment], filename: str = ""
+                          ) -> Iterator[Tuple[str, Union[bytes, Attachment], XMLData, ET.Element]]:
+    """
+    Como iter_xml_documents, pero agrega el árbol ya parseado del comprobante (el del CDATA
+    en un XML de autorización), para armar el RIDE sin volver a parsear el XML.
+    """
+    try:
+        is_attachment = isinstance(content, Attachment)
+        if is_attachment and not filename:
+            filename = content.filename
+        head = content.head(2) if is_attachment else bytes(content[:2])
+        if head == b'PK':
+            for entry_name, entry_content in _iter_zip_xml(content):
+                xml_data, root = _parse_document(entry_content)
+                if xml_data:
+                    yield entry_name, entry_content, xml_data, root
+            return
+        xml_data, root = _parse_document(content.view() if is_attachment else content)
+        if xml_data:
+            yield filename, content, xml_data, root
+    except Exception as e:
+        logger.error(f"Error procesando XML: {e}")
+
+def _parse_document(xml_content: Union[bytes, memoryview]) -> Tuple[Optional[XMLData], Optional[ET.Element]]:
+    """
+    (XMLData, árbol del comprobante) de un XML; (None, None) si no se pudo procesar.
+    """
     try:
-        if xml_content.startswith(b'PK'):
-            return _process_zip_xml(xml_content)
         # Detectar si es un XML de autorizacion con CDATA
         try:
-            text = xml_content.decode('utf-8')
+            text = str(xml_content, 'utf-8')
         except Exception:
-            text = xml_content.decode('latin1')
+            text = str(xml_content, 'latin1')
         if '<autorizacion>' in text and '<comprobante><![CDATA[' in text:
-            import xml.etree.ElementTree as ET
             try:
                 root = ET.fromstring(text)
                 comprobante = root.find('comprobante')
@@ -27,28 +72,98 @@ def process_xml_file(xml_content: bytes) -> Optional[XMLData]:
                         if idx != -1:
                             inner_xml = inner_xml[idx+2:].lstrip('\r\n')
                     # Procesar el contenido del CDATA
-                    xml_data = _parse_xml_content(inner_xml.encode('utf-8'))
+                    inner_root = ET.fromstring(inner_xml.encode('utf-8'))
+                    xml_data = _parse_xml_content(inner_root)
                     if xml_data:
                         # EXTRAER DATOS DEL XML DE AUTORIZACIÓN (fuera del CDATA)
                         _extract_authorization_data(root, xml_data)
-                    return xml_data
+                        # El RIDE los lee del comprobante: se copian al árbol del CDATA
+                        for tag in ("numeroAutorizacion", "fechaAutorizacion"):
+                            value = root.findtext(tag)
+                            if value and inner_root.find(tag) is None:
+                                ET.SubElement(inner_root, tag).text = value
+                    return xml_data, inner_root
             except Exception as e:
                 logger.error(f"Error extrayendo CDATA con ElementTree: {e}")
-                return None
-        return _parse_xml_content(xml_content)
+                return None, None
+        try:
+            root = ET.fromstring(xml_content)
+        except Exception as e:
+            logger.error(f"Error parseando XML: {e}")
+            return None, None
+        return _parse_xml_content(root), root
     except Exception as e:
         logger.error(f"Error procesando XML: {e}")
-        return None
+        return None, None
 
-def _process_zip_xml(zip_content: bytes) -> Optional[XMLData]:
-    try:
-        zip_file = zipfile.ZipFile(io.BytesIO(zip_content))
-        for file_info in zip_file.filelist:
-            if file_info.filename.lower().endswith('.xml'):
-                return _parse_xml_content(zip_file.read(file_info.filename))
-    except Exception as e:
-        logger.error(f"Error procesando ZIP: {e}")
-        return None
+def _iter_zip_xml(zip_content: Union[bytes, memoryview, Attachment]) -> Iterator[Tuple[str, bytes]]:
+    """
+    Recorre las entradas .xml de un ZIP leyéndolas por bloques con ZipFile.open y
+    aplicando los límites ZIP_MAX_* de cantidad de entradas, tamaño y tasa de compresión.
+    """
+    # ZipFile no cierra el archivo que recibe: el del Attachment (mmap si está en disco) se cierra aquí
+    source = zip_content.open() if isinstance(zip_content, Attachment) else io.BytesIO(zip_content)
+    with source:
+        try:
+            zip_file = zipfile.ZipFile(source)
+        except Exception as e:
+            logger.error(f"Error procesando ZIP: {e}")
+            return
+        with zip_file:
+            yield from _iter_zip_entries(zip_file)
+
+def _iter_zip_entries(zip_file: zipfile.ZipFile) -> Iterator[Tuple[str, bytes]]:
+    """
+    Entradas .xml válidas de un ZIP ya abierto, dentro de los límites ZIP_MAX_*.
+    """
+    entries = zip_file.infolist()
+    if len(entries) > settings.ZIP_MAX_ENTRIES:
+        logger.error(f"ZIP rechazado: {len(entries)} entradas (máximo {settings.ZIP_MAX_ENTRIES})")
+        return
+
+    total_bytes = 0
+    for file_info in entries:
+        if file_info.is_dir() or not file_info.filename.lower().endswith('.xml'):
+            continue
+        # Validación previa con los tamaños declarados en el directorio central
+        if file_info.file_size > settings.ZIP_MAX_ENTRY_BYTES:
+            logger.error(f"Entrada {file_info.filename} omitida: {file_info.file_size} bytes descomprimidos "
+                         f"(máximo {settings.ZIP_MAX_ENTRY_BYTES})")
+            continue
+        if file_info.file_size > settings.ZIP_MAX_RATIO * max(file_info.compress_size, 1):
+            logger.error(f"Entrada {file_info.filename} omitida: tasa de compresión sospechosa "
+                         f"({file_info.file_size}/{file_info.compress_size})")
+            continue
+        try:
+            content = _read_zip_entry(zip_file, file_info, settings.ZIP_MAX_TOTAL_BYTES - total_bytes)
+        except Exception as e:
+            logger.error(f"Error leyendo la entrada {file_info.filename} del ZIP: {e}")
+            continue
+        if content is None:
+            continue
+        total_bytes += len(content)
+        logger.info(f"XML extraído del ZIP: {file_info.filename} ({len(content)} bytes)")
+        yield file_info.filename, content
+
+def _read_zip_entry(zip_file: zipfile.ZipFile, file_info: zipfile.ZipInfo, remaining_bytes: int) -> Optional[bytes]:
+    """
+    Lee una entrada por bloques, cortando la descompresión si supera los límites
+    aunque los tamaños declarados en el ZIP sean falsos.
+    """
+    limit = min(settings.ZIP_MAX_ENTRY_BYTES,
+                settings.ZIP_MAX_RATIO * max(file_info.compress_size, 1),
+                remaining_bytes)
+    buffer = io.BytesIO()
+    with zip_file.open(file_info) as entry:
+        while True:
+            chunk = entry.read(_ZIP_READ_CHUNK)
+            if not chunk:
+                break
+            if buffer.tell() + len(chunk) > limit:
+                logger.error(f"Entrada {file_info.filename} omitida: la descompresión superó el límite de {limit} bytes")
+                return None
+            buffer.write(chunk)
+    return buffer.getvalue()
 
 def _extract_authorization_data(auth_root: ET.Element, xml_data: XMLData) -> None:
     """
@@ -76,23 +191,13 @@ def _extract_authorization_data(auth_root: ET.Element, xml_data: XMLData) -> Non
     except Exception as e:
         logger.error(f"Error extrayendo datos de autorización: {e}")
 
-def _parse_xml_content(xml_content: bytes) -> Optional[XMLData]:
+def _parse_xml_content(xml_content: Union[bytes, ET.Element]) -> Optional[XMLData]:
     try:
-        root = ET.fromstring(xml_content)
+        root = xml_content if isinstance(xml_content, ET.Element) else ET.fromstring(xml_content)
         
-        # Inicializar XMLData con valores por defecto
+        # Inicializar XMLData con valores por defecto (todos los campos están declarados en la clase)
         xml_data = XMLData(email_destinatario="")
         
-        # Inicializar todos los nuevos atributos con valores por defecto
-        xml_data.estab = ""
-        xml_data.pto_emi = ""
-        xml_data.secuencial = ""
-        xml_data.numero_autorizacion = ""
-        xml_data.codigo_documento = ""
-        xml_data.tipo_emision = ""
-        xml_data.fecha_autorizacion = ""
-        xml_data.estado_autorizacion = ""
-        
         # Buscar email del destinatario
         email_destinatario = None
         for campo in root.iter('campoAdicional'):
@@ -236,7 +341,7 @@ def _parse_xml_content(xml_content: bytes) -> Optional[XMLData]:
         logger.info(f"Número autorización: {xml_data.numero_autorizacion}")
         logger.info(f"Código documento: {xml_data.codigo_documento}")
         logger.info(f"Tipo emisión: {xml_data.tipo_emision}")
-        logger.info(f"Datos completos: {xml_data.__dict__}")
+        logger.info(f"Datos completos: {xml_data}")
         
         return xml_data
         